@@ -0,0 +1,461 @@
+#!/usr/bin/env python
+
+import os, sys, random, tempfile, shutil, subprocess, time, json, argparse
+
+# Benchmark overview
+
+# Generates a synthetic library with all the kinds of video dirs described at the top of
+# mediasorter.py, runs mediasorter.py over it without executing anything and reports how long each
+# phase took and how many stats, listings, regex searches etc. it did (see --profile there) as
+# JSON. Each size is run twice: first with an empty state db (cold) and then again with the scan
+# index and parse cache from the first run (warm). The sort is also planned in this process
+# through the Sorter API, to time that without process startup.
+# With --scan-agent the warm sort is run once more with the walk done by the scan agent.
+# With --parser every video name in the library is also parsed by the name parser and by the
+# reference parser below, checking that they give the same destinations and timing both.
+# With --check it instead sorts small libraries that have broken a run before, executing, with
+# each engine, and reports which did not sort as they should.
+# The NAS is replaced by a local shell, so nothing leaves this machine.
+
+mediasorter_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mediasorter.py')
+
+parser = argparse.ArgumentParser(description="Benchmark mediasorter.py on generated libraries")
+parser.add_argument('-s', '--sizes', default='100,1000,10000',
+  help='comma separated numbers of media roots to generate, e.g. "100,1000,10000,100000" (default 100,1000,10000)')
+parser.add_argument('-o', '--output', metavar='FILE',
+  help='write the results to FILE instead of stdout')
+parser.add_argument('--python', default=sys.executable,
+  help='python to run mediasorter.py with (default the one running this)')
+parser.add_argument('--seed', default=1, type=int,
+  help='seed for the generated names, the same seed gives the same library (default 1)')
+parser.add_argument('--scan-agent', default=False, action='store_true',
+  help='also run the warm sort with the walk done by the scan agent over the local shell')
+parser.add_argument('--parser', default=False, action='store_true',
+  help='also check the name parser against the reference parser on the generated names and time both')
+parser.add_argument('--check', default=False, action='store_true',
+  help='run the regression checks instead of the benchmark, exits with 1 if any fails')
+parser.add_argument('--keep', default=False, action='store_true',
+  help='do not remove the generated library afterwards')
+
+###### LIBRARY GENERATOR ###############################################
+## Every layout is a function making one media root in a parent dir, returning the number of files
+
+words = ['the', 'last', 'night', 'city', 'dark', 'river', 'king', 'love', 'war', 'man', 'story', 'blue',
+  'house', 'of', 'and', 'lost', 'star', 'game', 'road', 'summer', 'ghost', 'secret', 'empire', 'amelie',
+  'matrix', 'idiots', 'gun', 'naked', 'warrior', 'juno']
+tags = ['720p', '1080p', 'BluRay', 'BRRip', 'DVDRip', 'HDTV', 'x264', 'XviD', 'DivX', 'AC3', 'DTS', 'aac',
+  'ENG', 'SWE', 'KOREAN', 'WS', 'VODRip']
+groups = ['GRP', 'aXXo', 'FXG', 'DiAMOND', 'SPARKS', 'LOL', 'demonoid', 'www.kat.ph', '1234567.TPB']
+video_exts = ['avi', 'mkv', 'mp4', 'm4v', 'divx', 'wmv']
+
+def touch(path):
+  open(path, 'w').close()
+
+def makedirs(path):
+  if not os.path.isdir(path):
+    os.makedirs(path)
+
+def release_name(rnd, sep='.'):
+  title = [w.capitalize() if rnd.random()<0.7 else w for w in rnd.sample(words, rnd.randint(1, 4))]
+  name = title + [str(rnd.randint(1950, 2013))] + rnd.sample(tags, rnd.randint(0, 4))
+  return sep.join(name) + '-' + rnd.choice(groups)
+
+def basic(rnd, parent):
+  # video_dir/video.ext
+  name = release_name(rnd)
+  root = os.path.join(parent, name)
+  makedirs(root)
+  touch(os.path.join(root, name.lower()+'.'+rnd.choice(video_exts)))
+  touch(os.path.join(root, name+'.nfo'))
+  return 2
+
+def torrent_wrapper(rnd, parent):
+  # video/video.fastresume with video/video/video.ext
+  name = release_name(rnd)
+  root = os.path.join(parent, name, name)
+  makedirs(root)
+  touch(os.path.join(parent, name, name+'.fastresume'))
+  touch(os.path.join(root, name+'.'+rnd.choice(video_exts)))
+  return 2
+
+def dvd_image(rnd, parent):
+  # video/VIDEO_TS/*.VOB
+  root = os.path.join(parent, release_name(rnd, ' ').split('-')[0].strip(), 'VIDEO_TS')
+  makedirs(root)
+  for f in ['VIDEO_TS.IFO', 'VIDEO_TS.BUP', 'VTS_01_0.IFO', 'VTS_01_1.VOB', 'VTS_01_2.VOB']:
+    touch(os.path.join(root, f))
+  return 5
+
+def multi_cd(rnd, parent):
+  # video/CD1/video-cd1.ext, video/CD2/video-cd2.ext
+  name = release_name(rnd, ' ')
+  ext = rnd.choice(video_exts)
+  for cd in (1, 2):
+    root = os.path.join(parent, name, 'CD%d' % cd)
+    makedirs(root)
+    touch(os.path.join(root, '%s-cd%d.%s' % (name.lower().replace(' ', '.'), cd, ext)))
+  return 2
+
+def rar_set(rnd, parent):
+  # video/video.rar, video.r00, ...
+  name = release_name(rnd)
+  root = os.path.join(parent, name)
+  makedirs(root)
+  touch(os.path.join(root, name.lower()+'.rar'))
+  parts = rnd.randint(2, 20)
+  for i in range(parts):
+    touch(os.path.join(root, '%s.r%02d' % (name.lower(), i)))
+  touch(os.path.join(root, name.lower()+'.sfv'))
+  return parts+2
+
+def with_sample(rnd, parent):
+  # video/video.ext with video/Sample/sample.ext
+  name = release_name(rnd)
+  root = os.path.join(parent, name)
+  makedirs(os.path.join(root, 'Sample'))
+  ext = rnd.choice(video_exts)
+  touch(os.path.join(root, name.lower()+'.'+ext))
+  touch(os.path.join(root, 'Sample', 'sample-'+name.lower()+'.'+ext))
+  touch(os.path.join(root, 'Thumbs.db'))
+  return 3
+
+def with_subs(rnd, parent):
+  # show/episode.ext with episode.srt, a season of episodes in one dir
+  show = ' '.join(w.capitalize() for w in rnd.sample(words, rnd.randint(1, 3)))
+  season = rnd.randint(1, 9)
+  root = os.path.join(parent, '%s S%02d' % (show, season))
+  makedirs(root)
+  episodes = rnd.randint(6, 24)
+  for e in range(1, episodes+1):
+    name = '%s.S%02dE%02d.%s' % (show.replace(' ', '.'), season, e, rnd.choice(['HDTV.XviD', '720p.HDTV.x264']))
+    touch(os.path.join(root, name+'.avi'))
+    if rnd.random()<0.8:
+      touch(os.path.join(root, name+'.srt'))
+  return episodes*2
+
+def flat_dump(rnd, parent):
+  # Many unrelated videos in one dir
+  root = os.path.join(parent, 'Dump %d' % rnd.randint(0, 10**9))
+  makedirs(root)
+  count = rnd.randint(5, 40)
+  for i in range(count):
+    touch(os.path.join(root, release_name(rnd)+'.'+rnd.choice(video_exts)))
+  return count
+
+# Formats the names are parsed with by --parser, the default and ones using the other keys
+parser_formats = ['$filetype/$title ($year)/$filename',
+  '$title ($year)/$title $part $resolution $rip.$ext',
+  '$filetype/$title/$part $video_codec $sound_codec $torrent - $discarded.$ext']
+
+# (layout, how often it is picked)
+layouts = [(basic, 30), (torrent_wrapper, 10), (dvd_image, 5), (multi_cd, 8), (rar_set, 7),
+  (with_sample, 15), (with_subs, 20), (flat_dump, 5)]
+
+def generate(top, roots, seed):
+  """Makes a media dir and a downloads dir in top with roots media roots in total, and a list of
+  unfinished torrents naming some of the downloads. Returns the number of files made"""
+  rnd = random.Random(seed)
+  media_dir = os.path.join(top, 'media')
+  downloads = os.path.join(top, 'downloads')
+  makedirs(media_dir)
+  makedirs(downloads)
+  choices = [layout for layout, weight in layouts for i in range(weight)]
+  files = 0
+  for i in range(roots):
+    # A third are new downloads, the rest already in the library, some in a codec subdir
+    if i%3==0:
+      parent = downloads
+    else:
+      parent = os.path.join(media_dir, rnd.choice(['', '', 'Divx', 'Mkv-Etc', 'DVD']))
+      makedirs(parent)
+    files += rnd.choice(choices)(rnd, parent)
+  with open(os.path.join(top, 'downloading.txt'), 'w') as f:
+    for d in sorted(os.listdir(downloads))[::10]:
+      f.write(d+'.torrent\n')
+  return files
+#####################################################
+
+###### REFERENCE PARSER ###############################################
+## The parser as it was before the pattern table, running each pattern over the whole name with
+## match_remove. It is what the name parser must give the same results as
+
+reference_torrent = r"[_\W]*(?P<val>(demonoid|kat|isohunt|mininova|\d{6,}|www[_\W]\w+)([_\W]\w{2,4})?)[_\W]*"
+
+def match_remove(reobj, str, metadata=None, key=None, max=1, replace='#'):
+  i = 0
+  offset = 0
+  for m in reobj.finditer(str):
+    if m and m.group('val'):
+      if metadata and key:
+        if m.group('val') not in metadata[key]:
+          metadata[key].insert(0, m.group('val'))
+      tmp = len(str) # Need to store offset if we change str length during iteration
+      str = str[:m.start('val')+offset] + replace + str[m.end('val')+offset:]
+      offset += len(str)-tmp
+      i += 1
+      if i == max:
+        break
+  return str
+
+def reference_analyze(ms, match_torrent, components, file):
+  # ms is the mediasorter module, configured
+  from string import Template
+  metadata = dict((k, []) for k in ms.format_keys)
+  for str in list(components)+[file]:
+    str = match_remove(ms.match_extension, str, metadata, 'ext')
+    str = match_remove(ms.match_part, str, metadata, 'part')
+    str = match_remove(ms.match_part_alt, str, metadata, 'part')
+    str = match_remove(ms.match_video, str, metadata, 'video_codec')
+    str = match_remove(ms.match_year, str, metadata, 'year')
+    str = match_remove(ms.match_sound, str, metadata, 'sound_codec')
+    str = match_remove(ms.match_rip, str, metadata, 'rip')
+    str = match_remove(ms.match_resolution, str, metadata, 'resolution')
+    str = match_remove(match_torrent, str, metadata, 'torrent')
+    str = match_remove(ms.match_title, str, metadata, 'title')
+    str = match_remove(ms.match_lang, str)
+    newtitles = []
+    for title in metadata['title']:
+      title = match_remove(ms.match_clean1, title, replace=' ', max=10)
+      title = match_remove(ms.match_clean2, title, replace=' ', max=10)
+      title = match_remove(ms.match_clean3, title, replace=' - ', max=10).strip()
+      if len(title)>0 and title not in newtitles:
+        newtitles.append(title)
+    metadata['title'] = newtitles
+    for part in ms.match_split.split(str):
+      part = match_remove(ms.match_clean1, part, replace=' ', max=10)
+      part = match_remove(ms.match_clean2, part, replace=' ', max=10)
+      part = match_remove(ms.match_clean3, part, replace=' ', max=10).strip()
+      if len(part)>0 and part not in metadata['discarded']:
+        metadata['discarded'].append(part)
+  if len(metadata['title'])>1:
+    metadata['title'].sort(cmp=ms.cmp_titles)
+  formatdata = dict()
+  for k in ms.chosen_format_keys:
+    formatdata[k] = metadata[k][0] if metadata.get(k) else '$$'
+  if 'filetype' in ms.chosen_format_keys:
+    formatdata['filetype'] = ms.video_types[metadata['ext'][0]]
+  if 'filename' in ms.chosen_format_keys:
+    formatdata['filename'] = file
+  format = ms.args.format
+  if 'ext' in formatdata and metadata['ext'][0] == "VIDEO_TS":
+    format = format.replace(".$ext", os.path.sep+"$ext")
+  return tuple(ms.match_unfilled_format_keys.sub("", Template(format).substitute(formatdata)).rsplit("/", 1))
+
+def video_names(top):
+  # (dir names, file name) of every video in the library in top
+  names = []
+  for base in 'media', 'downloads':
+    base = os.path.join(top, base)
+    for root, dirs, files in os.walk(base):
+      components = [c for c in os.path.relpath(root, base).split(os.sep) if c!='.']
+      names.extend((components, f) for f in sorted(files) if f.rsplit('.', 1)[-1].lower() in video_exts+['vob'])
+  return names
+
+def compare_parsers(top, formats):
+  """Parses every video name in the library in top with each format, by the reference parser, by
+  mediasorter without its parse cache and by mediasorter with its memory caches starting empty.
+  Returns the names parsed, the first differences and the microseconds per name each took"""
+  import re, mediasorter
+  match_torrent = re.compile(reference_torrent, re.I)
+  names = video_names(top)
+  result = {'names': len(names)*len(formats), 'differences': [], 'reference': 0.0, 'parser': 0.0, 'cached': 0.0}
+  for format in formats:
+    for parse, key in (lambda c, f: reference_analyze(mediasorter, match_torrent, c, f), 'reference'), \
+        (mediasorter.analyze_video_file, 'parser'), (mediasorter.analyze_video_file, 'cached'):
+      # Not reading the db, only what this run parsed is cached
+      mediasorter.Sorter(mediasorter.Config(os.path.join(top, 'media'), db=os.path.join(top, 'api.db'),
+        format=format, parse_cache=4096 if key=='cached' else 0, full_rescan=True, unfinished_torrents=[])).use()
+      for cache in mediasorter.parse_cache+mediasorter.clean_cache:
+        cache.clear()
+      results = []
+      started = time.time()
+      for components, file in names:
+        try:
+          results.append(parse(components, file))
+        except KeyError as e: # Both fail on extensions without a video type, e.g. .VOB
+          results.append(('KeyError', str(e)))
+      result[key] += time.time()-started
+      if key=='reference':
+        expected = results
+        continue
+      result['differences'].extend([{'name': os.path.join(*(c+[f])), 'format': format, 'reference': e, key: r}
+        for (c, f), e, r in zip(names, expected, results) if e!=r][:10])
+  del mediasorter.parse_cache_new[:]
+  for key in 'reference', 'parser', 'cached':
+    result[key] = result[key]/max(1, result['names'])*1e6
+  return result
+#####################################################
+
+###### RUNNING ###############################################
+
+def fake_ssh(top):
+  # A bin dir with an ssh that runs the remote command in a local shell
+  bin_dir = os.path.join(top, 'bin')
+  makedirs(bin_dir)
+  ssh = os.path.join(bin_dir, 'ssh')
+  with open(ssh, 'w') as f:
+    f.write('#!/bin/sh\nshift\nexec sh -c "$*"\n')
+  os.chmod(ssh, 0755)
+  return bin_dir
+
+def run_sorter(top, python, env, options=[]):
+  """Runs mediasorter.py over the library in top without executing anything, returns the phase
+  timings it wrote with its counters and the wall time added"""
+  profile_path = os.path.join(top, 'profile.json')
+  cmd = [python, mediasorter_path, os.path.join(top, 'media'), '-i', os.path.join(top, 'downloads'),
+    '-b', '-t', os.path.join(top, 'downloading.txt'), '--db', os.path.join(top, 'state.db'),
+    '--profile', profile_path]+options
+  started = time.time()
+  with open(os.devnull, 'w') as devnull:
+    p = subprocess.Popen(cmd, stdout=devnull, stderr=subprocess.PIPE, env=env)
+    errors = p.communicate()[1]
+  wall = time.time()-started
+  if p.returncode!=0:
+    raise Exception("%s failed with %d:\n%s" % (' '.join(cmd), p.returncode, errors))
+  with open(profile_path) as f:
+    profile = json.load(f)
+  result = profile['phases']
+  result['counters'] = profile['counters']
+  result['wall'] = wall
+  return result
+
+def plan_in_process(top):
+  """Plans the sort of the library in top with a fresh state db through the API, returns how long
+  importing mediasorter and planning took"""
+  started = time.time()
+  import mediasorter
+  imported = time.time()-started
+  stdout = sys.stdout
+  sys.stdout = open(os.devnull, 'w') # It prints what it plans
+  try:
+    started = time.time()
+    config = mediasorter.Config(os.path.join(top, 'media'), db=os.path.join(top, 'api.db'), unfinished_torrents=[])
+    planned = mediasorter.Sorter(config).plan()
+    seconds = time.time()-started
+  finally:
+    sys.stdout.close()
+    sys.stdout = stdout
+  return {'import': imported, 'plan': seconds, 'commands': len(planned)}
+
+def benchmark(roots, args):
+  top = tempfile.mkdtemp(prefix='mediasorter-bench-')
+  try:
+    env = dict(os.environ)
+    env['PATH'] = fake_ssh(top)+os.pathsep+env.get('PATH', '')
+    started = time.time()
+    files = generate(top, roots, args.seed)
+    result = {'roots': roots, 'files': files, 'generate': time.time()-started}
+    result['cold'] = run_sorter(top, args.python, env)
+    result['warm'] = run_sorter(top, args.python, env)
+    if args.scan_agent:
+      result['agent'] = run_sorter(top, args.python, env, ['--scan-agent'])
+    result['api'] = plan_in_process(top)
+    if args.parser:
+      result['parser'] = compare_parsers(top, parser_formats)
+      print >>sys.stderr, ("%(names)d names parsed, %(differences)d differences: reference %(reference).0fus,"+
+        " parser %(parser).0fus, with its caches %(cached).0fus per name") % dict(result['parser'],
+        differences=len(result['parser']['differences']))
+    print >>sys.stderr, "%d roots, %d files: cold %.2fs, warm %.2fs" % (roots, files,
+      result['cold']['wall'], result['warm']['wall'])
+    return result
+  finally:
+    if args.keep:
+      print >>sys.stderr, "Library kept in %s" % top
+    else:
+      shutil.rmtree(top)
+#####################################################
+
+###### REGRESSION CHECKS ###############################################
+## Each check makes a small library in top, sorts it with sort_library() and returns None if it
+## was sorted as it should, otherwise what went wrong. Every check is run with each engine
+
+check_engines = [[], ['--engine', 'shell'], ['--engine', 'shell', '-j', '2'], ['--engine', 'script'], ['-j', '4'], ['--scan-jobs', '2']]
+check_timeout = 60
+
+def sort_library(top, python, options=[]):
+  """Sorts the media dir in top with mediasorter.py, executing. Returns (retcode, output), with
+  retcode None if it had not finished after check_timeout seconds"""
+  import threading
+  env = dict(os.environ)
+  env['PATH'] = fake_ssh(top)+os.pathsep+env.get('PATH', '')
+  touch(os.path.join(top, 'downloading.txt'))
+  cmd = [python, mediasorter_path, os.path.join(top, 'media'), '-x', '-b', '-t',
+    os.path.join(top, 'downloading.txt'), '--db', os.path.join(top, 'state.db')]+options
+  p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env, cwd=top)
+  timer = threading.Timer(check_timeout, p.kill)
+  timer.start()
+  try:
+    output = p.communicate()[0]
+  finally:
+    timer.cancel()
+  return (p.returncode if p.returncode>=0 else None), output
+
+def files_in(top):
+  return sorted(os.path.relpath(os.path.join(root, f), top) for root, dirs, files in os.walk(top) for f in files)
+
+def sorted_as_expected(top, retcode, output, videos):
+  # Common expectations: it finished without errors and each of the videos is in one place
+  if retcode is None:
+    return "did not finish in %ds" % check_timeout
+  if retcode!=0 or 'Traceback' in output:
+    return "failed with %s:\n%s" % (retcode, output[-2000:])
+  found = [os.path.basename(f) for f in files_in(os.path.join(top, 'media'))]
+  for video in videos:
+    if found.count(video)!=1:
+      return "%s found %d times after the sort:\n%s" % (video, found.count(video), output[-2000:])
+  return None
+
+def check_same_title_metadata(top, python, options):
+  # Two roots sorted to the same title dir, both making a metadata dir that is moved with them
+  videos = ['king.1995.bluray.swe-fxg.mp4', 'king.1995.ac3.ws.x264.vodrip-grp.mp4']
+  for d, files in [('Divx/King.1995.BluRay.SWE-FXG', [videos[0], 'Sample/sample-'+videos[0]]),
+      ('King.1995.AC3.WS.x264.VODRip-GRP', [videos[1], 'King.1995.AC3.WS.x264.VODRip-GRP.nfo'])]:
+    for f in files:
+      makedirs(os.path.dirname(os.path.join(top, 'media', d, f)))
+      touch(os.path.join(top, 'media', d, f))
+  retcode, output = sort_library(top, python, options)
+  if 'not empty' in output:
+    return "a move failed:\n%s" % output[-2000:]
+  return sorted_as_expected(top, retcode, output, videos)
+
+def check_quote_in_name(top, python, options):
+  # A double quote in a name, which unbalances the quoting of the shell commands
+  video = 'Some "Movie" 2001.avi'
+  makedirs(os.path.join(top, 'media', 'Some Movie 2001'))
+  touch(os.path.join(top, 'media', 'Some Movie 2001', video))
+  retcode, output = sort_library(top, python, options)
+  return sorted_as_expected(top, retcode, output, [video])
+
+checks = [check_same_title_metadata, check_quote_in_name]
+
+def run_checks(args):
+  """Runs every check with each engine, returns the failures as a list of dicts"""
+  failures = []
+  for check in checks:
+    for options in check_engines:
+      top = tempfile.mkdtemp(prefix='mediasorter-check-')
+      try:
+        problem = check(top, args.python, options)
+      finally:
+        shutil.rmtree(top)
+      print >>sys.stderr, "%s %s: %s" % (check.__name__, ' '.join(options) or 'default', 'FAILED' if problem else 'ok')
+      if problem:
+        failures.append({'check': check.__name__, 'options': options, 'problem': problem})
+  return failures
+#####################################################
+
+if __name__=='__main__':
+  args = parser.parse_args()
+  if args.check:
+    failures = run_checks(args)
+    json.dump({'python': args.python, 'failures': failures}, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+    sys.exit(1 if failures else 0)
+  results = {
+    'python': args.python,
+    'seed': args.seed,
+    'runs': [benchmark(int(size), args) for size in args.sizes.split(',')],
+  }
+  out = open(args.output, 'w') if args.output else sys.stdout
+  json.dump(results, out, indent=2, sort_keys=True)
+  out.write('\n')
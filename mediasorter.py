@@ -1,8 +1,11 @@
 #!/usr/bin/env python 
 
-import os, re, subprocess, fnmatch, shlex, time, argparse, string
+import os, sys, stat, re, fnmatch, time, string, atexit, glob, copy
+import thread, hashlib, select, struct, marshal, bisect, mmap
 from datetime import datetime,timedelta
 from string import Template
+# argparse, subprocess, shlex, pipes, shutil, json, threading, sqlite3, ctypes and scandir are
+# imported where they are first needed, they are slow to import and not needed to parse names
 
 # Script overview
 
@@ -125,37 +128,95 @@ default_deletefiles = ['*fastresume','*.sfv', '._*', 'Thumbs.db']
 default_keepfiles = ['*.bup','*.ifo', '.ds_store'] # Should be lowercase
 default_format = '$filetype/$title ($year)/$filename'
 
-parser = argparse.ArgumentParser(description="Sort your media library", version=0.2, 
-  formatter_class=argparse.RawDescriptionHelpFormatter,
-  epilog='Format keys:\n'+'\n'.join(format_keys.values()))
-parser.add_argument('media_dir',
-  help='the directory to sort')
-
-parser.add_argument('-f','--format', default=default_format,
-  help='the desired format of directories and file names')
-parser.add_argument('-i','--import', metavar='DIR', dest='import_dirs', action='append',
-  help='a directory to import media from before sorting (repeatable option)')
-parser.add_argument('-n', '--noimport', metavar='*', action='append', default=default_noimport,
-  help='absolute paths or file/directory patterns to exclude from import'+
-    ' e.g. "/some/path" or "*.mkv" or "apps/" (repeatable option)')
-parser.add_argument('-t', '--unfinished_torrents', metavar='FILE', action='append', default=default_unfinished_torrents,
-  help='paths to files listing torrent files or dirs that are currently downloading and should be excluded (repeatable option)')
-parser.add_argument('-e', '--exclude', metavar='*', action='append', default=default_exclude,
-  help='absolute paths or file/directory patterns to exclude from sorting'+
-    ' e.g. "/some/path" or "*.mkv" or "apps/" (repeatable option)')
-parser.add_argument('-x', '--execute', default=False, action='store_true',
-  help='executes file operations instead of just showing them - TAKE CARE AND REVIEW FIRST')
-parser.add_argument('-b', '--batch', default=False, action='store_true',
-  help='do NOT prompt for each file operation (e.g. for automated execution)')
-parser.add_argument('--subs', default=default_subs,
-  help='two letter code for subtitle languages to look for, e.g. "en"')
-parser.add_argument('--keepfiles', default=default_keepfiles,
-  help='file matching patterns (e.g. "*.ext") for files to always keep together with mediafiles')
-parser.add_argument('--deletefiles', default=default_deletefiles,
-  help='file matching patterns (e.g. "*.ext") for files to always keep DELETE')
-
-args = parser.parse_args()
-print args
+def make_parser():
+  # Defaults are copied, as appending options add to them
+  import argparse
+  parser = argparse.ArgumentParser(description="Sort your media library", version=0.2, 
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+    epilog='Format keys:\n'+'\n'.join(format_keys.values()))
+  parser.add_argument('media_dir',
+    help='the directory to sort')
+
+  parser.add_argument('-f','--format', default=default_format,
+    help='the desired format of directories and file names')
+  parser.add_argument('-i','--import', metavar='DIR', dest='import_dirs', action='append',
+    help='a directory to import media from before sorting (repeatable option)')
+  parser.add_argument('-n', '--noimport', metavar='*', action='append', default=list(default_noimport),
+    help='absolute paths or file/directory patterns to exclude from import'+
+      ' e.g. "/some/path" or "*.mkv" or "apps/" (repeatable option)')
+  parser.add_argument('-t', '--unfinished_torrents', metavar='FILE', action='append', default=list(default_unfinished_torrents),
+    help='paths to files listing torrent files or dirs that are currently downloading and should be excluded (repeatable option)')
+  parser.add_argument('-e', '--exclude', metavar='*', action='append', default=list(default_exclude),
+    help='absolute paths or file/directory patterns to exclude from sorting'+
+      ' e.g. "/some/path" or "*.mkv" or "apps/" (repeatable option)')
+  parser.add_argument('-x', '--execute', default=False, action='store_true',
+    help='executes file operations instead of just showing them - TAKE CARE AND REVIEW FIRST')
+  parser.add_argument('-b', '--batch', default=False, action='store_true',
+    help='do NOT prompt for each file operation (e.g. for automated execution)')
+  parser.add_argument('--subs', default=default_subs,
+    help='two letter code for subtitle languages to look for, e.g. "en"')
+  parser.add_argument('--subs-jobs', metavar='N', default=4, type=int,
+    help='number of subtitle searches to run at the same time while sorting goes on (default 4)')
+  parser.add_argument('--subs-retry', metavar='DAYS', default=7.0, type=float,
+    help='search again for subtitles that were not found this many days ago (default 7)')
+  parser.add_argument('--unrar-jobs', metavar='N', default=2, type=int,
+    help='number of RAR archives with media in them to extract at the same time while sorting goes on (default 2)')
+  parser.add_argument('--duplicates', default='skip', choices=['skip', 'link', 'import'],
+    help='what to do with a download that is in the media dir already with the same contents: leave it'+
+      ' where it is (skip), replace its files with hard links to those in the media dir to free the space'+
+      ' (link), or import it again as copy_NAME without comparing (import) (default skip)')
+  parser.add_argument('--keepfiles', default=list(default_keepfiles),
+    help='file matching patterns (e.g. "*.ext") for files to always keep together with mediafiles')
+  parser.add_argument('--deletefiles', default=list(default_deletefiles),
+    help='file matching patterns (e.g. "*.ext") for files to always keep DELETE')
+  parser.add_argument('--engine', default='python', choices=['python', 'shell', 'script'],
+    help='run moves, deletes and mkdirs in-process (python), as mv/rm/mkdir commands (shell) or'+
+      ' as one shell script sent to the NAS in a single round trip (script)')
+  parser.add_argument('--db', metavar='FILE',
+    help='SQLite file keeping state between runs, such as the scan index (default MEDIA_DIR/.mediasorter.db)')
+  parser.add_argument('--full-rescan', default=False, action='store_true',
+    help='look through all media dirs, also those that have not changed since they were last found sorted,'+
+      ' and parse all names again')
+  parser.add_argument('--parse-cache', metavar='SIZE', default=4096, type=int,
+    help='number of parsed names to keep in memory, 0 to parse every name every time (default 4096)')
+  parser.add_argument('--scan-jobs', metavar='N', default=1, type=int,
+    help='number of processes to walk and plan the dirs in the media dir with, each dir directly in it'+
+      ' in one process, 1 to do everything in this process (default 1)')
+  parser.add_argument('--scan-agent', default=False, action='store_true',
+    help='walk the dir being sorted on the NAS, with a script sent through the SSH session, instead of'+
+      ' listing every dir and stat:ing every file through the mount')
+  parser.add_argument('-w', '--watch', default=False, action='store_true',
+    help='keep running and handle new or changed files in the import and media dirs as they appear')
+  parser.add_argument('--watch-delay', metavar='SECONDS', default=3.0, type=float,
+    help='in watch mode, wait until nothing has changed for this long before handling changes (default 3)')
+  parser.add_argument('--plan-out', metavar='FILE',
+    help='write the commands to run, with fingerprints of the paths they touch, to FILE as JSON')
+  parser.add_argument('--apply', metavar='FILE',
+    help='run the commands of a plan written by --plan-out instead of sorting, except those whose'+
+      ' paths have changed since')
+  parser.add_argument('--undo', metavar='RUN_ID',
+    help='undo the file operations of an earlier run, by the id it printed when it started, instead of sorting')
+  parser.add_argument('--timings', metavar='FILE',
+    help='write how many seconds the import, the sort walk, parsing and planning took to FILE as JSON')
+  parser.add_argument('--profile', metavar='FILE',
+    help='write the phase times, counts of stats, dir listings, regex searches, names parsed,'+
+      ' subprocesses, renames and bytes copied and hashed, and how long commands took, to FILE as JSON')
+  parser.add_argument('--prometheus', metavar='FILE',
+    help='write the same as --profile to FILE in the Prometheus text format, e.g. for the'+
+      ' node_exporter textfile collector')
+  parser.add_argument('--recent-weeks', metavar='N', default=4.0, type=float,
+    help='keep a symlink to each title added in the last N weeks in MEDIA_DIR/_Recent, 0 to not keep'+
+      ' one (default 4)')
+  parser.add_argument('--no-optimize', dest='optimize', default=True, action='store_false',
+    help='run the commands as queued, instead of first dropping those not needed and joining moves'+
+      ' that can be done as one')
+  parser.add_argument('-j', '--jobs', default=1, type=int,
+    help='number of file operations to run at the same time per target volume when executing,'+
+      ' operations on the same paths still run in order (default 1)')
+  return parser
+#####################################################
+
+args = None # The configuration in use, set by configure()
 
 ###### CONFIG ###############################################
 ## Detailed configuration not accessible through command line
@@ -163,11 +224,8 @@ print args
 #TODO
 
 # Musa the warrior__korean --> korean not put as language, same for Juno (2007) English
-# Keep SSH stream open
 # Seij gakuen has unicode that is unclear if it work
-# 3 Idiots RAR file not unpacked, incorrectly sent to metadata
 # Unpack RAR, confirm ok, delete RAR, give option
-# Save original paths to restore file
 # Add to iTunes after import
 # Empty metadatafolders will not be removed currently
 # If there are subs in Subs-folder or any other subfolder, it would not be used and would instead 
@@ -203,7 +261,12 @@ find_subtitles =  ['mkv','divx','avi','mp4','m4v'] # file extensions of files to
 # The SSH destination needs to be pre-authenticated, see http://linuxproblem.org/art_9.html
 ssh_string = "ssh admin@192.168.0.50"
 remote_path_replace = ("/Volumes","/share")
+# All remote commands are written to one long-lived shell started with this command, instead of
+# doing one SSH handshake per command. Can be set to just "sh" to run the same commands locally
+ssh_session_cmd = ssh_string+" sh"
 ssh_process = None
+ssh_marker = None # Printed with exit code after each command, unique per session
+ssh_lock = thread.allocate_lock() # Commands from parallel workers take turns in the session
 
 commands = {
   'move': {'cmd': 'mv', 'name': 'Move', 'remote':True},
@@ -211,53 +274,67 @@ commands = {
   'delete_dir': {'cmd': 'rm -R', 'name': 'Delete dir'},
   'make_dir': {'cmd': 'mkdir', 'name': 'Make dir'},
   'make_path': {'cmd': 'mkdir -p', 'name': 'Make whole path'},
-  'search_subs': {'cmd': 'periscope -l '+args.subs, 'name': 'Search for subtitles'},
+  'search_subs': {'cmd': 'periscope -l', 'name': 'Search for subtitles'}, # Languages added by configure()
   'output': {'cmd': 'cat', 'name': 'Search for subtitles', 'remote':True},
-  'list_rar': {'cmd': 'unrar lb', 'name': 'List contents of RAR'},
-  'unrar': {'cmd': 'unrar e -o-', 'name': 'UnRAR'},
+  'unrar': {'cmd': 'unrar e -o- -p-', 'name': 'UnRAR'},
 }
 
+# 'op' names the in-process implementation in file_ops used instead of the shell command
 move_cmd = {
     'cmd':    ssh_string+' "'+'mv%s"',
     'path':   ' \\"%s\\"',
     'replace':remote_path_replace,
+    'op':     'move',
     'name': 'Move'}
 rmdir_cmd = {
     'cmd':    ssh_string+' "'+'rm -R%s"',
     'path':   ' \\"%s\\"',
     'replace':remote_path_replace,
+    'op':     'delete_dir',
     'name': 'Remove dir'}
 rm_cmd = {
     'cmd':    'rm%s',
     'path':   ' "%s"',
+    'op':     'delete',
     'name': 'Remove'}
 mkdir_cmd = {
     'cmd':    'mkdir%s',
     'path':   ' "%s"',
+    'op':     'make_dir',
     'name': 'Make dir'}
 mkdir_rec_cmd = {
     'cmd':    'mkdir -p%s',
     'path':   ' "%s"',
+    'op':     'make_path',
     'name': 'Make whole path'}
+rmdir_empty_cmd = {
+    'cmd':    'rmdir%s', # Only used to undo, when a dir made by a run is empty again
+    'path':   ' "%s"',
+    'op':     'remove_dir',
+    'name': 'Remove empty dir'}
+link_cmd = {
+    'cmd':    'ln -f%s', # Replace the last path with a hard link to the first
+    'path':   ' "%s"',
+    'op':     'link',
+    'name': 'Hard link'}
+symlink_cmd = {
+    'cmd':    'ln -s%s', # Link the last path to the first, relative to where the link is
+    'path':   ' "%s"',
+    'op':     'symlink',
+    'name': 'Link'}
 periscope_cmd = {
-    'cmd':    'periscope -l '+args.subs+'%s',
+    'cmd':    None, # Set by configure() with the languages to look for
     'path':   ' "%s"',
     'name': 'Look for subs to'}
 output_cmd = {
     'cmd':    ssh_string+' "'+'cat%s"',
     'path':   ' \\"%s\\"',
     'name': 'Display '}
-rarlist_cmd = {
-    'cmd':    'unrar lb%s', #lb means list bare, only file names
-    'path':   ' "%s"',
-    'name': 'List in RAR'}
 unrar_cmd = {
-    'cmd':    'unrar e -o-%s', #extract, do NOT overwrite
+    'cmd':    'unrar e -o- -p-%s', #extract, do NOT overwrite, do not ask for passwords
     'path':   ' "%s" ',
     'name': 'UnRAR'}
-global cmds, cmds_history, reverse_cmds, created_paths
 created_paths = set()
-reverse_cmds = dict()
 
 def human_friendly_cmd(cmd, *paths):
   if len(paths)>1:
@@ -273,31 +350,49 @@ def human_friendly_cmd(cmd, *paths):
   else:
     return '%s "%s"' % (cmd['name'], '" --> "'.join(print_paths))
 
+class Op(object):
+  """A queued command with the paths it runs on. The paths are interned, as the same dirs come
+  back in many commands, and the shell command is only rendered when needed. Unpacks like a
+  (cmd, paths) pair, and two are equal if they would run the same command line"""
+  __slots__ = ('cmd', 'paths')
+
+  def __init__(self, cmd, paths):
+    self.cmd = cmd
+    self.paths = tuple(intern(p) if type(p) is str else p for p in paths)
+
+  def __iter__(self):
+    yield self.cmd
+    yield self.paths
+
+  def __eq__(self, other):
+    return isinstance(other, Op) and self.cmd is other.cmd and self.paths==other.paths
+
+  def __ne__(self, other):
+    return not self==other
+
+  def __hash__(self):
+    return hash((id(self.cmd), self.paths))
+
+  def __repr__(self):
+    return "Op(%s, %r)" % (self.cmd['name'], self.paths)
+
 def queue_cmd(cmd, *paths):
   print human_friendly_cmd(cmd, *paths)
   global cmds
+  cmds.append(Op(cmd, paths))
+
+def render_cmd(cmd, paths):
   paths_merged =""
   for path in paths:
     if('replace' in cmd): #we have a replace component, means we need to replace in path
       path = path.replace(cmd['replace'][0],cmd['replace'][1], 1) # max 1 replacement to ensure we replace beginning of path 
-    paths_merged = paths_merged + (cmd['path'] % path)
-  cmds.append(cmd['cmd'] % paths_merged)
+    if path.endswith(os.path.sep+'*'): # Keep wildcard outside the quotes so the shell expands it
+      paths_merged = paths_merged + (cmd['path'] % path[:-1]) + '*'
+    else:
+      paths_merged = paths_merged + (cmd['path'] % path)
+  return cmd['cmd'] % paths_merged
 #####################################################
 
-def save_reverse_cmd(fromdir, fromfile, todir, tofile):
-  global reverse_cmds
-  frompath = os.path.join(fromdir,fromfile)
-  topath = os.path.join(todir, tofile)
-  print "Reverse '%s' '%s'" % (topath, frompath)
-  # Have current frompath previously been stored, if so update it's "topath" to new
-  # path given but keep original frompath
-  if frompath in reverse_cmds:
-    op,of,np,nf = reverse_cmds[frompath]
-    del reverse_cmds[frompath]
-    reverse_cmds[topath] = (op,of,todir,tofile)
-  else: # Not found, file must be new, but save frompath and topath for later
-    reverse_cmds[topath] = (fromdir,fromfile,todir,tofile)
-    
 def move(fromdir, fromfile, todir, tofile="", all=False):
   global created_paths
   topath = os.path.join(todir, tofile)
@@ -308,214 +403,2014 @@ def move(fromdir, fromfile, todir, tofile="", all=False):
     for f in fromfile:
       frompath = os.path.join(fromdir, f)
       paths.append(frompath)
-      #save_reverse_cmd(fromdir, f, todir, f)
     if all:
       paths = [os.path.join(fromdir, '*')] # actually erase paths and add a wildcard to save time
     paths.append(os.path.join(todir,tofile)) 
   else:
     frompath = os.path.join(fromdir, fromfile)
-    #save_reverse_cmd(fromdir, fromfile, todir, tofile)
     paths = [frompath, topath]
   
-  if todir not in created_paths and not os.path.exists(todir):
+  if todir not in created_paths and not path_exists(todir):
     queue_cmd(mkdir_rec_cmd, todir)
     created_paths.add(todir)
   queue_cmd(move_cmd, *paths)
   
 def init_cmds():
-  global cmds, cmds_history
+  global cmds, cmds_history, planned_paths
   cmds = []
-  cmds_history = set()
+  cmds_history = set() # Ops processed already
+  planned_paths = dict()
 #####################################################
 
-def run_cmd(cmd, execute=False):
-  do_cmd = True
-  if not execute and not args.batch:
-    print "[y/n]? %s" % cmd
-    input = raw_input()
-    if not input.startswith("y"):
-      do_cmd = False
-      print "Ignored!"
+def open_ssh_session():
+  global ssh_process, ssh_marker
+  close_ssh_session()
+  import subprocess, shlex
+  ssh_marker = "__mediasorter_%s__" % os.urandom(8).encode('hex')
+  ssh_process = subprocess.Popen(shlex.split(ssh_session_cmd), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+  count('subprocesses')
+
+def close_ssh_session():
+  global ssh_process
+  if ssh_process:
+    try:
+      ssh_process.stdin.close()
+      ssh_process.wait()
+    except (IOError, OSError):
+      pass
+    ssh_process = None
+atexit.register(close_ssh_session)
+
+def ssh_session_run(remote_cmd):
+  """Run remote_cmd in the shared SSH session and return (output, retcode). A dropped session is
+  reopened before the command is sent. If it drops while the command runs, retcode is 255 like ssh.
+  A command with unbalanced quotes is not sent, retcode is then 2 like a shell's syntax error."""
+  import shlex
+  try:
+    shlex.split(remote_cmd) # Unbalanced quotes would leave the shell waiting for more input forever
+  except ValueError as e:
+    return "%s: %s\n" % (remote_cmd, e), 2
+  with ssh_lock:
+    started = time.time()
+    try:
+      return ssh_session_send(remote_cmd)
+    finally:
+      observe('ssh', started)
+
+def ssh_session_send(remote_cmd):
+  for attempt in range(2):
+    if not ssh_process or ssh_process.poll() is not None:
+      open_ssh_session()
+    try:
+      # Read stdin from /dev/null so the command can't eat the commands that follow it
+      ssh_process.stdin.write("{ %s\n} </dev/null\nprintf '%%s %%d\\n' %s \"$?\"\n" % (remote_cmd, ssh_marker))
+      ssh_process.stdin.flush()
+      break
+    except IOError: # Broken pipe, the command never reached the shell so it is safe to resend
+      close_ssh_session()
+  else:
+    return "", 255
+  output = []
+  while True:
+    line = ssh_process.stdout.readline()
+    if not line: # Session dropped while running, don't know if the command completed
+      close_ssh_session()
+      return ''.join(output), 255
+    i = line.find(ssh_marker)
+    if i>=0:
+      output.append(line[:i]) # Output not ending with newline ends up before the marker
+      return ''.join(output), int(line[i+len(ssh_marker):])
+    output.append(line)
+#####################################################
+
+###### STAT CACHE ###############################################
+## Each listing and stat is a round trip on a network mount, so the walk remembers what it has
+## listed and stat:ed during a run. Paths touched by executed operations are invalidated, which
+## also invalidates everything inside them and the listing of their parent dir.
+
+stat_generation = 0
+stat_cache = dict() # path -> (generation, stat result or None if missing)
+listed_dirs = dict() # dir -> (generation, dict of name -> 'dir', 'link' (to dir) or 'file')
+invalidated = dict() # path -> generation when it and everything in it was last invalidated
+own_changes = set() # Paths our commands changed, while watching, see drain_own_events()
+
+def reset_stat_cache():
+  global stat_generation
+  stat_generation += 1
+  stat_cache.clear()
+  listed_dirs.clear()
+  invalidated.clear()
+
+def invalidate_path(path):
+  global stat_generation
+  stat_generation += 1
+  path = path[:-2] if path.endswith(os.path.sep+'*') else path.rstrip(os.path.sep)
+  invalidated[path] = stat_generation
+  if inotify_fd is not None:
+    own_changes.add(path)
+  parent = os.path.dirname(path)
+  listed_dirs.pop(parent, None)
+  stat_cache.pop(parent, None)
+
+def cache_valid(path, generation):
+  # Not invalidated since generation, neither path nor any parent of it
+  while True:
+    if invalidated.get(path, -1)>generation:
+      return False
+    parent = os.path.dirname(path)
+    if parent==path:
+      return True
+    path = parent
+
+scandir = False # Looked up on first use, None if not available
+
+def find_scandir():
+  global scandir
+  try:
+    from os import scandir
+  except ImportError:
+    try:
+      from scandir import scandir # Backport of os.scandir for Python 2
+    except ImportError:
+      scandir = None
+
+def list_dir(path):
+  """Lists path once per run, returns dict of name -> 'dir', 'link' (to dir) or 'file'"""
+  listing = listed_dirs.get(path)
+  if listing and cache_valid(path, listing[0]):
+    return listing[1]
+  names = dict()
+  count('listdirs')
+  if scandir is False:
+    find_scandir()
+  if scandir: # Entry types come with the listing on most systems, no stat needed
+    for entry in scandir(path):
+      if entry.is_dir():
+        names[entry.name] = 'link' if entry.is_symlink() else 'dir'
+      else:
+        names[entry.name] = 'file'
+  else:
+    for name in os.listdir(path):
+      p = os.path.join(path, name)
+      if counted_isdir(p):
+        names[name] = 'link' if counted_islink(p) else 'dir'
+      else:
+        names[name] = 'file'
+  listed_dirs[path] = (stat_generation, names)
+  return names
+
+def scan_dir(path):
+  # Returns (dirs, files) in path, like one step of os.walk
+  names = list_dir(path)
+  dirs = sorted(n for n, kind in names.iteritems() if kind!='file')
+  files = sorted(n for n, kind in names.iteritems() if kind=='file')
+  return dirs, files
+
+def scan_walk(top):
+  """Same as os.walk(top) going top-down, but using the cached listings"""
+  try:
+    names = list_dir(top)
+  except OSError:
+    return
+  dirs, files = scan_dir(top)
+  yield top, dirs, files
+  for d in dirs:
+    if names.get(d)=='dir': # Like os.walk, do not follow symlinks to dirs
+      for step in scan_walk(os.path.join(top, d)):
+        yield step
+
+## Where the cache can't be used, e.g. by the file operations, which must see what is there now,
+## the calls go through these so --profile counts them all
+
+def counted_stat(path, follow=True):
+  count('stats')
+  return os.stat(path) if follow else os.lstat(path)
+
+def counted_kind(path, follow=True):
+  # stat.S_IFMT of the mode of path, None if it is missing
+  try:
+    return stat.S_IFMT(counted_stat(path, follow).st_mode)
+  except OSError:
+    return None
+
+def counted_isdir(path):
+  return counted_kind(path)==stat.S_IFDIR
+
+def counted_islink(path):
+  return counted_kind(path, False)==stat.S_IFLNK
+
+def counted_lexists(path):
+  return counted_kind(path, False) is not None
+
+def counted_samefile(a, b):
+  return os.path.samestat(counted_stat(a), counted_stat(b))
+
+def counted_listdir(path):
+  count('listdirs')
+  return os.listdir(path)
+
+def cached_stat(path):
+  path = path.rstrip(os.path.sep) or os.path.sep
+  entry = stat_cache.get(path)
+  if entry is None or not cache_valid(path, entry[0]):
+    count('stats')
+    try:
+      st = os.stat(path)
+    except OSError:
+      st = None
+    entry = stat_cache[path] = (stat_generation, st)
+  return entry[1]
+
+def path_kind(path, list_parent=False):
+  # 'dir', 'link', 'file' or None if missing. Answered from the parent's listing if there is one
+  path = path.rstrip(os.path.sep)
+  parent, name = os.path.split(path)
+  listing = listed_dirs.get(parent)
+  if (listing and cache_valid(parent, listing[0])) or (list_parent and parent):
+    try:
+      return list_dir(parent).get(name)
+    except OSError:
+      return None
+  st = cached_stat(path)
+  if st is None:
+    return None
+  return 'dir' if stat.S_ISDIR(st.st_mode) else 'file'
+
+def path_exists(path, list_parent=False):
+  return path_kind(path, list_parent) is not None
+
+def path_isdir(path):
+  return path_kind(path) in ('dir', 'link')
+
+def path_ctime(path):
+  return cached_stat(path).st_ctime
+#####################################################
+
+###### SCAN AGENT ###############################################
+## With --scan-agent the dir being sorted is walked on the NAS itself instead of through the mount,
+## by a small script sent through the SSH session. It prints each dir it lists with the kind, size
+## and times of what is in it, which is put in the stat cache as if it had been listed and stat:ed
+## here. Whatever else is read, and what the executed commands change, goes through the mount
+
+scan_agent_python = "python" # On the NAS, any Python from 2.6 on
+
+# Prints a record per dir, "D" and its path relative to the top, followed by one per entry in it,
+# "kind mode dev inode size mtime ctime name" with kind d, l (link to a dir) or f. Records end
+# with a NUL, as names can have newlines. Dirs named in the arguments after the top are not walked
+scan_agent_source = r'''
+import os, sys, stat
+out = getattr(sys.stdout, "buffer", sys.stdout)
+fsencode = getattr(os, "fsencode", lambda p: p)
+top = fsencode(sys.argv[1])
+exclude = set(fsencode(a) for a in sys.argv[2:])
+def walk(rel):
+    path = os.path.join(top, rel) if rel else top
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return
+    out.write(b"D" + rel + b"\0")
+    dirs = []
+    for name in names:
+        p = os.path.join(path, name)
+        try:
+            st = os.lstat(p)
+        except OSError:
+            continue
+        kind = b"f"
+        if stat.S_ISLNK(st.st_mode):
+            try:
+                st = os.stat(p)
+                kind = b"l" if stat.S_ISDIR(st.st_mode) else b"f"
+            except OSError:
+                pass
+        elif stat.S_ISDIR(st.st_mode):
+            kind = b"d"
+            if name not in exclude:
+                dirs.append(os.path.join(rel, name) if rel else name)
+        out.write(kind + (" %d %d %d %d %r %r " % (st.st_mode, st.st_dev, st.st_ino, st.st_size,
+            st.st_mtime, st.st_ctime)).encode("ascii") + name + b"\0")
+    for d in sorted(dirs):
+        walk(d)
+walk(b"")
+'''
+scan_agent_kinds = {'d': 'dir', 'l': 'link', 'f': 'file'}
+
+def scan_agent_walk(top):
+  """Lists top and the dirs in it on the NAS and puts what was found in the stat cache. Returns
+  False if the agent failed, the walk then lists and stats through the mount as usual"""
+  import pipes
+  started = time.time()
+  output, retcode = ssh_session_run(' '.join([scan_agent_python, '-c', pipes.quote(scan_agent_source),
+    pipes.quote(remote_path(top))]+[pipes.quote(d) for d in sorted(excluded)]))
+  if retcode!=0 or not output.startswith('D'):
+    print "WARNING, scan agent failed with code %s, walking %s through the mount" % (retcode, top)
+    return False
+  entries = 0
+  for record in output.split('\0')[:-1]:
+    if record.startswith('D'):
+      path = os.path.join(top, record[1:]) if len(record)>1 else top
+      names = dict()
+      listed_dirs[path] = (stat_generation, names)
+      continue
+    kind, mode, dev, ino, size, mtime, ctime, name = record.split(' ', 7)
+    names[name] = scan_agent_kinds[kind]
+    stat_cache[os.path.join(path, name)] = (stat_generation, os.stat_result((int(mode), int(ino), int(dev),
+      1, 0, 0, int(size), float(mtime), float(mtime), float(ctime))))
+    entries += 1
+  count('agent_entries', entries)
+  add_time('walk', started)
+  return True
+#####################################################
+
+###### DESTINATIONS ###############################################
+## Where the queued moves put things, so that two roots or imports are never moved to the same
+## path. Together with the cached listings this tells what is or will be at a path without a stat
+
+planned_paths = dict() # Path -> root or import moved there by a queued command
+
+def move_targets(paths, names_in=list_dir):
+  # Where what a move command moves ends up, with a wildcard expanded to names_in(dir)
+  if len(paths)==2 and not paths[-1].endswith(os.path.sep):
+    return [paths[-1]]
+  names = []
+  for p in paths[:-1]:
+    if p.endswith(os.path.sep+'*'):
+      names.extend(sorted(names_in(p[:-2])))
+    else:
+      names.append(os.path.basename(p))
+  return [os.path.join(paths[-1], name) for name in names]
+
+def moved_to(queued):
+  """Where the queued moves put things. A wildcard is expanded to what will be in the dir when the
+  move runs: what is in it now, with what the commands before it make or move there, or move away
+  or delete from there, e.g. the metadata dir a root makes before moving all it holds"""
+  changes = dict() # dir -> (names made there, names gone from there)
+  def names_in(dir):
+    made, gone = changes.get(dir, ((), ()))
+    return set(list_dir(dir)).union(made).difference(gone)
+  def change(path, made):
+    dir, name = os.path.split(path.rstrip(os.path.sep))
+    entry = changes.setdefault(dir, (set(), set()))
+    entry[not made].add(name)
+    entry[made].discard(name)
+  targets = []
+  for cmd, paths in queued:
+    if cmd is move_cmd:
+      moved = move_targets(paths, names_in)
+      for p in paths[:-1]:
+        if p.endswith(os.path.sep+'*'):
+          for name in names_in(p[:-2]):
+            change(os.path.join(p[:-2], name), False)
+        else:
+          change(p, False)
+      for t in moved:
+        change(t, True)
+      targets.extend(moved)
+    elif cmd is mkdir_cmd or cmd is mkdir_rec_cmd:
+      for p in [paths[0].rstrip(os.path.sep)]+parent_dirs(paths[0].rstrip(os.path.sep))[:-1]:
+        change(p, True)
+    elif cmd is rm_cmd:
+      for p in paths:
+        change(p, False)
+  return targets
+
+def path_listed(path):
+  # Like path_exists(path, list_parent=True), but a parent that isn't there is not tried listed
+  return path_isdir(os.path.dirname(path)) and path_exists(path, list_parent=True)
+
+def path_taken(path):
+  # Something is at path, or a queued move will put something there
+  return path in planned_paths or path_listed(path)
+
+def claim_paths(root, paths, existing=True):
+  """Adds the paths root moves things to to the index. Unless something is at one of them already,
+  or another root moves something there, then returns a warning saying so instead"""
+  for path in paths:
+    by = planned_paths.get(path, root)
+    if by!=root:
+      return "WARNING, %s is moved to by %s already, leaving %s as it is" % (path, by, root)
+    if existing and path not in planned_paths and path_listed(path):
+      return "WARNING, %s exists already, leaving %s as it is" % (path, root)
+  for path in paths:
+    planned_paths[path] = root
+  return None
+
+def unqueue(queued_before):
+  # Drops the commands queued since there were queued_before
+  for cmd, paths in cmds[queued_before:]:
+    if cmd is mkdir_rec_cmd:
+      created_paths.discard(paths[0])
+  del cmds[queued_before:]
+#####################################################
+
+###### FILE OPERATIONS ###############################################
+## In-process versions of the mv, rm and mkdir commands, to avoid one fork+exec per operation.
+## They return (output, retcode) just like a command run by run_cmd.
+
+copy_chunk_size = 1024*1024
+
+def remote_path(path):
+  return path.replace(remote_path_replace[0], remote_path_replace[1], 1)
+
+def is_remote_path(path):
+  return path.startswith(remote_path_replace[0]+os.path.sep)
+
+def path_dev(path):
+  # Device of path, or of its closest existing parent if it has not been created yet
+  while True:
+    try:
+      return counted_stat(path).st_dev
+    except OSError:
+      parent = os.path.dirname(path)
+      if parent==path:
+        raise
+      path = parent
+
+def copy_move(frompath, topath):
+  # Only used when a move crosses devices and can't be done as a rename
+  import shutil
+  if counted_islink(frompath):
+    os.symlink(os.readlink(frompath), topath)
+    os.unlink(frompath)
+  elif counted_isdir(frompath):
+    os.mkdir(topath)
+    for name in counted_listdir(frompath):
+      copy_move(os.path.join(frompath, name), os.path.join(topath, name))
+    shutil.copystat(frompath, topath)
+    os.rmdir(frompath)
+  else:
+    with open(frompath, 'rb') as fsrc, open(topath, 'wb') as fdst:
+      while True:
+        buf = fsrc.read(copy_chunk_size)
+        if not buf:
+          break
+        fdst.write(buf)
+        count('bytes_copied', len(buf))
+    shutil.copystat(frompath, topath)
+    os.unlink(frompath)
+
+def op_move(*paths):
+  frompaths = []
+  for path in paths[:-1]:
+    if path.endswith(os.path.sep+'*'): # Wildcard means all files left in that dir
+      d = path[:-2]
+      frompaths.extend(os.path.join(d, f) for f in sorted(counted_listdir(d)))
+    else:
+      frompaths.append(path)
+  target = paths[-1]
+  to_dir = counted_isdir(target)
+  if (len(frompaths)>1 or target.endswith(os.path.sep)) and not to_dir:
+    raise OSError("Target %s is not a directory" % target)
+  for frompath in frompaths:
+    # Like mv, moving to an existing directory puts the source inside it
+    topath = os.path.join(target, os.path.basename(frompath.rstrip(os.path.sep))) if to_dir else target.rstrip(os.path.sep)
+    if path_dev(frompath)==path_dev(os.path.dirname(topath)):
+      os.rename(frompath, topath)
+      count('renames')
+    elif is_remote_path(frompath) and is_remote_path(topath):
+      # Different volumes on the NAS, copying through the mount would send all data over the network twice
+      import pipes
+      output, retcode = ssh_session_run('mv %s %s' % (pipes.quote(remote_path(frompath)), pipes.quote(remote_path(topath))))
+      if retcode!=0:
+        raise OSError("Remote move of %s failed with code %s" % (frompath, retcode))
+    else:
+      copy_move(frompath, topath)
+
+def op_delete(*paths):
+  for path in paths:
+    os.remove(path)
+
+def op_delete_dir(*paths):
+  import shutil
+  for path in paths:
+    if counted_isdir(path) and not counted_islink(path):
+      shutil.rmtree(path)
+    else:
+      os.remove(path)
+
+def op_make_dir(*paths):
+  for path in paths:
+    os.mkdir(path)
+
+def op_remove_dir(*paths):
+  for path in paths:
+    os.rmdir(path)
+
+def op_make_path(*paths):
+  for path in paths:
+    if not counted_isdir(path):
+      os.makedirs(path)
+
+def op_link(*paths):
+  # Linked next to it and renamed over it, so the file is never missing
+  tmp = paths[-1]+'.mediasorter-link'
+  os.link(paths[0], tmp)
+  os.rename(tmp, paths[-1])
+
+def relative_link(paths):
+  # The paths of a symlink command as ln -s is given them, the target relative to the link
+  target, link = paths
+  return os.path.relpath(target, os.path.dirname(link)), link
+
+def op_symlink(*paths):
+  os.symlink(*relative_link(paths))
+
+file_ops = {
+  'move':       op_move,
+  'delete':     op_delete,
+  'delete_dir': op_delete_dir,
+  'make_dir':   op_make_dir,
+  'make_path':  op_make_path,
+  'remove_dir': op_remove_dir,
+  'link':       op_link,
+  'symlink':    op_symlink,
+}
+
+def run_file_op(cmd, paths):
+  try:
+    file_ops[cmd['op']](*paths)
+  except (OSError, IOError) as e:
+    return "", 1, "%s failed: %s\n" % (human_friendly_cmd(cmd, *paths), e)
+  return "", 0, ""
+#####################################################
+
+def exec_cmd(queued):
+  """Runs a queued command without asking, returns (output, retcode, errors)"""
+  cmd, paths = queued
+  started = time.time()
+  try:
+    return exec_queued(cmd, paths)
+  finally:
+    observe(cmd_kind(cmd), started)
+
+def cmd_kind(cmd):
+  # What a command is counted as: its file operation, or the program it runs
+  if 'op' in cmd:
+    return cmd['op']
+  cmdline = cmd['cmd'].replace('%s', '')
+  if cmdline.startswith(ssh_string):
+    cmdline = cmdline[len(ssh_string):]
+  return cmdline.strip(' "').split()[0]
+
+def exec_queued(cmd, paths):
+  import subprocess, shlex
+  if args.engine=='python' and 'op' in cmd:
+    return run_file_op(cmd, paths)
+  if cmd is symlink_cmd:
+    paths = relative_link(paths)
+  cmdline = render_cmd(cmd, paths)
+  try:
+    if cmdline.startswith(ssh_string):
+      # ssh joins its remaining arguments into the remote command line, do the same
+      output, retcode = ssh_session_run(' '.join(shlex.split(cmdline[len(ssh_string):])))
+      return output, retcode, ""
+    argv = shlex.split(cmdline)
+  except ValueError as e: # Quotes in a name can leave the command line unbalanced, as a shell would fail
+    return "", 2, "%s: %s\n" % (cmdline, e)
+  count('subprocesses')
+  try:
+    sub = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  except OSError as e:
+    return "", 127, "%s: %s\n" % (cmdline, e)
+  output, errors = sub.communicate()
+  return output, sub.returncode, errors
+
+def confirm_cmd(queued):
+  print "[y/n]? %s" % render_cmd(*queued)
+  input = raw_input()
+  if not input.startswith("y"):
+    print "Ignored!"
+    return False
+  return True
+
+def run_cmd(queued, execute=False):
+  do_cmd = execute or args.batch or confirm_cmd(queued)
   output = ""
   retcode = -1
   if do_cmd and (args.execute or execute):
-    if cmd['cmd'].startswith(ssh_string):
-      if not ssh_process:
-        ssh_process = subprocess.Popen(shlex.split(ssh_string), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-      ssh_process.stdin.write(
-    else:
-      sub = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE)
-      output = sub.communicate()[0]
-      retcode = sub.returncode
+    output, retcode, errors = exec_cmd(queued)
+    sys.stderr.write(errors)
   return output, retcode
 #####################################################
 
 def pop_cmd(execute=False):
-  cmd = cmds.pop()
-  if cmd in cmds_history:
-    print "Already run before, ignored: %s" % cmd
+  queued = cmds.pop()
+  if queued in cmds_history:
+    print "Already run before, ignored: %s" % render_cmd(*queued)
     output = ""
     retcode = -1
   else:
-    output, retcode = run_cmd(cmd,execute)
+    output, retcode = run_cmd(queued,execute)
     if retcode is not -1: # If return -1 it means the command was not run
-      cmds_history.add(cmd)
+      cmds_history.add(queued)
+      invalidate_cmds([queued])
   return output, retcode
 #####################################################
   
+def invalidate_cmds(queue):
+  # Run (or maybe run) commands have changed the paths they touched
+  for cmd, paths in queue:
+    if 'op' in cmd:
+      for path in paths:
+        invalidate_path(path)
+
+def pending_cmds():
+  # Queued commands that have not been run before
+  queue = []
+  for queued in cmds:
+    if queued in cmds_history:
+      print "Already run before, ignored: %s" % render_cmd(*queued)
+    else:
+      queue.append(queued)
+    cmds_history.add(queued) # Remember that we processed this cmd
+  return queue
+
 def flush_cmds():
-  for cmd in cmds:
-    if cmd in cmds_history:
-      print "Already run before, ignored: %s" % cmd
+  queue = optimize_cmds(pending_cmds())
+  if planned_steps is not None:
+    planned_steps.append(plan_step(queue))
+  try:
+    if args.engine=='script':
+      return flush_cmds_script(queue)
+    if args.execute and args.jobs>1:
+      if not args.batch: # Ask for everything first, then run what was accepted in parallel
+        queue = [queued for queued in queue if confirm_cmd(queued)]
+      journal_plan(queue)
+      return flush_cmds_parallel(queue)
+    journal_plan(queue)
+    for i, queued in enumerate(queue):
+      output, retcode = run_cmd(queued)
+      journal_done(i, retcode)
+  finally:
+    journal_sync()
+    invalidate_cmds(queue)
+#####################################################
+
+def dependency_paths(paths):
+  # Paths an operation touches, with any wildcard meaning the whole dir
+  return set(p[:-2] if p.endswith(os.path.sep+'*') else p.rstrip(os.path.sep) for p in paths)
+
+def parent_dirs(path):
+  # The dirs above path, the closest first, as os.path.dirname would give them one by one
+  dirs = []
+  i = path.rfind(os.path.sep)
+  while i>0:
+    path = path[:i]
+    dirs.append(path)
+    i = path.rfind(os.path.sep)
+  if i==0 and path!=os.path.sep:
+    dirs.append(os.path.sep)
+  return dirs
+
+def cmd_dependencies(queue):
+  """For each queued command, returns the indices of earlier commands it depends on, which are
+  those touching the same path, a parent of it or something inside it"""
+  touched = dict() # path -> indices of commands touching exactly that path
+  below = dict() # path -> indices of commands touching something inside that path
+  deps = []
+  for i, (cmd, paths) in enumerate(queue):
+    d = set()
+    paths = [(path, parent_dirs(path)) for path in dependency_paths(paths)]
+    for path, parents in paths:
+      for found in touched.get(path), below.get(path):
+        if found:
+          d.update(found)
+      for parent in parents:
+        found = touched.get(parent)
+        if found:
+          d.update(found)
+    for path, parents in paths:
+      touched.setdefault(path, []).append(i)
+      for parent in parents:
+        below.setdefault(parent, []).append(i)
+    deps.append(sorted(d))
+  return deps
+#####################################################
+
+###### PLAN OPTIMIZER ###############################################
+## A batch of commands is rewritten into fewer doing the same before it runs: moves ending where
+## they started and dirs made already are dropped, a move of what an earlier move put somewhere is
+## joined with it (see collapse_moves), moves into a dir deleted later become deletes, and moving
+## all that is in a dir to a new dir becomes one rename of the dir. A command is only rewritten
+## when no command in between depends on it, see cmd_dependencies(). Those are worked out once,
+## and the passes after that leave None where they drop a command so the indices still hold
+
+def optimize_cmds(queue):
+  """Returns a queue doing what queue does, with fewer commands if it can"""
+  if not args.optimize or len(queue)<2:
+    return queue
+  optimized = [Op(cmd, paths) for cmd, paths in collapse_moves(drop_noop_moves(queue), move_cmd)]
+  deps = cmd_dependencies(optimized)
+  dependents = [set() for op in optimized]
+  for i, d in enumerate(deps):
+    for j in d:
+      dependents[j].add(i)
+  done_by = dict() # Index of a dropped command -> index of the command doing what it did now
+  delete_moved(optimized, dependents)
+  rewritten = rename_dirs(optimized, dependents, done_by)
+  drop_made_dirs(optimized, deps, done_by, rewritten)
+  optimized = [op for op in optimized if op is not None]
+  if len(optimized)<len(queue):
+    count('ops_optimized', len(queue)-len(optimized))
+    print "Optimized %d commands into %d" % (len(queue), len(optimized))
+    original = set(queue)
+    for cmd, paths in optimized:
+      if Op(cmd, paths) not in original:
+        print "  %s" % human_friendly_cmd(cmd, *paths)
+  return optimized
+
+def drop_noop_moves(queue):
+  # Moves of a path to where it is already, or into the dir it is in
+  kept = []
+  for op in queue:
+    cmd, paths = op
+    if cmd is move_cmd:
+      target = paths[-1].rstrip(os.path.sep)
+      into = not plain_move(paths)
+      sources = [p for p in paths[:-1] if p.rstrip(os.path.sep)!=target and
+        not (into and os.path.dirname(p[:-2] if p.endswith(os.path.sep+'*') else p)==target)]
+      if not sources:
+        continue
+      if len(sources)<len(paths)-1:
+        op = Op(cmd, sources+[paths[-1]])
+    kept.append(op)
+  return kept
+
+def delete_moved(queue, dependents):
+  """Moves into a dir that a later command deletes, when that is the first command depending on
+  them, are made deletes of what they move"""
+  if not any(cmd is rmdir_cmd for cmd, paths in queue):
+    return
+  for i, (cmd, paths) in enumerate(queue):
+    if cmd is not move_cmd or not dependents[i] or any(p.endswith(os.path.sep+'*') for p in paths[:-1]):
+      continue
+    later, deleted = queue[min(dependents[i])]
+    if plain_move(paths):
+      targets = [paths[1]]
+    else:
+      targets = [os.path.join(paths[-1], os.path.basename(p.rstrip(os.path.sep))) for p in paths[:-1]]
+    if later is rmdir_cmd and all(any(t==d or t.startswith(d+os.path.sep) for d in deleted) for t in targets):
+      queue[i] = Op(rmdir_cmd, paths[:-1])
+
+def rename_dirs(queue, dependents, done_by):
+  """A dir made by a make_path command that nothing is put in but all of what is in one other dir,
+  under the same names, is made by renaming that dir instead. Returns the indices of the make_path
+  commands changed to make the dir above it"""
+  found = [] # (make_path index, dir it makes, indices of the moves into it, dir they move from)
+  for i, op in enumerate(queue):
+    if op is None or op.cmd is not mkdir_rec_cmd or len(op.paths)!=1 or not dependents[i]:
+      continue
+    target = op.paths[0].rstrip(os.path.sep)
+    group = dependents[i]
+    source = None
+    names = set()
+    everything = False
+    for k in group:
+      if queue[k] is None or queue[k].cmd is not move_cmd or not dependents[k]<=group:
+        break
+      paths = queue[k].paths
+      into = not plain_move(paths)
+      if into and paths[-1].rstrip(os.path.sep)!=target:
+        break
+      for p in paths[:-1]:
+        if p.endswith(os.path.sep+'*'):
+          d, name = p[:-2], None
+          everything = True
+        else:
+          d, name = os.path.split(p.rstrip(os.path.sep))
+          names.add(name)
+        if source not in (None, d) or (not into and paths[1]!=os.path.join(target, name)):
+          break
+        source = d
+      else:
+        continue
+      break
+    else:
+      if source is None or source==target or target.startswith(source+os.path.sep) or \
+          source.startswith(target+os.path.sep) or source in [args.media_dir]+(args.import_dirs or []):
+        continue
+      try:
+        if everything or names.issuperset(list_dir(source)):
+          found.append((i, target, group, source))
+      except OSError:
+        pass
+  if not found:
+    return set()
+  # Nothing may use the dir after it has been renamed
+  last_use = dict.fromkeys([source for i, target, group, source in found], -1)
+  for k, op in enumerate(queue):
+    if op is not None:
+      for path in dependency_paths(op.paths):
+        for p in [path]+parent_dirs(path):
+          if p in last_use:
+            last_use[p] = k
+  rewritten = set()
+  for i, target, group, source in found:
+    last = max(group)
+    if last_use[source]>last:
+      continue
+    parent = os.path.dirname(target)
+    if path_isdir(parent):
+      queue[i] = None
+      done_by[i] = last
+    else:
+      queue[i] = Op(mkdir_rec_cmd, [parent])
+      rewritten.add(i)
+    for k in group:
+      queue[k] = None
+      done_by[k] = last
+    queue[last] = Op(move_cmd, [source, target])
+  return rewritten
+
+def drop_made_dirs(queue, deps, done_by, rewritten):
+  """Drops make_path commands for dirs made already by an earlier one, also when it made a dir in
+  them. A dir made inside one made by an earlier command is made by that command instead, if
+  nothing in between depends on it. Not done with the rewritten commands, whose dependencies
+  are not those they had when they were worked out"""
+  made = dict() # Dir made by a command, or a dir above it -> index of the command
+  for j, op in enumerate(queue):
+    if op is None:
+      continue
+    cmd, paths = op
+    if cmd is mkdir_rec_cmd:
+      paths = [p.rstrip(os.path.sep) for p in paths]
+      todo = [p for p in paths if p not in made]
+      by = made[paths[0]] if not todo else j
+      if len(todo)==1 and len(paths)==1 and j not in rewritten:
+        parents = [p for p in parent_dirs(todo[0]) if p in made]
+        i = made[parents[0]] if parents else None
+        if i is not None and i not in rewritten and [p.rstrip(os.path.sep) for p in queue[i].paths]==parents[:1] and \
+            all(done_by.get(d, d)<=i for d in deps[j]):
+          queue[i] = Op(cmd, todo)
+          by = i
+      if by!=j:
+        queue[j] = None
+        done_by[j] = by
+      elif len(todo)<len(paths):
+        queue[j] = Op(cmd, todo)
+      for path in todo:
+        for p in [path]+parent_dirs(path):
+          if p in made:
+            break
+          made[p] = by
+    elif cmd is move_cmd or cmd.get('op') in ('delete', 'delete_dir', 'remove_dir'):
+      # Made dirs moved or deleted are not there any more
+      for path in dependency_paths(paths[:-1] if cmd is move_cmd else paths):
+        if path in made:
+          for p in [p for p in made if p==path or p.startswith(path+os.path.sep)]:
+            del made[p]
+#####################################################
+
+script_cmds = {
+  'move':       'mv',
+  'delete':     'rm',
+  'delete_dir': 'rm -R',
+  'make_dir':   'mkdir',
+  'make_path':  'mkdir -p',
+  'remove_dir': 'rmdir',
+  'link':       'ln -f',
+  'symlink':    'ln -s',
+}
+
+def script_line(cmd, paths, remote):
+  import shlex, pipes
+  if 'op' not in cmd: # Not a file operation, use the command as is
+    cmdline = render_cmd(cmd, paths)
+    if cmdline.startswith(ssh_string):
+      return ' '.join(shlex.split(cmdline[len(ssh_string):]))
+    return cmdline
+  if cmd is symlink_cmd:
+    paths = relative_link(paths)
+  quoted = []
+  for path in paths:
+    if remote:
+      path = remote_path(path)
+    if path.endswith(os.path.sep+'*'):
+      quoted.append(pipes.quote(path[:-1])+'*')
     else:
-      run_cmd(cmd)
-    cmds_history.add(cmd) # Remember that we processed this cmd
-#####################################################
-
-init_cmds()
-
-### Make sure we are configured correctly
-if not os.path.isdir(args.media_dir):
-    exit("Media path %s is not a directory or is inaccessible, check volume mounts or give different path" % args.media_dir)
-
-args.media_dir = os.path.normpath(args.media_dir) # Remove ending slashes if any
-
-if args.import_dirs:
-  for i, d in enumerate(args.import_dirs):
-    if not os.path.isdir(d):
-      exit("Import path %s is not a directory or is inaccessible, check volume mounts or give different path" % d)
-    common = os.path.commonprefix([d,args.media_dir])
-    if common==d or common==args.media_dir:
-      exit("Either media dir %s or import %s dir is a subdirectory of the other, which is not allowed" % (args.media_dir, d))
-    args.import_dirs[i] = os.path.normpath(d) # Remove ending slashes if any
-  if len(args.import_dirs)>1:
-    sorted = sorted(args.import_dirs)
-    for i, d in enumerate(sorted[1:]):
-      common = os.path.commonprefix([d,sorted[i-1]])
-      if common==d or common==sorted[i-1]:
-        exit("Either one of import dirs %s and %s is a subdirectory of the other, which is not allowed" % (d, sorted[i-1])) 
-
-noimport_filters = []
-if args.noimport:
-  tmp = args.noimport
-  args.noimport = []
-  for i, e in enumerate(tmp):
-    if e.startswith(os.path.sep): # An absolute path
-      e = os.path.normpath(e)  # Remove ending slashes if any
-      args.noimport.append(e)
-    else: #Interpret as an exclude pattern
-      noimport_filters.append(e)
-
-# Make sure format is valid
-# $filetype/$title ($year)/$filename
-for m in re.finditer(r"$(\w+)",args.format):
-  if m.group(1) not in format_keys:
-    exit("Key "+m.group(0)+" in format %s is not a recognized key" % args.format)
-if args.format.startswith("/"):
-  exit("Format %s cannot begin with /, e.g. the path is relative from %s!" % (args.format, args.media_dir))
-if '$filename' not in args.format and '$ext' not in args.format:
-  exit("Format lacks $ext and $filename, need to have either one")
-format_parts = args.format.count("/")
-if format_parts==0: # means no folder path was given, e.g. 
-  exit("Format %s need to have at least one folder in the path!" % args.format)
-title_i = args.format.find("$title")
-if title_i==-1:
-  exit("No $title format found in input format - you need to sort at least by title")
-part_i = args.format.find("$part")
-if part_i>=0:
-  if part_i<title_i:
-    exit("$part format cannot be before $title")
-elif args.format.find("$filename")==-1: # no part and no filename in format
-  exit("No $part in format and not using $filename is not allowed (because may overwrite part files)")
-cleaned = args.format.translate(None, '\?*:|"<>')
-if len(cleaned) < len(args.format):
-  print("Format "+args.format+" had the following illegal characters removed " + args.format.translate(None, cleaned))
-  args.format = cleaned
-
-args.keepfiles = [f.lower() for f in args.keepfiles]
-args.deletefiles = [f.lower() for f in args.deletefiles]
-
-chosen_format_keys = [k for k in format_keys if k in args.format]
-
-# Read files containing the dir/file names of what is already being downloaded, and print into variable
-# We don't want to move files still under download. Can also add file listing what to ignore here.
-files_downloading = ""
-if args.unfinished_torrents:
-  queue_cmd(output_cmd, *args.unfinished_torrents) # Use cat on all files to read into variable
-  files_downloading,retcode = pop_cmd(True)
-  if retcode is not -1:
-    print "Currently downloading: " + files_downloading
+      quoted.append(pipes.quote(path))
+  return ' '.join([script_cmds[cmd['op']]]+quoted)
+
+def compile_script(queue, remote, marker):
+  """Compiles the queue into one shell script. Each command only runs if none of the commands it
+  depends on failed, and prints its output and errors followed by a marker line with its index and
+  exit code (or skip). It runs in a subshell, so the failure flags don't outlive it in the SSH
+  session"""
+  lines = ['(']
+  for i, deps in enumerate(cmd_dependencies(queue)):
+    cmd, paths = queue[i]
+    if deps:
+      lines.append('if [ -z "%s" ]; then' % ''.join(['$f%i' % d for d in deps]))
+    else:
+      lines.append('if true; then')
+    lines.append('{ %s\n} </dev/null 2>&1; r=$?' % script_line(cmd, paths, remote))
+    lines.append('else r=skip; fi')
+    lines.append('[ "$r" = 0 ] || f%i=1' % i)
+    lines.append("printf '%%s %%s\\n' '%s %i' \"$r\"" % (marker, i))
+  lines.append(')')
+  return '\n'.join(lines)+'\n'
+
+def parse_script_output(output, queue, marker):
+  report = [{'cmd': human_friendly_cmd(cmd, *paths), 'retcode': None, 'status': 'skipped', 'output': ''}
+    for cmd, paths in queue]
+  text = []
+  for line in output.splitlines(True):
+    i = line.find(marker)
+    if i<0:
+      text.append(line)
+      continue
+    text.append(line[:i]) # Output not ending with newline ends up before the marker
+    index, result = line[i+len(marker):].split()
+    entry = report[int(index)]
+    entry['output'] = ''.join(text)
+    text = []
+    if result!='skip':
+      entry['retcode'] = int(result)
+      entry['status'] = 'ok' if entry['retcode']==0 else 'failed'
+  return report
+
+def flush_cmds_script(queue):
+  """Runs the queue as one shell script, on the NAS through the SSH session if all paths are on
+  the mount, otherwise in a local shell. Returns a report with one entry per command"""
+  if not queue:
+    return []
+  remote = all(render_cmd(cmd, paths).startswith(ssh_string) or
+    ('op' in cmd and all(is_remote_path(p) for p in paths)) for cmd, paths in queue)
+  marker = "__mediasorter_op_%s__" % os.urandom(8).encode('hex')
+  script = compile_script(queue, remote, marker)
+  if not args.batch:
+    print script
+    print "[y/n]? Run %i commands as one script %s" % (len(queue), "on remote" if remote else "locally")
+    if not raw_input().startswith("y"):
+      print "Ignored!"
+      return []
+  if not args.execute:
+    return []
+  journal_plan(queue)
+  started = time.time()
+  if remote:
+    # The session wraps the script in one { } group, which the shell reads whole before running it
+    output, retcode = ssh_session_run(script)
   else:
-    print "Could not read downloading torrents"
-
-# Matches .x264, h264, xvid, divx, etc at the end of string or a secion
-match_video = re.compile(r"[_\W](?P<val>[xh]\.?264|xvidhd|xvid|divx|mpeg2|avc)($|[_\W])", re.I) # case insensitive
-# Matches four digits in between some section breaker (e.g. moviename-2007- or moviename[1998])
-match_year = re.compile(r"[_\W](?P<val>\d{4})($|[_\W])")
-# Matches audio acronyms
-match_sound = re.compile(r"[_\W](?P<val>(\d(.1|Ch)[_\W]?)?(mp3|ac3|dts|dd|aac|ac-3)([_\W]?\d(.1|Ch)[_\W]?)?)($|[_\W])", re.I)
-# Matches type of rip acronyms
-match_rip = re.compile(r"[_\W](?P<val>dvdrip|dvdscr|dvd|screener|scr|brrip|bdrip|bluray|hdtv|hdtvrip|hdrip|vhsrip|vhs|vod|vodrip)($|[_\W])", re.I)
-match_resolution = re.compile(r"[_\W](?P<val>((\d{3,4}x)?(720|1080)p?)|ws|hd)($|[_\W])", re.I)
-match_lang = re.compile(r"[_\W](?P<val>(english|eng|en|swedish|sv|swe|french|korean|nl|hindi)([_\W]?(subtitles|subbed|subs|sub))?)($|[_\W])", re.I)
-# Matches movies split by disk, part, etc, can be followed by up to 2 digits, e.g. Part 02, CD1, A
-match_part = re.compile(r"(^|[_\W])(?P<val>(cd|part|pt|episode|ep|s\d{1,2}e|vol)([._\W]?(\d{1,2}|[iv]+))?)($|[_\W])", re.I)
-match_part_alt = re.compile(r"[_\W](?P<val>a|b|\d{1,2})(.#|$)", re.I)
-match_extension = re.compile(r"(^|[_\W])(?P<val>(mkv|divx|avi|mpg|m4v|mp4|iso|vob|VIDEO_TS|wmv|ogm))$", re.I)
-# Matches a name between () [] or {}, alternatively ending in 1231512.TPB (or some other digits)
-#match_torrent = re.compile(r"(?P<val>([]()[{}][^\]()\[{}]+[]()[{}])|\d{4,}\.TPB$)", re.I)
-match_torrent = re.compile(r"[_\W]*(?P<val>(demonoid|kat|isohunt|mininova|\d{6,}|www[_\W]\w+)([_\W]\w{2,4})?)[_\W]*", re.I)
-#Match from beginning until a replacement was made or 3 consecutive non-word chars. Use non-greedy match.
-# If it should end with 3+ non-word chars, we exclude "-" because it can appear in middle of title
-match_title = re.compile(r"^[_\W]*(?P<val>.{3,}?[])]?)([_\W]*#|[_\W]*$)", re.I)
-match_split = re.compile(r"[. _#]{2,}|[]()[{}]")
-
-# Matches left-over characters
-# To keep 'word, word', 'word 2.5', 'word - word', 'word's'
-# To remove 'word.word', 'word_word', 'word-', 'word.', 'word....word'. '-word'
-
-# uses negative lookbehind (?<!..) and lookahead (?!...) to only match "." not between ' /d' and ' /d'
-match_clean1 = re.compile(r"(?<! \d)(?P<val>\.+)(?!\d )")
-match_clean2 = re.compile(r"(?P<val>[_# ]+)")
-match_clean3 = re.compile(r"(?P<val> *-+ *)")
-
-match_correctcase = re.compile(r"[A-Z][a-z]")
-match_unfilled_format_keys = re.compile(r"[-._ ]+[{([]? ?\$\$ ?[)}\]]?")
-
-#TODO search for only approved media extensions, compile regex from extension list
-match_fileext_in_results = re.compile(r"\.(\w{3,4})$", re.I)
-#####################################################
-
-def match_remove(reobj, str, metadata=None, key=None, max=1, replace='#'):
-    if metadata and key and key not in metadata:
-      raise Exception("Incorrect key '%s' for metadata" % key) 
-    matches = reobj.finditer(str)
-    i = 0
-    offset = 0
-    for m in matches:
-      if m and m.group('val'):
-        #print "Found '%s' in '%s' using %s" % (m.group('val'), str, reobj.pattern)
-        if metadata and key:
-          if m.group('val') not in metadata[key]:
-          # insert first, which means higher priority. Match_remove called from left
-          # to right in path, so means last path component has highest priority
-            metadata[key].insert(0, m.group('val'))
-        #Cut away what we found but leave replace char as sign that something was there
-        tmp = len(str) # Need to store offset if we change str length during iteration
-        str = str[:m.start('val')+offset] + replace + str[m.end('val')+offset:]
-        offset += len(str)-tmp
-        i += 1
-        if i == max:
+    import subprocess
+    count('subprocesses')
+    sub = subprocess.Popen(['sh', '-s'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    output = sub.communicate(script)[0]
+  observe('script', started)
+  report = parse_script_output(output, queue, marker)
+  for i, entry in enumerate(report):
+    journal_done(i, entry['retcode'])
+    if entry['status']!='ok':
+      print "%s %s (%s) %s" % (entry['status'].upper(), entry['cmd'], entry['retcode'], entry['output'].strip())
+  print "Ran %i commands in one script: %i ok, %i failed, %i skipped" % tuple([len(report)] +
+    [len([e for e in report if e['status']==s]) for s in ('ok', 'failed', 'skipped')])
+  return report
+#####################################################
+
+def cmd_volume(cmd, paths):
+  # The device a command writes to, moves write to their target
+  return path_dev(paths[-1] if cmd.get('op')=='move' else paths[0])
+
+def flush_cmds_parallel(queue):
+  """Runs the queue with up to args.jobs commands at a time per target volume. A command starts
+  when all commands it depends on have finished, and is skipped if any of them failed. Results
+  are logged in queue order, and returned as a report with one entry per command"""
+  import threading, Queue
+  deps = cmd_dependencies(queue)
+  waiting = [len(d) for d in deps]
+  dependents = [[] for q in queue]
+  for i, d in enumerate(deps):
+    for j in d:
+      dependents[j].append(i)
+  report = [{'cmd': human_friendly_cmd(cmd, *paths), 'retcode': None, 'status': None, 'output': ''}
+    for cmd, paths in queue]
+  doomed = [False]*len(queue) # A command it depends on failed
+  results = Queue.Queue()
+  volumes = dict() # device -> work queue of the workers for that volume
+  workers = []
+
+  def worker(work):
+    while True:
+      i = work.get()
+      if i is None:
+        return
+      try:
+        result = exec_cmd(queue[i])
+      except Exception as e: # The loop below waits for every result, so one must come
+        result = ("", 1, "%s: %s\n" % (render_cmd(*queue[i]), e))
+      results.put((i, result))
+
+  def start(i):
+    try:
+      dev = cmd_volume(*queue[i])
+    except OSError:
+      dev = None
+    if dev not in volumes:
+      volumes[dev] = Queue.Queue()
+      for j in range(args.jobs):
+        t = threading.Thread(target=worker, args=(volumes[dev],))
+        t.daemon = True
+        t.start()
+        workers.append((t, volumes[dev]))
+    volumes[dev].put(i)
+
+  def finish(i, status):
+    # Returns commands that can be started now
+    report[i]['status'] = status
+    ready = []
+    done = [i]
+    while done:
+      i = done.pop()
+      for k in dependents[i]:
+        waiting[k] -= 1
+        doomed[k] = doomed[k] or report[i]['status']!='ok'
+        if waiting[k]==0:
+          if doomed[k]:
+            report[k]['status'] = 'skipped'
+            journal_done(k, None)
+            done.append(k)
+          else:
+            ready.append(k)
+    return ready
+
+  running = 0
+  for i in range(len(queue)):
+    if waiting[i]==0:
+      start(i)
+      running += 1
+  logged = 0
+  while running>0:
+    i, (output, retcode, errors) = results.get()
+    running -= 1
+    report[i].update(retcode=retcode, output=output+errors)
+    journal_done(i, retcode)
+    for k in sorted(finish(i, 'ok' if retcode==0 else 'failed')):
+      start(k)
+      running += 1
+    while logged<len(report) and report[logged]['status']:
+      entry = report[logged]
+      if entry['status']=='failed':
+        sys.stderr.write(entry['output'] or "%s failed (%s)\n" % (entry['cmd'], entry['retcode']))
+      elif entry['status']=='skipped':
+        print "Skipped, depends on a failed command: %s" % entry['cmd']
+      logged += 1
+  for t, work in workers:
+    work.put(None)
+  for t, work in workers:
+    t.join()
+  return report
+#####################################################
+
+###### JOURNAL ###############################################
+## Every file operation run is appended to a journal next to the state db, one line per operation
+## with the operations undoing it. The inverses are worked out before a batch of commands runs, by
+## playing it through on the dir listings, so wildcards are expanded to what they will move. Lines
+## are written as operations finish and synced to disk in batches. The next run that executes
+## resumes a run that was interrupted, and --undo RUN_ID undoes a whole run
+
+journal_sync_every = 64 # Lines written before syncing to disk, or
+journal_sync_seconds = 1.0 # seconds since the last sync
+journal_fd = None
+run_id = None # Of this run, set when the journal is opened
+journal_step = 0 # Batches of commands journaled in this run
+journal_undos = [] # Inverses of the commands in the batch being run
+journal_unsynced = 0
+journal_synced = 0.0
+
+op_cmds = { # The command for each operation in the journal
+  'move':       move_cmd,
+  'delete':     rm_cmd,
+  'delete_dir': rmdir_cmd,
+  'make_dir':   mkdir_cmd,
+  'make_path':  mkdir_rec_cmd,
+  'remove_dir': rmdir_empty_cmd,
+  'link':       link_cmd,
+  'symlink':    symlink_cmd,
+}
+
+def journal_path():
+  return args.db+'.journal'
+
+def absolute_path(path):
+  # Keeping a trailing slash, which makes a move go into a dir
+  return os.path.abspath(path)+os.path.sep*path.endswith(os.path.sep)
+
+def read_journal():
+  """Returns the journal lines as dicts, without a last line that was cut short"""
+  import ast
+  entries = []
+  try:
+    with open(journal_path()) as f:
+      for line in f:
+        try:
+          entries.append(ast.literal_eval(line))
+        except (ValueError, SyntaxError):
+          pass
+  except IOError:
+    pass
+  return entries
+
+def journal_write(entry, sync=False):
+  # Lines are repr() of dicts, which keeps paths the bytes they are
+  global journal_unsynced, journal_synced
+  os.write(journal_fd, repr(entry)+'\n')
+  journal_unsynced += 1
+  if sync or journal_unsynced>=journal_sync_every or time.time()-journal_synced>=journal_sync_seconds:
+    journal_sync()
+
+def journal_sync():
+  global journal_unsynced, journal_synced
+  if journal_fd is not None and journal_unsynced:
+    os.fsync(journal_fd)
+    journal_unsynced = 0
+    journal_synced = time.time()
+
+def open_journal():
+  global journal_fd, run_id, journal_step
+  if journal_fd is None:
+    journal_fd = os.open(journal_path(), os.O_WRONLY|os.O_APPEND|os.O_CREAT, 0644)
+    run_id = '%s-%d' % (time.strftime('%Y%m%d-%H%M%S'), os.getpid())
+    journal_step = 0
+    journal_write({'run': run_id, 'started': time.time()}, sync=True)
+    print "Run %s, journaled in %s" % (run_id, journal_path())
+
+def close_journal():
+  global journal_fd
+  if journal_fd is not None:
+    journal_write({'run': run_id, 'ended': time.time()}, sync=True)
+    os.close(journal_fd)
+    journal_fd = None
+
+def journal_plan(queue):
+  """Journals a batch of commands that is about to run, if executing. Commands of it are then
+  journaled with journal_done(index in queue, retcode) as they finish"""
+  global journal_step, journal_undos
+  if not args.execute or not queue:
+    return
+  open_journal()
+  journal_step += 1
+  journal_undos = plan_inverses(queue)
+  journal_write({'run': run_id, 'step': journal_step,
+    'plan': [(cmd.get('op'), [absolute_path(p) for p in paths]) for cmd, paths in queue]}, sync=True)
+
+def journal_done(i, retcode):
+  # retcode is None if it was skipped, -1 if it was declined
+  if journal_fd is None:
+    return
+  entry = {'run': run_id, 'step': journal_step, 'i': i, 'retcode': retcode}
+  if retcode==0:
+    entry['undo'] = journal_undos[i]
+  journal_write(entry)
+
+def plan_inverses(queue):
+  """For each queued command, the operations undoing it as a list of (op, paths), or None if it
+  can't be undone. Worked out by playing the queue through on the dir listings, as they are when
+  it starts, so wildcards expand to what the moves will find"""
+  tree = {'real': os.path.sep, 'children': dict()} # Dirs as they will be, each with its real path if it has one
+
+  def node(path):
+    n = tree
+    for c in path.split(os.path.sep):
+      if c:
+        if c not in n['children']:
+          n['children'][c] = {'real': n['real'] and os.path.join(n['real'], c), 'children': dict()}
+        n = n['children'][c]
+    return n
+
+  def names(n):
+    if 'names' not in n:
+      try:
+        n['names'] = dict(list_dir(n['real'])) if n['real'] else dict()
+      except OSError:
+        n['names'] = dict()
+    return n['names']
+
+  def kind(path):
+    parent, name = os.path.split(path)
+    return names(node(parent)).get(name)
+
+  def remove(path):
+    parent, name = os.path.split(path)
+    n = node(parent)
+    names(n).pop(name, None)
+    n['children'][name] = {'real': None, 'children': dict(), 'names': dict()}
+
+  def make(path):
+    parent, name = os.path.split(path)
+    n = node(parent)
+    names(n)[name] = 'dir'
+    n['children'][name] = {'real': None, 'children': dict(), 'names': dict()}
+
+  def move(src, dst):
+    (sp, sn), (dp, dn) = os.path.split(src), os.path.split(dst)
+    s, d = node(sp), node(dp)
+    names(d)[dn] = names(s).pop(sn, None) or 'file'
+    d['children'][dn] = s['children'].pop(sn, None) or {'real': s['real'] and os.path.join(s['real'], sn),
+      'children': dict()}
+
+  inverses = []
+  for cmd, paths in queue:
+    op = cmd.get('op')
+    paths = [os.path.abspath(p) for p in paths]
+    undo = None
+    if op=='move': # Same as op_move()
+      frompaths = []
+      for path in paths[:-1]:
+        if path.endswith(os.path.sep+'*'):
+          frompaths.extend(os.path.join(path[:-2], f) for f in sorted(names(node(path[:-2]))))
+        else:
+          frompaths.append(path)
+      target = paths[-1]
+      to_dir = kind(target) in ('dir', 'link')
+      undo = []
+      for frompath in frompaths:
+        topath = os.path.join(target, os.path.basename(frompath)) if to_dir else target
+        move(frompath, topath)
+        undo.insert(0, ('move', [topath, frompath]))
+    elif op in ('make_dir', 'make_path'):
+      undo = []
+      for path in paths:
+        made = []
+        while kind(path) is None and path!=os.path.dirname(path) and (op=='make_path' or not made):
+          made.append(path)
+          path = os.path.dirname(path)
+        for path in reversed(made):
+          make(path)
+        undo = [('remove_dir', [path]) for path in made]+undo
+    elif op=='symlink':
+      parent, name = os.path.split(paths[1])
+      names(node(parent))[name] = 'link'
+      undo = [('delete', [paths[1]])]
+    elif op in ('delete', 'delete_dir', 'remove_dir'):
+      for path in paths:
+        remove(path)
+      if op=='remove_dir': # Was empty
+        undo = [('make_dir', [path]) for path in reversed(paths)]
+    inverses.append(undo)
+  return inverses
+
+def already_done(op, paths):
+  # A journaled operation that had been run, but was not journaled as done before the run stopped
+  if op=='move':
+    if any(p.endswith(os.path.sep+'*') for p in paths[:-1]):
+      return False
+    return counted_lexists(paths[-1]) and not any(counted_lexists(p) for p in paths[:-1])
+  if op in ('delete', 'delete_dir', 'remove_dir'):
+    return not any(counted_lexists(p) for p in paths)
+  if op=='link':
+    return all(counted_lexists(p) for p in paths) and counted_samefile(*paths)
+  if op=='symlink':
+    return counted_islink(paths[1])
+  return all(counted_isdir(p) for p in paths)
+
+def resume_run():
+  """Runs what is left of the last journaled run, if it was interrupted before it had run all it
+  planned"""
+  entries = read_journal()
+  runs = [e['run'] for e in entries if 'plan' in e]
+  if not runs:
+    return
+  last = runs[-1]
+  plans = dict()
+  finished = set()
+  for e in entries:
+    if e['run']!=last:
+      continue
+    if 'ended' in e or 'resumed_by' in e:
+      return
+    if 'plan' in e:
+      plans[e['step']] = e['plan']
+    elif 'i' in e:
+      finished.add((e['step'], e['i']))
+  left = [(op, paths) for step in sorted(plans) for i, (op, paths) in enumerate(plans[step])
+    if op and (step, i) not in finished]
+  if not left:
+    return
+  if not args.execute:
+    print "Run %s was interrupted with %d file operations left, they are run first when executing" % (last, len(left))
+    return
+  print "Resuming run %s, %d file operations left" % (last, len(left))
+  open_journal()
+  for op, paths in left:
+    if already_done(op, paths):
+      print "Already done: %s" % human_friendly_cmd(op_cmds[op], *paths)
+    else:
+      queue_cmd(op_cmds[op], *paths)
+  flush_cmds()
+  init_cmds()
+  journal_write({'run': last, 'resumed_by': run_id}, sync=True)
+
+def plain_move(paths):
+  # A move of one path to a new path, not into a dir nor of what is in a dir
+  return len(paths)==2 and not paths[0].endswith(os.path.sep+'*') and not paths[1].endswith(os.path.sep)
+
+def collapse_moves(ops, move='move'):
+  """Joins a move from a to b and a later move from b to c into one move from a to c, unless
+  something in between touched a or b, a dir above them or anything in them. Moves ending where
+  they started are dropped. ops are (op, paths), with op==move for moves"""
+  result = []
+  watched = dict() # Start and end paths of moves in result -> index
+  below = dict() # dir -> watched paths inside it
+  broken = set() # Indices of moves that can't be joined any more
+
+  def watch(path, k):
+    watched[path] = k
+    for parent in parent_dirs(path):
+      below.setdefault(parent, set()).add(path)
+
+  def forget(path):
+    for p in below.pop(path, ()):
+      broken.add(watched.pop(p, None))
+    for p in [path]+parent_dirs(path):
+      if p in watched:
+        broken.add(watched.pop(p))
+
+  for op, paths in ops:
+    k = None
+    if op==move and plain_move(paths):
+      k = watched.get(paths[0])
+      if k in broken or (k is not None and result[k][1][1]!=paths[0]):
+        k = None
+    for path in dependency_paths(paths):
+      forget(path)
+    if k is not None:
+      start = result[k][1][0]
+      forget(start)
+      result[k] = None
+      if start==paths[1]:
+        continue
+      paths = [start, paths[1]]
+    result.append((op, paths))
+    if op==move and plain_move(paths):
+      watch(paths[0], len(result)-1)
+      watch(paths[1], len(result)-1)
+  return [r for r in result if r is not None]
+
+def undo_run(undo_id):
+  """Undoes the file operations of a journaled run, the last first, in this process. Raises
+  ConfigError if there is no such run"""
+  plans = dict()
+  undos = []
+  lost = []
+  found = False
+  for e in read_journal():
+    if e['run']!=undo_id:
+      continue
+    found = True
+    if 'undone_by' in e:
+      print "Run %s was undone already by run %s" % (undo_id, e['undone_by'])
+      return
+    if 'plan' in e:
+      plans[e['step']] = e['plan']
+    elif e.get('retcode')==0:
+      if e.get('undo') is None:
+        if plans[e['step']][e['i']][0]: # Not a file operation otherwise, such as a subtitle search
+          lost.append(plans[e['step']][e['i']])
+      else:
+        undos.append(e['undo'])
+  if not found:
+    raise ConfigError("No run %s in %s" % (undo_id, journal_path()))
+  for op, paths in lost:
+    print "Can't undo: %s" % human_friendly_cmd(op_cmds[op], *paths)
+  queue = [(op_cmds[op], tuple(paths)) for op, paths in collapse_moves([u for undo in reversed(undos) for u in undo])]
+  for cmd, paths in queue:
+    print human_friendly_cmd(cmd, *paths)
+  if not queue or not args.execute:
+    return
+  if not args.batch:
+    print "[y/n]? Undo run %s with %d file operations" % (undo_id, len(queue))
+    if not raw_input().startswith("y"):
+      print "Ignored!"
+      return
+  journal_plan(queue)
+  failed = 0
+  for i, (cmd, paths) in enumerate(queue):
+    output, retcode, errors = run_file_op(cmd, paths)
+    sys.stderr.write(errors)
+    journal_done(i, retcode)
+    failed += retcode!=0
+  journal_write({'run': undo_id, 'undone_by': run_id}, sync=True)
+  print "Undid run %s: %d file operations, %d failed" % (undo_id, len(queue), failed)
+#####################################################
+
+###### PLAN FILES ###############################################
+## --plan-out writes every batch of commands a run would flush to a JSON file, with fingerprints of
+## the paths they touch as they were then. --apply runs such a file later without walking or parsing
+## anything again, skipping commands whose paths have changed since and what depends on them
+
+planned_steps = None # Batches of commands flushed, collected when args.plan_out is given
+
+plan_cmds = dict(op_cmds, unrar=unrar_cmd) # The commands a plan can have, by the name it uses
+
+def fingerprint(path, source):
+  """(kind, size, mtime) of path or None if it is missing. Only the kind if it is not a source,
+  e.g. a dir things are moved into, as changes to what is in it don't matter"""
+  try:
+    st = counted_stat(path[:-2] if path.endswith(os.path.sep+'*') else path)
+  except OSError:
+    return None
+  kind = 'dir' if stat.S_ISDIR(st.st_mode) else 'file'
+  if not source:
+    return [kind]
+  return [kind, st.st_size if kind=='file' else 0, st.st_mtime]
+
+def plan_cmd_name(cmd):
+  # The name of cmd in plan_cmds, None if it can't be in a plan
+  for name, c in plan_cmds.iteritems():
+    if c is cmd:
+      return name
+  return None
+
+def plan_step(queue):
+  # A batch of commands as it goes into a plan file
+  step = []
+  for cmd, paths in queue:
+    name = plan_cmd_name(cmd)
+    if not name:
+      continue # Not something that can be run from a plan, such as a subtitle search
+    paths = [absolute_path(p) for p in paths]
+    targets = paths[-1:] if cmd.get('op') in ('move', None) else []
+    if cmd.get('op') in ('make_dir', 'make_path', 'symlink'): # Nothing linked to is changed
+      targets = paths
+    step.append({'cmd': name, 'paths': paths,
+      'before': dict((p, fingerprint(p, p not in targets)) for p in paths)})
+  return step
+
+def save_plan():
+  import json
+  plan = {'media_dir': os.path.abspath(args.media_dir), 'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+    'encoding': 'utf-8', 'steps': [step for step in planned_steps if step]}
+  try:
+    text = json.dumps(plan, indent=1, sort_keys=True, separators=(',', ': '))
+  except UnicodeDecodeError: # Some name is not UTF-8, keep the bytes as they are
+    plan['encoding'] = 'latin-1'
+    text = json.dumps(plan, indent=1, sort_keys=True, separators=(',', ': '), encoding='latin-1')
+  with open(args.plan_out, 'w') as f:
+    f.write(text+'\n')
+  print "Plan with %d commands written to %s" % (sum(len(step) for step in plan['steps']), args.plan_out)
+
+def load_plan(path):
+  """Reads a plan file, raises ConfigError if it can't be read or is for another media dir"""
+  import json
+  try:
+    with open(path) as f:
+      plan = json.load(f)
+  except (IOError, ValueError) as e:
+    raise ConfigError("Can't read plan %s: %s" % (path, e))
+  if plan['media_dir'].encode(plan['encoding'])!=os.path.abspath(args.media_dir):
+    raise ConfigError("Plan %s is for media dir %s, not %s" % (path, plan['media_dir'], args.media_dir))
+  encode = lambda p: p.encode(plan['encoding'])
+  for step in plan['steps']:
+    for entry in step:
+      entry['paths'] = [encode(p) for p in entry['paths']]
+      entry['before'] = dict((encode(p), fp) for p, fp in entry['before'].iteritems())
+  return plan
+
+def apply_plan(path):
+  """Runs the commands of a plan file whose paths are as they were when it was made, and all
+  that don't depend on one that isn't"""
+  plan = load_plan(path)
+  print "Applying plan %s from %s" % (path, plan['created'])
+  queues = []
+  for step in plan['steps']:
+    queue = [(plan_cmds[entry['cmd']], tuple(entry['paths'])) for entry in step]
+    skipped = set()
+    for i, deps in enumerate(cmd_dependencies(queue)):
+      cmd, paths = queue[i]
+      before = step[i]['before']
+      changed = [p for p in before if fingerprint(p, len(before[p] or ())>1)!=before[p]]
+      if changed:
+        print "Changed since planned, skipped: %s (%s)" % (human_friendly_cmd(cmd, *paths), ', '.join(changed))
+        skipped.add(i)
+      elif skipped.intersection(deps):
+        print "Skipped, depends on a skipped command: %s" % human_friendly_cmd(cmd, *paths)
+        skipped.add(i)
+    queues.append([queued for i, queued in enumerate(queue) if i not in skipped])
+  # All checked before anything runs, as running changes the paths
+  started = time.time()
+  for queue in queues:
+    for cmd, paths in queue:
+      queue_cmd(cmd, *paths)
+    flush_cmds()
+    init_cmds()
+  add_time('flush', started)
+#####################################################
+
+###### SETUP ###############################################
+## Everything that depends on the configuration is set up here instead of at import, so the parser
+## can be imported by other tools
+
+class ConfigError(Exception):
+  pass
+
+def configure(config):
+  """Makes config, as from the command line or Config, the configuration in use. Raises
+  ConfigError if it is not valid"""
+  global args, noimport_filters, format_parts, title_i, part_i, chosen_format_keys
+  global file_rules, noimport_rules, noimport_paths, excluded
+  global db_dir, db_name, scan_index, state_db, created_paths, parse_cache_pruned, recent_limit
+  close_journal() # Of the config used before
+  args = copy.deepcopy(config) # Normalised below, keep what was given as it was
+  compile_patterns()
+  init_cmds()
+  created_paths = set()
+  periscope_cmd['cmd'] = 'periscope -l '+args.subs+'%s'
+  commands['search_subs']['cmd'] = 'periscope -l '+args.subs
+
+  ### Make sure we are configured correctly
+  if not os.path.isdir(args.media_dir):
+      raise ConfigError("Media path %s is not a directory or is inaccessible, check volume mounts or give different path" % args.media_dir)
+
+  args.media_dir = os.path.normpath(args.media_dir) # Remove ending slashes if any
+
+  if args.import_dirs:
+    for i, d in enumerate(args.import_dirs):
+      if not os.path.isdir(d):
+        raise ConfigError("Import path %s is not a directory or is inaccessible, check volume mounts or give different path" % d)
+      common = os.path.commonprefix([d,args.media_dir])
+      if common==d or common==args.media_dir:
+        raise ConfigError("Either media dir %s or import %s dir is a subdirectory of the other, which is not allowed" % (args.media_dir, d))
+      args.import_dirs[i] = os.path.normpath(d) # Remove ending slashes if any
+    if len(args.import_dirs)>1:
+      sorted_dirs = sorted(args.import_dirs)
+      for i, d in enumerate(sorted_dirs[1:]):
+        common = os.path.commonprefix([d,sorted_dirs[i]])
+        if common==d or common==sorted_dirs[i]:
+          raise ConfigError("Either one of import dirs %s and %s is a subdirectory of the other, which is not allowed" % (d, sorted_dirs[i])) 
+
+  noimport_filters = []
+  if args.noimport:
+    tmp = args.noimport
+    args.noimport = []
+    for i, e in enumerate(tmp):
+      if e.startswith(os.path.sep): # An absolute path
+        e = os.path.normpath(e)  # Remove ending slashes if any
+        args.noimport.append(e)
+      else: #Interpret as an exclude pattern
+        noimport_filters.append(e)
+
+  # Make sure format is valid
+  # $filetype/$title ($year)/$filename
+  for m in re.finditer(r"$(\w+)",args.format):
+    if m.group(1) not in format_keys:
+      raise ConfigError("Key "+m.group(0)+" in format %s is not a recognized key" % args.format)
+  if args.format.startswith("/"):
+    raise ConfigError("Format %s cannot begin with /, e.g. the path is relative from %s!" % (args.format, args.media_dir))
+  if '$filename' not in args.format and '$ext' not in args.format:
+    raise ConfigError("Format lacks $ext and $filename, need to have either one")
+  format_parts = args.format.count("/")
+  if format_parts==0: # means no folder path was given, e.g. 
+    raise ConfigError("Format %s need to have at least one folder in the path!" % args.format)
+  title_i = args.format.find("$title")
+  if title_i==-1:
+    raise ConfigError("No $title format found in input format - you need to sort at least by title")
+  part_i = args.format.find("$part")
+  if part_i>=0:
+    if part_i<title_i:
+      raise ConfigError("$part format cannot be before $title")
+  elif args.format.find("$filename")==-1: # no part and no filename in format
+    raise ConfigError("No $part in format and not using $filename is not allowed (because may overwrite part files)")
+  cleaned = args.format.translate(None, '\?*:|"<>')
+  if len(cleaned) < len(args.format):
+    print("Format "+args.format+" had the following illegal characters removed " + args.format.translate(None, cleaned))
+    args.format = cleaned
+
+  args.keepfiles = [f.lower() for f in args.keepfiles]
+  args.deletefiles = [f.lower() for f in args.deletefiles]
+  try:
+    file_rules = compile_rules([('keep', args.keepfiles), ('delete', args.deletefiles)])
+    noimport_rules = compile_rules([('noimport', noimport_filters)])
+  except re.error as e:
+    raise ConfigError("Invalid keep, delete or noimport pattern: %s" % e)
+  noimport_paths = frozenset(args.noimport)
+  excluded = frozenset(args.exclude)
+
+  if not args.db:
+    args.db = os.path.join(args.media_dir, ".mediasorter.db")
+
+  chosen_format_keys = [k for k in format_keys if k in args.format]
+  recent_limit = timedelta(weeks=args.recent_weeks)
+
+  db_dir, db_name = os.path.split(os.path.abspath(args.db))
+  if state_db:
+    state_db.close() # Could be another media dir's
+    state_db = None
+    parse_cache_pruned = False
+  scan_index = None
+#####################################################
+
+###### UNFINISHED TORRENTS ###############################################
+## The files listing what is being downloaded are parsed into a set of names, so checking a dir is
+## one exact lookup. Lists that can be reached locally are read directly and parsed again only
+## when their mtime or size changes, the others are read with cat over SSH
+
+downloading = frozenset() # Names of torrent files and dirs being downloaded
+torrent_lists = dict() # local path -> ((mtime, size), names), or tuple of remote paths -> (text, names)
+torrent_file_pattern = r"[^/\t\"]+\.torrent"
+
+def parse_torrent_list(text):
+  """Returns the names in the text of a torrent list: each line, its last path component and
+  each *.torrent file name in it"""
+  names = set()
+  for line in text.splitlines():
+    line = line.strip()
+    if line:
+      names.add(line)
+      names.add(os.path.basename(line.rstrip(os.path.sep)))
+      names.update(t.strip() for t in re.findall(torrent_file_pattern, line))
+  return names
+
+def read_downloading():
+  """Reads the lists of what is already being downloaded, which we don't want to move. Returns
+  True if what is being downloaded has changed"""
+  global downloading
+  names = set()
+  remote = []
+  for path in args.unfinished_torrents:
+    try:
+      st = counted_stat(path)
+    except OSError:
+      remote.append(path)
+      continue
+    cached = torrent_lists.get(path)
+    if not cached or cached[0]!=(st.st_mtime, st.st_size):
+      with open(path) as f:
+        cached = ((st.st_mtime, st.st_size), parse_torrent_list(f.read()))
+      torrent_lists[path] = cached
+    names.update(cached[1])
+  if remote:
+    # Not queued, as watch mode reads them again
+    output, retcode = run_cmd((output_cmd, tuple(remote)), True)
+    if retcode!=0:
+      print "Could not read all downloading torrents in %s" % ", ".join(remote)
+    cached = torrent_lists.get(tuple(remote))
+    if not cached or cached[0]!=output:
+      cached = (output, parse_torrent_list(output))
+      torrent_lists[tuple(remote)] = cached
+    names.update(cached[1])
+  if names==downloading:
+    return False
+  downloading = frozenset(names)
+  print "Currently downloading: %s" % ', '.join(sorted(downloading))
+  return True
+
+def is_downloading(name):
+  return name+".torrent" in downloading or name in downloading
+#####################################################
+
+patterns_compiled = False
+
+def compile_patterns():
+  """Compiles the patterns names are parsed with, once and only when first needed"""
+  global patterns_compiled, match_video, match_year, match_sound, match_rip, match_resolution
+  global match_lang, match_part, match_part_alt, match_extension, match_torrent, match_title
+  global match_split, match_clean1, match_clean2, match_clean3, match_correctcase
+  global match_unfilled_format_keys
+  if patterns_compiled:
+    return
+  # Matches .x264, h264, xvid, divx, etc at the end of string or a secion
+  match_video = re.compile(r"[_\W](?P<val>[xh]\.?264|xvidhd|xvid|divx|mpeg2|avc)($|[_\W])", re.I) # case insensitive
+  # Matches four digits in between some section breaker (e.g. moviename-2007- or moviename[1998])
+  match_year = re.compile(r"[_\W](?P<val>\d{4})($|[_\W])")
+  # Matches audio acronyms
+  match_sound = re.compile(r"[_\W](?P<val>(\d(.1|Ch)[_\W]?)?(mp3|ac3|dts|dd|aac|ac-3)([_\W]?\d(.1|Ch)[_\W]?)?)($|[_\W])", re.I)
+  # Matches type of rip acronyms
+  match_rip = re.compile(r"[_\W](?P<val>dvdrip|dvdscr|dvd|screener|scr|brrip|bdrip|bluray|hdtv|hdtvrip|hdrip|vhsrip|vhs|vod|vodrip)($|[_\W])", re.I)
+  match_resolution = re.compile(r"[_\W](?P<val>((\d{3,4}x)?(720|1080)p?)|ws|hd)($|[_\W])", re.I)
+  match_lang = re.compile(r"[_\W](?P<val>(english|eng|en|swedish|sv|swe|french|korean|nl|hindi)([_\W]?(subtitles|subbed|subs|sub))?)($|[_\W])", re.I)
+  # Matches movies split by disk, part, etc, can be followed by up to 2 digits, e.g. Part 02, CD1, A
+  match_part = re.compile(r"(^|[_\W])(?P<val>(cd|part|pt|episode|ep|s\d{1,2}e|vol)([._\W]?(\d{1,2}|[iv]+))?)($|[_\W])", re.I)
+  match_part_alt = re.compile(r"[_\W](?P<val>a|b|\d{1,2})(.#|$)", re.I)
+  match_extension = re.compile(r"(^|[_\W])(?P<val>(mkv|divx|avi|mpg|m4v|mp4|iso|vob|VIDEO_TS|wmv|ogm))$", re.I)
+  # Matches a name between () [] or {}, alternatively ending in 1231512.TPB (or some other digits)
+  #match_torrent = re.compile(r"(?P<val>([]()[{}][^\]()\[{}]+[]()[{}])|\d{4,}\.TPB$)", re.I)
+  # No separators around the value, as they never change where it is found and made every search slow
+  match_torrent = re.compile(r"(?P<val>(demonoid|kat|isohunt|mininova|\d{6,}|www[_\W]\w+)([_\W]\w{2,4})?)", re.I)
+  #Match from beginning until a replacement was made or 3 consecutive non-word chars. Use non-greedy match.
+  # If it should end with 3+ non-word chars, we exclude "-" because it can appear in middle of title
+  match_title = re.compile(r"^[_\W]*(?P<val>.{3,}?[])]?)([_\W]*#|[_\W]*$)", re.I)
+  match_split = re.compile(r"[. _#]{2,}|[]()[{}]")
+
+  # Matches left-over characters
+  # To keep 'word, word', 'word 2.5', 'word - word', 'word's'
+  # To remove 'word.word', 'word_word', 'word-', 'word.', 'word....word'. '-word'
+
+  # uses negative lookbehind (?<!..) and lookahead (?!...) to only match "." not between ' /d' and ' /d'
+  match_clean1 = re.compile(r"(?<! \d)(?P<val>\.+)(?!\d )")
+  match_clean2 = re.compile(r"(?P<val>[_# ]+)")
+  match_clean3 = re.compile(r"(?P<val> *-+ *)")
+
+  match_correctcase = re.compile(r"[A-Z][a-z]")
+  match_unfilled_format_keys = re.compile(r"[-._ ]+[{([]? ?\$\$ ?[)}\]]?")
+  compile_parse_table()
+  patterns_compiled = True
+#####################################################
+
+###### PARSER ###############################################
+## Each path component is parsed as if the pattern table ran over it in order, each pattern
+## cutting out the value it finds first and leaving a '#' in its place, which later patterns rely
+## on (match_part_alt and match_title look for it). Rather than searching once per pattern, one
+## finditer of match_values, an alternation of all the patterns with a separator before their
+## value, tries them at the start and after each separator and classifies what it finds there as
+## the value of the first one in table order that matches, by the group it is in. As a cut leaves
+## a separator where there were separators around it already, such a value is still the first of
+## its pattern after the cuts before it, unless one of them cut into it, or a value of an earlier
+## pattern hid it from the scan by being found where it was and then not cut out. match_sound is
+## matched again where a cut follows, as its value can end in a separator it only takes when a
+## separator follows too. The rest of the table (match_part_alt, match_torrent, whose values can
+## start anywhere, and from wherever the scan can't tell) runs the patterns over the cut string.
+## The title is found by find_title without backtracking. Results are the same as running each
+## regex over the whole string, which benchmark.py --parser checks.
+
+def find_title(str):
+  """Same as match_title.match(str) but returns the (start, end) of its value, or None"""
+  n = len(str)
+  if n<3:
+    return None
+  if '\n' in str: # . does not match newlines, leave those rare cases to the regex
+    m = match_title.match(str)
+    return m and m.span('val')
+  # Leading separators are skipped, unless that leaves less than the 3 chars needed
+  start = 0
+  while start<n-3 and str[start] in separator_chars:
+    start += 1
+  # The value ends as early as possible (3 chars on) where only separators are left before a # or
+  # the end. It keeps a ] or ) it ends on
+  end = str.find('#', start+3)
+  if end<0:
+    end = n
+  while end>start+3 and str[end-1] in separator_chars:
+    end -= 1
+  if end<n and str[end] in '])':
+    end += 1
+  return start, end
+
+def value_parts(pattern):
+  """Splits a pattern with a (?P<val>...) group into what comes before the group, the group's
+  own pattern and what comes after it"""
+  start = pattern.index('(?P<val>')
+  i = start
+  depth = 0
+  while True:
+    c = pattern[i]
+    if c=='\\':
+      i += 1
+    elif c=='[':
+      i = pattern.index(']', i+2) # A ] right after the [ is in the set
+    elif c=='(':
+      depth += 1
+    elif c==')':
+      depth -= 1
+      if depth==0:
+        return pattern[:start], pattern[start+len('(?P<val>'):i], pattern[i+1:]
+    i += 1
+
+def scan_pattern(pattern):
+  # The pattern matching the lowercased strings the case insensitive pattern matches, which unlike
+  # a re.I pattern is searched for by skipping to the chars it can start with. Only its named
+  # groups capture, so a match's lastindex is the group of the value found
+  return re.sub(r"\\.|\[\]?[^]]*\]|\((?!\?)|\(\?P<\w+>|[A-Z]",
+    lambda m: {'(': '(?:'}.get(m.group(), m.group().lower() if len(m.group())==1 else m.group()), pattern)
+
+parser_revision = 1 # Bump when parse_component changes in a way the patterns don't show
+
+def compile_parse_table():
+  global separator_chars, parse_table, parser_version
+  global match_values, value_rows, parse_steps
+  separator_chars = frozenset(c for c in map(chr, range(256)) if re.match(r"[_\W]", c))
+  # (key, pattern, needles the lowercased string must have one of or None, chars from the end to
+  # search or 0 for all). Its values are values of the first match, none are empty
+  parse_table = [
+    ('ext',         match_extension, None, 10),
+    ('part',        match_part, r"cd|pt|part|ep|vol|s\d", 0),
+    ('part',        match_part_alt, None, 0),
+    ('video_codec', match_video, r"264|xvid|divx|mpeg2|avc", 0),
+    ('year',        match_year, None, 0),
+    ('sound_codec', match_sound, r"mp3|ac3|dts|dd|aac|ac-3", 0),
+    ('rip',         match_rip, r"dvd|scr|brrip|bdrip|bluray|hdtv|hdrip|vhs|vod", 0),
+    ('resolution',  match_resolution, r"720|1080|ws|hd", 0),
+    ('torrent',     match_torrent, r"demonoid|kat|isohunt|mininova|\d{6}|www", 0),
+    ('title',       None, None, 0), # find_title
+    # Cut out but not kept as $lang yet, see TODO about korean above
+    (None,          match_lang, r"en|sv|swe|korean|nl|hindi", 0),
+  ]
+  parse_table = [(key, reobj, needles and re.compile(needles).search, tail)
+    for key, reobj, needles, tail in parse_table]
+  # The scan tries the patterns in a lookahead after each separator, and at the start the ones that
+  # can match there, so the separators between values are not used up. Each value is a group named
+  # after its row's key, value_rows has the row of each group
+  values = []
+  start_values = []
+  names = dict()
+  parse_steps = [] # (row, None) of the rows parse_component runs itself
+  for row, (key, reobj, needles, tail) in enumerate(parse_table):
+    if reobj in (match_extension, match_part, match_video, match_year, match_sound, match_rip,
+        match_resolution, match_lang):
+      name = key or 'lang'
+      names[name] = names['start_'+name] = row
+      head, value, after = value_parts(reobj.pattern)
+      values.append("(?P<%s>%s)%s" % (name, value, after))
+      if head==r"(^|[_\W])":
+        start_values.append("(?P<start_%s>%s)%s" % (name, value, after))
+    else:
+      parse_steps.append((row, None))
+  match_values = re.compile(scan_pattern(r"^(?=%s)|[_\W](?=%s)" % ("|".join(start_values), "|".join(values))))
+  value_rows = [None]*(match_values.groups+1)
+  for name, group in match_values.groupindex.items():
+    value_rows[group] = names[name]
+  # Parse results stored by a parser with other patterns are not used
+  parser_version = "%d-%s" % (parser_revision, hashlib.md5(repr([reobj.pattern for reobj in (match_extension,
+    match_part, match_part_alt, match_video, match_year, match_sound, match_rip, match_resolution,
+    match_torrent, match_title, match_lang, match_split, match_clean1, match_clean2, match_clean3)])).hexdigest()[:12])
+
+def cut_out(str, cuts):
+  # str with each (start, end) in cuts replaced by a '#', cuts being sorted
+  parts = []
+  last = 0
+  for start, end in cuts:
+    parts.append(str[last:start])
+    last = end
+  parts.append(str[last:])
+  return '#'.join(parts)
+
+def cut_position(cuts, pos):
+  # Where pos in the uncut string is in the cut one, cuts being sorted, for pos not in a cut
+  shift = 0
+  for start, end in cuts:
+    if end>pos:
+      break
+    shift += end-start-1
+  return pos-shift
+
+def uncut_position(cuts, pos):
+  # Where pos in the cut string is in the uncut one, cuts being sorted. A pos on a '#' is where its
+  # cut starts
+  shift = 0
+  for start, end in cuts:
+    if start-shift>=pos:
+      break
+    shift += end-start-1
+  return pos+shift
+
+def parse_component(str):
+  """Returns (found, rest), where found lists (key, value) in the order found and rest is what
+  is left of str after cutting out the values"""
+  counters['parsed_names'] += 1
+  low = str.lower()
+  steps = [(value_rows[m.lastindex], m.span(m.lastindex)) for m in match_values.finditer(low)]
+  if steps:
+    steps.extend(parse_steps)
+    steps.sort() # By row, the first value of a row first
+  else:
+    steps = parse_steps
+  found = []
+  cuts = [] # (start, end) in str of the values cut out, sorted
+  rest = str # str with the cuts cut out, or None until it is needed
+  searches = 1
+  resume = None # The row from which on the table runs over the cut string
+  last = None
+  for row, span in steps:
+    key, reobj, needles, tail = parse_table[row]
+    if span:
+      if row==last:
+        # A value found behind the second value of a row, which isn't cut out, was hidden from
+        # the scan
+        resume = row+1
+        break
+      last = row
+      start, end = span
+      if cuts:
+        if [1 for s, e in cuts if s<end and e>start]:
+          resume = row
           break
-    return str    
+        if reobj is match_sound and [1 for s, e in cuts if s==end+1]:
+          if rest is None:
+            rest = cut_out(str, cuts)
+          searches += 1
+          m = reobj.match(rest, cut_position(cuts, start)-1)
+          end = uncut_position(cuts, m.end('val'))
+    elif reobj is match_part_alt:
+      if rest is None:
+        rest = cut_out(str, cuts)
+      hash = rest.find('#')
+      searches += 1
+      m = reobj.search(rest, max(0, min(len(rest)-3, hash-4 if hash>=0 else len(rest))))
+      if not m:
+        continue
+      start, end = m.span('val')
+      if cuts:
+        start, end = uncut_position(cuts, start), uncut_position(cuts, end)
+    elif reobj:
+      # Its values can start anywhere, so the scan doesn't look for them
+      if needles(low):
+        resume = row
+        break
+      continue
+    else:
+      if rest is None:
+        rest = cut_out(str, cuts)
+      span = find_title(rest)
+      if not span:
+        continue
+      found.append((key, rest[span[0]:span[1]]))
+      rest = rest[:span[0]] + '#' + rest[span[1]:]
+      if cuts:
+        start, end = uncut_position(cuts, span[0]), uncut_position(cuts, span[1])
+        cuts = [(s, e) for s, e in cuts if s<start or e>end] # Not the ones in the title
+        bisect.insort(cuts, (start, end))
+      else:
+        cuts = [span]
+      continue
+    if key:
+      found.append((key, str[start:end]))
+    bisect.insort(cuts, (start, end))
+    rest = None
+  if rest is None:
+    rest = cut_out(str, cuts)
+  if resume is not None:
+    rest, count = parse_rows(rest, found, resume)
+    searches += count
+  counters['regex_searches'] += searches # Only the parser counts these, no lock needed
+  return found, rest
+
+def parse_rows(str, found, row):
+  """Runs the pattern table from row on over str, which has the values of the rows before cut out
+  already, adding the values to found. Returns what is left of str and the searches run"""
+  low = str.lower()
+  searches = 0
+  for key, reobj, needles, tail in parse_table[row:]:
+    if needles and not needles(low):
+      continue
+    if reobj:
+      searches += 1
+      m = reobj.search(str, len(str)-tail if tail and len(str)>tail else 0)
+      if not m:
+        continue
+      start, end = m.span('val')
+    else:
+      span = find_title(str)
+      if not span:
+        continue
+      start, end = span
+    if key:
+      found.append((key, str[start:end]))
+    str = str[:start] + '#' + str[end:]
+    low = low[:start] + '#' + low[end:]
+  return str, searches
+
+def clean_title(title):
+  # Each pattern only runs when title has chars it changes, a single space is left as it is
+  if '.' in title:
+    title = match_clean1.sub(' ', title, 10)
+  if '_' in title or '#' in title or '  ' in title:
+    title = match_clean2.sub(' ', title, 10)
+  if '-' in title:
+    title = match_clean3.sub(' - ', title, 10)
+  return title.strip()
+
+def clean_discarded(part):
+  if '.' in part:
+    part = match_clean1.sub(' ', part, 10)
+  if '_' in part or '#' in part or '  ' in part:
+    part = match_clean2.sub(' ', part, 10)
+  if '-' in part:
+    part = match_clean3.sub(' ', part, 10)
+  return part.strip()
+
+format_renderers = dict()
+
+def format_renderer(format):
+  """Returns a function rendering format with a dict, like Template(format).substitute but as a
+  %-format made once, which is much faster. Formats substitute() raises ValueError for are left
+  to it"""
+  if format not in format_renderers:
+    template = Template(format)
+    parts = []
+    last = 0
+    for m in template.pattern.finditer(format):
+      if m.group('invalid') is not None:
+        parts = None
+        break
+      parts.append(format[last:m.start()].replace('%', '%%'))
+      if m.group('escaped') is not None:
+        parts.append('$')
+      else:
+        parts.append('%%(%s)s' % (m.group('named') or m.group('braced')))
+      last = m.end()
+    if parts is None:
+      format_renderers[format] = template.substitute
+    else:
+      format_renderers[format] = (''.join(parts)+format[last:].replace('%', '%%')).__mod__
+  return format_renderers[format]
 #####################################################
 
+def title_score(title):
+    score = len(title) - len(match_correctcase.sub("",title)) #Number of correct case pairs, e.g. Ab, not ab or AB
+    return score + title.count(" ") # Number of spaces, more are better
+
 def cmp_titles(x, y):
-    xscore = len(x) - len(match_correctcase.sub("",x)) #Number of correct case pairs, e.g. Ab, not ab or AB
-    yscore = len(y) - len(match_correctcase.sub("",y)) # More are better
-    xscore += x.count(" ") # Number of spaces, more are better
-    yscore += y.count(" ")
-    return yscore-xscore
+    return title_score(y)-title_score(x)
 #     print "%s has %i score, %s has %i, returning score %s" % (
 #       x,
 #       len(x) - len(match_correctcase.sub("",x)),
@@ -549,63 +2444,48 @@ def cmp_titles(x, y):
     return score
 #####################################################
 
-def analyze_video_file(components, file):
-  metadata = dict.fromkeys(format_keys.keys())
-  for k in metadata.iterkeys():
-    metadata[k] = []
+def parse_video_file(components, file):
+  """Returns the metadata found in file and the dir names above it, as a dict of format key ->
+  list of values found, most likely first"""
+  metadata = dict([(k, []) for k in format_keys])
   components = list(components)
   components.append(file) 
+  cleaned = dict() # The titles are cleaned again after each component, mostly cleaned ones
   for str in components:
-    #if str==file: #only check extension on the file itself
-    str = match_remove(match_extension, str, metadata, 'ext')
-    
-    str = match_remove(match_part, str, metadata, 'part')
-    str = match_remove(match_part_alt, str, metadata, 'part')
-    str = match_remove(match_video, str, metadata,'video_codec')
-    str = match_remove(match_year, str, metadata, 'year')
-    str = match_remove(match_sound, str, metadata, 'sound_codec')
-    str = match_remove(match_rip, str, metadata, 'rip')    
-    str = match_remove(match_resolution, str, metadata, 'resolution')
-    str = match_remove(match_torrent, str, metadata, 'torrent')
-    str = match_remove(match_title, str, metadata, 'title')
-    str = match_remove(match_lang, str, metadata['lang'])
+    found, discarded = parse_cached(str)
+    for key, val in found:
+      if val not in metadata[key]:
+        # insert first, which means higher priority. Components are parsed from left
+        # to right in path, so means last path component has highest priority
+        metadata[key].insert(0, val)
     
     newtitles = []
     for title in metadata['title']:
-      #print "Before: '%s'" % title
-      title = match_remove(match_clean1, title, replace=' ', max=10)
-      #print "1: '%s'" % title
-      title = match_remove(match_clean2, title, replace=' ', max=10)
-      #print "2: '%s'" % title
-      title = match_remove(match_clean3, title, replace=' - ', max=10)
-      #print "3: '%s'" % title
-      title = title.strip()
-      #title = string.capwords(title)
-      
+      if title not in cleaned:
+        cleaned[title] = clean_cached(title)
+      title = cleaned[title]
       if len(title)>0 and title not in newtitles:
         newtitles.append(title)
-    
     metadata['title'] = newtitles
     
-    parts = match_split.split(str)
-    for part in parts:
-      part = match_remove(match_clean1, part, replace=' ', max=10)
-      #print "1: '%s'" % part
-      part = match_remove(match_clean2, part, replace=' ', max=10)
-      #print "2: '%s'" % part
-      part = match_remove(match_clean3, part, replace=' ', max=10)
-      #print "3: '%s'" % part
-      part = part.strip()
-      if part=='-':
-        print parts
-      if len(part)>0  and part not in metadata['discarded']:
+    for part in discarded:
+      if part not in metadata['discarded']:
         metadata['discarded'].append(part)
   
   if len(metadata['title'])>1:
-    metadata['title'].sort(cmp=cmp_titles)
-#    sorted_titles = sorted(metadata['title'], cmp=cmp_titles)
-    #print "Best title: %s" % sorted_titles[0]
-  
+    metadata['title'].sort(key=title_score, reverse=True) # Stable like sorting by cmp_titles
+  return metadata
+
+def analyze_video_file(components, file, path=None):
+  # Format keys the names don't give are probed from the headers of the video at path, if given
+  metadata = parse_video_file(components, file)
+  if path:
+    missing = [k for k in probed_keys if k in chosen_format_keys and not metadata[k]]
+    if missing:
+      found = probe_cached(path)
+      for k in missing:
+        if k in found:
+          metadata[k] = [found[k]]
   formatdata = dict()
   
   for k in chosen_format_keys:
@@ -622,117 +2502,1058 @@ def analyze_video_file(components, file):
     #TODO incorrect mediaroot, should be only highest dir
     formatdata['mediaroot'] = os.path.join(components, file)   
   
-  # Print only the metadata items that has a value
-  #print "\n%s\n\t%s" % ('/'.join(components), dict([(k,v) for k,v in metadata.iteritems() if len(v)>0]))
-  #print "Meta: %s" % dict([(k, metadata[k]) for k in metadata.iterkeys() if len(metadata[k])>0]) 
-
   if 'ext' in formatdata and metadata['ext'][0] == "VIDEO_TS":
-    template = Template(args.format.replace(".$ext", os.path.sep+"$ext"))
+    render = format_renderer(args.format.replace(".$ext", os.path.sep+"$ext"))
   else:
-    template = Template(args.format)
+    render = format_renderer(args.format)
   
-  #print template.substitute(formatdata) 
-    
-  newpath,newfile = (match_unfilled_format_keys.sub("",template.substitute(formatdata))).rsplit("/", 1)
+  newpath,newfile = (match_unfilled_format_keys.sub("",render(formatdata))).rsplit("/", 1)
   #print "newpath=%s, newfile=%s" % (newpath, newfile)
   return newpath, newfile
 #####################################################
 
+###### RAR ARCHIVES ###############################################
+## Lists what RAR archives hold by reading their headers, skipping over the packed data, instead of
+## running unrar on every archive. Only the first volume of a set is read, it lists the files that
+## start in it, which is all of them for a set made from one video
+
+rar4_signature = 'Rar!\x1a\x07\x00'
+rar5_signature = 'Rar!\x1a\x07\x01\x00'
+rar_listings = dict() # path -> ((mtime, size), members) of archives read before
+
+def read_vint(data, i):
+  # RAR5 variable length integer at data[i], 7 bits per byte, returns (value, index after it)
+  value = 0
+  shift = 0
+  while True:
+    byte = ord(data[i])
+    value |= (byte & 0x7f) << shift
+    i += 1
+    if not byte & 0x80:
+      return value, i
+    shift += 7
+    if shift>63:
+      raise ValueError("vint too long")
+
+def read_rar4(f):
+  members = []
+  while True:
+    pos = f.tell()
+    head = f.read(7)
+    if len(head)<7:
+      return members # Truncated, what was found so far
+    crc, type, flags, size = struct.unpack('<HBHH', head)
+    body = f.read(size-7)
+    if size<7 or len(body)<size-7:
+      return members
+    data = 0
+    if type==0x73 and flags & 0x80:
+      return None # The headers are encrypted
+    elif type==0x74: # File
+      data, unpacked, host, fcrc, ftime, version, method, namelen, attr = struct.unpack_from('<IIBIIBBHI', body)
+      offset = 25
+      if flags & 0x100: # Large file, high 32 bits of the sizes follow
+        high_data, high_unpacked = struct.unpack_from('<II', body, offset)
+        data += high_data << 32
+        unpacked += high_unpacked << 32
+        offset += 8
+      name = body[offset:offset+namelen]
+      if flags & 0x200:
+        name = name.split('\0')[0] # Unicode names come after an ASCII one, or are UTF-8 alone
+      members.append((name.replace('\\', '/'), unpacked, flags & 0xe0==0xe0))
+    elif type==0x7b: # End of archive
+      return members
+    elif flags & 0x8000: # Some data follows the header
+      data = struct.unpack_from('<I', body)[0]
+    f.seek(pos+size+data)
+
+def read_rar5(f):
+  members = []
+  while True:
+    pos = f.tell()
+    head = f.read(7) # CRC32 and the header size, in at most 3 bytes
+    if len(head)<5:
+      return members
+    size, start = read_vint(head, 4)
+    f.seek(pos+start)
+    header = f.read(size)
+    if len(header)<size:
+      return members
+    type, i = read_vint(header, 0)
+    flags, i = read_vint(header, i)
+    data = 0
+    if flags & 1:
+      extra, i = read_vint(header, i)
+    if flags & 2:
+      data, i = read_vint(header, i)
+    if type==4:
+      return None # The headers are encrypted
+    elif type==5:
+      return members
+    elif type==2: # File
+      file_flags, i = read_vint(header, i)
+      unpacked, i = read_vint(header, i)
+      attr, i = read_vint(header, i)
+      if file_flags & 2: # Modification time
+        i += 4
+      if file_flags & 4: # CRC32
+        i += 4
+      compression, i = read_vint(header, i)
+      host, i = read_vint(header, i)
+      namelen, i = read_vint(header, i)
+      members.append((header[i:i+namelen], unpacked, bool(file_flags & 1)))
+    f.seek(pos+start+size+data)
+
+def read_rar(path):
+  """Lists the members of a RAR archive as (name, unpacked size, is_dir) without decompressing
+  anything, or returns None if it is not a RAR archive we can read, e.g. one with encrypted headers"""
+  try:
+    with open(path, 'rb') as f:
+      signature = f.read(8)
+      if signature.startswith(rar5_signature):
+        return read_rar5(f)
+      if signature.startswith(rar4_signature):
+        f.seek(len(rar4_signature))
+        return read_rar4(f)
+  except (IOError, OSError, struct.error, ValueError, IndexError):
+    pass
+  return None
+
+def rar_members(path):
+  # read_rar(), remembered until the archive changes
+  st = cached_stat(path)
+  if st is None:
+    return None
+  key = (st.st_mtime, st.st_size)
+  if path not in rar_listings or rar_listings[path][0]!=key:
+    rar_listings[path] = (key, read_rar(path))
+  return rar_listings[path][1]
+
+def is_first_volume(file):
+  # name.rar or name.part1.rar, not name.part2.rar and on
+  name = file.lower()
+  if not name.endswith('.rar'):
+    return False
+  part = os.path.splitext(name[:-4])[1]
+  return not (part.startswith('.part') and part[5:].isdigit() and int(part[5:])!=1)
+
+def rar_has_media(path):
+  # True if the archive holds a video that would be sorted as one, not a sample
+  for name, size, is_dir in rar_members(path) or []:
+    fname, ext = os.path.splitext(os.path.basename(name))
+    if not is_dir and ext.strip('.').lower() in video_types and not (
+        "sample" in fname.lower() or "trailer" in fname.lower()):
+      return True
+  return False
+
+def media_archives(root, files):
+  """The RAR archives among files in root with media in them, by the name of their first volume"""
+  return [f for f in files if is_first_volume(f) and rar_has_media(os.path.join(root, f))]
+#####################################################
+
+###### DUPLICATES ###############################################
+## A download that is in the media dir already, e.g. downloaded again, is not imported as a copy.
+## Dirs are compared by the sizes of their files first, then by hashes of chunks from the start,
+## middle and end of each file, and only if those are the same by hashes of the whole files.
+## Hashes are kept in the state db by device and inode, and used again while size and mtime are the same
+
+hash_sample_size = 64*1024 # Bytes hashed at the start, middle and end of a file
+hash_map_size = 16*1024*1024 # Bytes mapped at a time, whole big files can't be mapped on 32 bit systems
+
+def map_region(f, offset, length):
+  # (read only mmap of length bytes of the open file f from offset, where offset is in it), as
+  # mappings have to start at a multiple of the allocation granularity. Close it when done
+  start = offset-offset%mmap.ALLOCATIONGRANULARITY
+  return mmap.mmap(f.fileno(), offset-start+length, access=mmap.ACCESS_READ, offset=start), offset-start
+
+def mapped_chunk(f, offset, length):
+  # length bytes of the open file f from offset, mapping only what is needed
+  m, i = map_region(f, offset, length)
+  try:
+    return m[i:]
+  finally:
+    m.close()
+
+def hash_file(path, size, full):
+  """md5 of all of path if full, otherwise of its size and chunks from the start, middle and end"""
+  h = hashlib.md5()
+  if full:
+    chunks = [(i, min(hash_map_size, size-i)) for i in xrange(0, size, hash_map_size)]
+  else:
+    h.update(str(size))
+    chunks = [(i, min(hash_sample_size, size-i)) for i in
+      sorted(set([0, max(0, size/2-hash_sample_size/2), max(0, size-hash_sample_size)])) if i<size]
+  with open(path, 'rb') as f:
+    for offset, length in chunks:
+      h.update(mapped_chunk(f, offset, length))
+      count('bytes_hashed', length)
+  return h.hexdigest()
+
+def file_hash(path, full):
+  """The hash of path as from hash_file, from the hash cache if the file has not changed since"""
+  st = counted_stat(path)
+  db = open_state_db()
+  row = db.execute("SELECT sample, full FROM file_hashes WHERE dev=? AND inode=? AND size=? AND mtime=?",
+    (st.st_dev, st.st_ino, st.st_size, st.st_mtime)).fetchone()
+  sample, whole = row or (None, None)
+  if (whole if full else sample) is None:
+    if full:
+      whole = hash_file(path, st.st_size, True)
+    else:
+      sample = hash_file(path, st.st_size, False)
+    db.execute("INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?, ?, ?)",
+      (st.st_dev, st.st_ino, st.st_size, st.st_mtime, sample, whole))
+  return whole if full else sample
+
+def tree_sizes(top):
+  # Path relative to top -> size, for all files in top
+  sizes = dict()
+  for root, dirs, files in scan_walk(top):
+    for f in files:
+      st = cached_stat(os.path.join(root, f))
+      sizes[os.path.relpath(os.path.join(root, f), top)] = st.st_size if st else -1
+  return sizes
+
+def same_tree(a, b):
+  """True if the dirs a and b have the same files with the same contents"""
+  sizes = tree_sizes(a)
+  if not sizes or sizes!=tree_sizes(b):
+    return False
+  try:
+    for full in False, True: # All samples first, a whole file is only read if all samples are the same
+      for name in sorted(sizes):
+        pa, pb = os.path.join(a, name), os.path.join(b, name)
+        if not counted_samefile(pa, pb) and file_hash(pa, full)!=file_hash(pb, full):
+          return False
+    return True
+  except (OSError, IOError, ValueError) as e: # ValueError from mmap if a file shrinks
+    print "WARNING, could not compare %s and %s: %s" % (a, b, e)
+    return False
+  finally:
+    open_state_db().commit()
+
+def import_duplicate(orig_root, existing):
+  # Leaves orig_root where it is, or has its files hard link to those in existing
+  print "Not importing %s, it is in the media dir already as %s" % (orig_root, existing)
+  if args.duplicates!='link':
+    return
+  if cached_stat(orig_root).st_dev!=cached_stat(existing).st_dev:
+    print "Can't hard link %s to %s, they are on different volumes" % (orig_root, existing)
+    return
+  for name in sorted(tree_sizes(orig_root)):
+    if not counted_samefile(os.path.join(existing, name), os.path.join(orig_root, name)):
+      queue_cmd(link_cmd, os.path.join(existing, name), os.path.join(orig_root, name))
+#####################################################
+
 def has_media(files, path, orig_root):
-  rarfiles = fnmatch.filter(files, "*.rar")
-  extracted_files = False
-  # If there are rar file, find out if they contain media
-#   for rarfile in rarfiles:
-#     queue_cmd(rarlist_cmd, os.path.join(path, rarfile))
-#     results,retcode = pop_cmd()
-# #    print results
-#     c = 0
-#     maxc = 50
-#     for ext in match_fileext_in_results.findall(results):
-#       c+=1
-#       if c>maxc: # in case of very many files, break after 50
-#         break
-# #      print ext
-#       if ext.lower() in video_types:
-#         #Exract rar to same dir
-#         queue_cmd(unrar_cmd, os.path.join(path, rarfile), path)
-#         pop_cmd()
-#         extracted_files = True
-#         break
-#   if extracted_files:
-#     files = [f for f in os.listdir(root) if os.path.isfile(f)]
-#     print "New files in %s: %s" (path, files)
+  """Moves orig_root to the media dir if path has video files in it, or archives with video in
+  them, which are extracted when it is sorted. Not if the same files are in the media dir already"""
   for file in files:
     fname, ext = os.path.splitext(file)
     ext = ext.strip('.').lower()
     if ext in video_types: #a file in dir has right extension
-      # Move the whole directory tree from its root
-      # make sure we can't overwrite anything
-      dirname = os.path.basename(orig_root)
-      while os.path.exists(os.path.join(args.media_dir, dirname)):
-        dirname="copy_"+dirname
-      move(orig_root, os.path.join(args.media_dir, dirname))
+      break
+  else:
+    if not media_archives(path, files):
+      return False
+  # Move the whole directory tree from its root
+  # make sure we can't overwrite anything
+  dirname = os.path.basename(orig_root)
+  while path_taken(os.path.join(args.media_dir, dirname)):
+    existing = os.path.join(args.media_dir, dirname)
+    if args.duplicates!='import' and existing not in planned_paths and same_tree(orig_root, existing):
+      import_duplicate(orig_root, existing)
       return True
-  return False
+    dirname="copy_"+dirname
+  move(os.path.dirname(orig_root), os.path.basename(orig_root), args.media_dir, dirname)
+  planned_paths[os.path.join(args.media_dir, dirname)] = orig_root
+  return True
 #####################################################
 
-def fnmatch_multi(file, patterns):
-  f = file.lower()
-  for p in patterns:
-    if fnmatch.fnmatch(f, p):
-      return True
-  return False
+###### MEDIA HEADERS ###############################################
+## The video codec, resolution and sound codec of a video whose names don't tell are read from its
+## container headers: the Tracks of an MKV, the moov atom of an MP4 or M4V, which is often at the
+## end of the file, and the stream headers of an AVI. Only the pages holding them are mapped, so
+## a video on a network mount is not read through. What was found is kept in the state db by
+## device and inode, and used again while size and mtime are the same
+
+probe_version = 1 # Cached results of other versions are probed again
+probe_head_size = 256*1024 # Bytes mapped from the start of a file, MKV and AVI headers are in them
+probe_atom_max = 16*1024*1024 # Biggest MKV Tracks or MP4 moov read
+probed_keys = ('video_codec', 'resolution', 'sound_codec')
+probe_cache_new = [] # (dev, inode, size, mtime, version, marshalled result) probed since last saved
+
+# MKV CodecID, MP4 sample entry type or AVI fourcc (upper cased) -> name as in release names
+video_codec_names = {
+  'V_MPEG4/ISO/AVC': 'h264', 'V_MPEGH/ISO/HEVC': 'HEVC', 'V_MPEG4/ISO/ASP': 'MPEG4', 'V_MPEG2': 'mpeg2',
+  'V_VP8': 'VP8', 'V_VP9': 'VP9', 'V_AV1': 'AV1',
+  'avc1': 'h264', 'avc3': 'h264', 'hvc1': 'HEVC', 'hev1': 'HEVC', 'mp4v': 'MPEG4', 'av01': 'AV1',
+  'XVID': 'XviD', 'DIVX': 'DivX', 'DX50': 'DivX', 'DIV3': 'DivX', 'FMP4': 'MPEG4', 'MP4V': 'MPEG4',
+  'H264': 'h264', 'AVC1': 'h264', 'X264': 'x264', 'MPG2': 'mpeg2',
+}
+# MKV CodecID, MP4 sample entry type or AVI wFormatTag -> name as in release names
+sound_codec_names = {
+  'A_AC3': 'AC3', 'A_EAC3': 'EAC3', 'A_DTS': 'DTS', 'A_AAC': 'AAC', 'A_MPEG/L3': 'Mp3', 'A_MPEG/L2': 'MP2',
+  'A_TRUEHD': 'TrueHD', 'A_FLAC': 'FLAC', 'A_VORBIS': 'Vorbis', 'A_OPUS': 'Opus',
+  'mp4a': 'AAC', 'ac-3': 'AC3', 'ec-3': 'EAC3', 'dtsc': 'DTS', '.mp3': 'Mp3',
+  0x55: 'Mp3', 0x50: 'MP2', 0x2000: 'AC3', 0x2001: 'DTS', 0xFF: 'AAC', 0x1610: 'AAC',
+}
+channel_names = {6: '5.1', 7: '6.1', 8: '7.1'}
+
+def ebml_vint(m, i, strip):
+  # (value, end) of the EBML variable length int at i, with its length marker stripped for sizes
+  first = ord(m[i])
+  length = 1
+  while length<=8 and not first & (0x80>>(length-1)):
+    length += 1
+  if length>8:
+    raise ValueError("Bad EBML int at %d" % i)
+  value = first & (0xFF>>length) if strip else first
+  for c in m[i+1:i+length]:
+    value = value<<8 | ord(c)
+  return value, i+length
+
+def ebml_elements(m, start, end):
+  # (id, data start, data end) of the EBML elements from start, data end as in the file
+  while start<end:
+    eid, i = ebml_vint(m, start, False)
+    size, j = ebml_vint(m, i, True)
+    if size==(1<<7*(j-i))-1: # Unknown, e.g. of a segment being written, it lasts to the end
+      size = end-j
+    yield eid, j, j+size
+    start = j+size
+
+def ebml_uint(m, start, end):
+  value = 0
+  for c in m[start:end]:
+    value = value<<8 | ord(c)
+  return value
+
+def mkv_tracks(m, start, end):
+  # The codec, size and channels of the first video and sound tracks in Tracks
+  streams = dict()
+  for eid, s, e in ebml_elements(m, start, end):
+    if eid!=0xAE: # TrackEntry
+      continue
+    kind = codec = None
+    numbers = dict()
+    for tid, s2, e2 in ebml_elements(m, s, e):
+      if tid==0x83: # TrackType
+        kind = ebml_uint(m, s2, e2)
+      elif tid==0x86: # CodecID
+        codec = m[s2:e2].rstrip('\0')
+      elif tid in (0xE0, 0xE1): # Video, Audio
+        for nid, s3, e3 in ebml_elements(m, s2, e2):
+          if nid in (0xB0, 0xBA, 0x9F): # PixelWidth, PixelHeight, Channels
+            numbers[nid] = ebml_uint(m, s3, e3)
+    if kind==1 and 'video' not in streams:
+      streams.update(video=codec, width=numbers.get(0xB0), height=numbers.get(0xBA))
+    elif kind==2 and 'audio' not in streams:
+      streams.update(audio=codec, channels=numbers.get(0x9F))
+  return streams
+
+def probe_mkv(f, size, head):
+  # Tracks are found in the segment before the first Cluster, or where the SeekHead says
+  segment = None
+  for eid, s, e in ebml_elements(head, 0, len(head)):
+    if eid==0x18538067: # Segment
+      segment = s
+      break
+  if segment is None:
+    return None
+  tracks = None
+  for eid, s, e in ebml_elements(head, segment, len(head)):
+    if eid==0x1654AE6B: # Tracks
+      if e<=len(head):
+        return mkv_tracks(head, s, e)
+      tracks = s-segment
+      break
+    if eid==0x114D9B74: # SeekHead
+      tracks = mkv_seek(head, s, min(e, len(head)), 0x1654AE6B)
+    if eid==0x1F43B675 or e>=len(head): # Cluster, the frames are after the headers
+      break
+  if tracks is None or segment+tracks>=size:
+    return None
+  m, i = map_region(f, segment+tracks, min(probe_atom_max, size-segment-tracks))
+  try:
+    eid, s, e = next(ebml_elements(m, i, len(m)))
+    return mkv_tracks(m, s, min(e, len(m))) if eid==0x1654AE6B else None
+  finally:
+    m.close()
+
+def mkv_seek(m, start, end, wanted):
+  # Position in the segment of the element with id wanted from a SeekHead, None if not in it
+  for eid, s, e in ebml_elements(m, start, end):
+    if eid==0x4DBB: # Seek
+      seek = dict((sid, ebml_uint(m, s2, e2)) for sid, s2, e2 in ebml_elements(m, s, e))
+      if seek.get(0x53AB)==wanted: # SeekID
+        return seek.get(0x53AC) # SeekPosition
+  return None
+
+def mp4_atoms(m, start, end):
+  # (type, data start, data end) of the atoms from start
+  while start+8<=end:
+    size, kind = struct.unpack_from('>I4s', m, start)
+    header = 8
+    if size==1:
+      size, header = struct.unpack_from('>Q', m, start+8)[0], 16
+    elif size==0:
+      size = end-start
+    if size<header:
+      return
+    yield kind, start+header, min(start+size, end)
+    start += size
+
+def mp4_child(m, start, end, path):
+  # (data start, data end) of the atom found by following the types in path, None if there is none
+  for kind in path:
+    for k, s, e in mp4_atoms(m, start, end):
+      if k==kind:
+        start, end = s, e
+        break
+    else:
+      return None
+  return start, end
+
+def mp4_moov(m, start, end):
+  # The codec, size and channels of the first video and sound traks
+  streams = dict()
+  for kind, s, e in mp4_atoms(m, start, end):
+    if kind!='trak':
+      continue
+    hdlr = mp4_child(m, s, e, ['mdia', 'hdlr'])
+    stsd = mp4_child(m, s, e, ['mdia', 'minf', 'stbl', 'stsd'])
+    if not hdlr or not stsd:
+      continue
+    handler = m[hdlr[0]+8:hdlr[0]+12]
+    entry = stsd[0]+8 # After version, flags and entry count
+    codec = m[entry+4:entry+8]
+    if handler=='vide' and 'video' not in streams:
+      width, height = struct.unpack_from('>HH', m, entry+32)
+      streams.update(video=codec, width=width, height=height)
+    elif handler=='soun' and 'audio' not in streams:
+      streams.update(audio=codec, channels=struct.unpack_from('>H', m, entry+24)[0])
+  return streams
+
+def probe_mp4(f, size):
+  # The top level atoms are walked by their headers to the moov, wherever it is
+  offset = 0
+  while offset+8<=size:
+    m, i = map_region(f, offset, min(16, size-offset))
+    try:
+      atom_size, kind = struct.unpack_from('>I4s', m, i)
+      header = 8
+      if atom_size==1:
+        atom_size, header = struct.unpack_from('>Q', m, i+8)[0], 16
+    finally:
+      m.close()
+    if atom_size==0:
+      atom_size = size-offset
+    if atom_size<header:
+      return None
+    if kind=='moov':
+      m, i = map_region(f, offset, min(atom_size, probe_atom_max, size-offset))
+      try:
+        return mp4_moov(m, i+header, len(m))
+      finally:
+        m.close()
+    offset += atom_size
+  return None
+
+def riff_chunks(m, start, end):
+  # (id, data start, data end) of the RIFF chunks from start, which are padded to even sizes
+  while start+8<=end:
+    cid, size = struct.unpack_from('<4sI', m, start)
+    yield cid, start+8, min(start+8+size, end)
+    start += 8+size+(size&1)
+
+def probe_avi(m):
+  # The stream headers are in the hdrl list, one strl list with a strh and strf per stream
+  streams = dict()
+  for cid, s, e in riff_chunks(m, 12, len(m)):
+    if cid!='LIST' or m[s:s+4]!='hdrl':
+      continue
+    for cid, s2, e2 in riff_chunks(m, s+4, e):
+      if cid!='LIST' or m[s2:s2+4]!='strl':
+        continue
+      chunks = dict((c, s3) for c, s3, e3 in riff_chunks(m, s2+4, e2))
+      if 'strh' not in chunks or 'strf' not in chunks:
+        continue
+      kind = m[chunks['strh']:chunks['strh']+4]
+      if kind=='vids' and 'video' not in streams: # strf is a BITMAPINFOHEADER
+        width, height, fourcc = struct.unpack_from('<4xii4x4s', m, chunks['strf'])
+        streams.update(video=fourcc.upper(), width=width, height=abs(height))
+      elif kind=='auds' and 'audio' not in streams: # strf is a WAVEFORMATEX
+        tag, channels = struct.unpack_from('<HH', m, chunks['strf'])
+        streams.update(audio=tag, channels=channels)
+    break
+  return streams
+
+def resolution_name(width, height):
+  if width>=3800 or height>=2100:
+    return '2160p'
+  if width>=1900 or height>=1060:
+    return '1080p'
+  if width>=1260 or height>=700:
+    return '720p'
+  return '%dp' % height if height else None
+
+def probe_file(path, size):
+  """Format keys found in the headers of the video path, e.g. {'video_codec': 'h264', 'resolution':
+  '1080p', 'sound_codec': 'AC3 5.1'}. Empty if it's not an MKV, MP4 or AVI or they can't be read"""
+  found = dict()
+  if size<16:
+    return found
+  count('headers_probed')
+  try:
+    with open(path, 'rb') as f:
+      head, i = map_region(f, 0, min(probe_head_size, size))
+      try:
+        if head[:4]=='\x1a\x45\xdf\xa3': # EBML
+          streams = probe_mkv(f, size, head)
+        elif head[4:8]=='ftyp':
+          streams = probe_mp4(f, size)
+        elif head[:4]=='RIFF' and head[8:12]=='AVI ':
+          streams = probe_avi(head)
+        else:
+          streams = None
+      finally:
+        head.close()
+  except (EnvironmentError, ValueError, IndexError, struct.error), e:
+    print "Can't read the headers of %s: %s" % (path, e)
+    return found
+  if not streams:
+    return found
+  codec = streams.get('video')
+  name = video_codec_names.get(codec)
+  if name:
+    found['video_codec'] = name
+  resolution = resolution_name(streams.get('width') or 0, streams.get('height') or 0)
+  if resolution:
+    found['resolution'] = resolution
+  codec = streams.get('audio')
+  name = sound_codec_names.get(codec)
+  if name is None and isinstance(codec, str): # e.g. A_AAC/MPEG4/LC
+    name = sound_codec_names.get(codec.split('/')[0])
+  if name:
+    channels = channel_names.get(streams.get('channels'))
+    found['sound_codec'] = name+' '+channels if channels else name
+  return found
+
+def probe_cached(path):
+  """probe_file(path), from the state db if the file has not changed since it was probed"""
+  st = cached_stat(path)
+  if st is None or not stat.S_ISREG(st.st_mode):
+    return dict()
+  key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime, probe_version)
+  if not args.full_rescan:
+    row = open_state_db().execute("SELECT result FROM media_headers WHERE dev=? AND inode=? AND "
+      "size=? AND mtime=? AND version=?", key).fetchone()
+    if row:
+      return marshal.loads(row[0])
+  found = probe_file(path, st.st_size)
+  probe_cache_new.append(key+(marshal.dumps(found),))
+  return found
+
+def save_probe_cache():
+  if probe_cache_new:
+    db = open_state_db()
+    db.executemany("INSERT OR REPLACE INTO media_headers VALUES (?, ?, ?, ?, ?, ?)",
+      [row[:5]+(buffer(row[5]),) for row in probe_cache_new])
+    db.commit()
+    del probe_cache_new[:]
+#####################################################
+
+###### RULES ###############################################
+## The keep, delete and noimport patterns are compiled once into one matcher per kind of rule,
+## instead of trying every pattern with fnmatch for every file. Patterns of the form *.ext are
+## looked up by extension in a dict, the rest are joined into one regex
+
+def compile_rules(rules):
+  """rules is a list of (name, fnmatch patterns), most important first. Returns a function taking a
+  file name and returning the name of the first rules it matches, or None"""
+  names = [name for name, patterns in rules]
+  by_ext = dict() # '.ext' -> index of the first rules with *.ext
+  groups = []
+  for i, (name, patterns) in enumerate(rules):
+    regexes = []
+    for p in patterns:
+      if p.startswith('*.') and len(p)>2 and not [c for c in p[2:] if c in '*?[.']:
+        by_ext.setdefault(p[1:], i)
+      else:
+        regex = fnmatch.translate(p)
+        if regex.endswith('(?ms)'):
+          regex = regex[:-5]
+        regexes.append(regex)
+    if regexes:
+      groups.append("(?P<r%d>%s)" % (i, '|'.join(regexes)))
+  match = re.compile('|'.join(groups), re.S).match if groups else None
+  def classify(file):
+    i = file.rfind('.')
+    found = by_ext.get(file[i:]) if i>=0 else None
+    if found!=0 and match:
+      m = match(file)
+      if m and (found is None or int(m.lastgroup[1:])<found):
+        found = int(m.lastgroup[1:])
+    return None if found is None else names[found]
+  return classify
+#####################################################
+
+###### TIMINGS ###############################################
+## Seconds spent in each phase, summed over the run. Planning is everything done in the media
+## roots found by the walk, so it includes parsing. Also counts of what tends to make a run slow,
+## and how long each kind of command took, which --profile and --prometheus write out
+
+phase_times = dict()
+counters = dict.fromkeys(['stats', 'listdirs', 'regex_searches', 'parsed_names', 'subprocesses',
+  'renames', 'bytes_copied', 'bytes_hashed', 'headers_probed', 'ops_optimized', 'agent_entries'], 0)
+latency_buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0, 120.0) # Seconds
+latencies = dict() # Kind of command -> [count in each bucket and above the last, sum of seconds]
+profile_lock = thread.allocate_lock() # Commands run in worker threads too
+
+def add_time(phase, started):
+  phase_times[phase] = phase_times.get(phase, 0.0) + time.time()-started
+
+def count(counter, n=1):
+  with profile_lock:
+    counters[counter] += n
+
+def observe(kind, started):
+  # A command of this kind (see cmd_kind) that started at started has finished
+  seconds = time.time()-started
+  with profile_lock:
+    if kind not in latencies:
+      latencies[kind] = [[0]*(len(latency_buckets)+1), 0.0]
+    latencies[kind][0][bisect.bisect_left(latency_buckets, seconds)] += 1
+    latencies[kind][1] += seconds
+
+def profile():
+  """Returns the phase times, counters and latency histograms, with the number of commands that
+  took at most each bucket's seconds"""
+  histograms = dict()
+  for kind, (buckets, seconds) in latencies.iteritems():
+    cumulative = [sum(buckets[:i+1]) for i in range(len(buckets))]
+    histograms[kind] = {'count': cumulative[-1], 'sum': seconds,
+      'buckets': dict(zip([str(b) for b in latency_buckets]+['+Inf'], cumulative))}
+  return {'phases': phase_times, 'counters': counters, 'latency': histograms, 'parse_cache': parse_cache_stats}
+
+def prometheus_text(summary):
+  # The text format node_exporter reads from its textfile collector dir
+  lines = ['# HELP mediasorter_phase_seconds Seconds the last run spent in each phase',
+    '# TYPE mediasorter_phase_seconds gauge']
+  lines.extend('mediasorter_phase_seconds{phase="%s"} %r' % item for item in sorted(summary['phases'].items()))
+  for name, value in sorted(summary['counters'].items()):
+    lines.append('# HELP mediasorter_%s Number of %s in the last run' % (name, name.replace('_', ' ')))
+    lines.append('# TYPE mediasorter_%s gauge' % name)
+    lines.append('mediasorter_%s %d' % (name, value))
+  lines.append('# HELP mediasorter_parse_cache Names found in memory, in the db or parsed in the last run')
+  lines.append('# TYPE mediasorter_parse_cache gauge')
+  lines.extend('mediasorter_parse_cache{result="%s"} %d' % item for item in sorted(summary['parse_cache'].items()))
+  lines.append('# HELP mediasorter_command_seconds Seconds each command of the last run took, by kind')
+  lines.append('# TYPE mediasorter_command_seconds histogram')
+  for kind, histogram in sorted(summary['latency'].items()):
+    for le in [str(b) for b in latency_buckets]+['+Inf']:
+      lines.append('mediasorter_command_seconds_bucket{kind="%s",le="%s"} %d' % (kind, le, histogram['buckets'][le]))
+    lines.append('mediasorter_command_seconds_sum{kind="%s"} %r' % (kind, histogram['sum']))
+    lines.append('mediasorter_command_seconds_count{kind="%s"} %d' % (kind, histogram['count']))
+  lines.append('# HELP mediasorter_last_run_timestamp_seconds When the last run finished')
+  lines.append('# TYPE mediasorter_last_run_timestamp_seconds gauge')
+  lines.append('mediasorter_last_run_timestamp_seconds %d' % time.time())
+  return '\n'.join(lines)+'\n'
+
+def save_timings():
+  import json
+  if args.timings:
+    with open(args.timings, 'w') as f:
+      json.dump(phase_times, f, indent=2, sort_keys=True)
+  if args.profile:
+    with open(args.profile, 'w') as f:
+      json.dump(profile(), f, indent=2, sort_keys=True)
+  if args.prometheus:
+    # Written whole and renamed into place, so the collector never reads half a file
+    with open(args.prometheus+'.tmp', 'w') as f:
+      f.write(prometheus_text(profile()))
+    os.rename(args.prometheus+'.tmp', args.prometheus)
 #####################################################
-   
-if args.import_dirs:    
+
+###### STATE DB ###############################################
+## SQLite file keeping what we learned between runs
+
+state_db_schema = [
+  '''CREATE TABLE IF NOT EXISTS scan_index (
+    root TEXT PRIMARY KEY, config TEXT, components TEXT, mtime REAL, ctime REAL, files TEXT,
+    destinations TEXT)''',
+  '''CREATE TABLE IF NOT EXISTS parse_cache (
+    component TEXT, version TEXT, result BLOB, PRIMARY KEY (component, version))''',
+  '''CREATE TABLE IF NOT EXISTS subs_missing (
+    file TEXT, langs TEXT, searched REAL, PRIMARY KEY (file, langs))''',
+  '''CREATE TABLE IF NOT EXISTS file_hashes (
+    dev INTEGER, inode INTEGER, size INTEGER, mtime REAL, sample TEXT, full TEXT, PRIMARY KEY (dev, inode))''',
+  '''CREATE TABLE IF NOT EXISTS media_headers (
+    dev INTEGER, inode INTEGER, size INTEGER, mtime REAL, version INTEGER, result BLOB, PRIMARY KEY (dev, inode))''',
+]
+state_db = None
+
+def open_state_db():
+  global state_db
+  if not state_db:
+    import sqlite3
+    state_db = sqlite3.connect(args.db)
+    state_db.text_factory = str # Paths are bytes, keep them that way
+    for statement in state_db_schema:
+      state_db.execute(statement)
+  return state_db
+
+def close_state_db():
+  # Commits and closes the connection, e.g. before forking as it can't be shared with the
+  # child processes. The next open_state_db() opens it again
+  global state_db
+  if state_db:
+    state_db.commit()
+    state_db.close()
+    state_db = None
+#####################################################
+
+###### SCAN INDEX ###############################################
+## Media roots found already sorted, with the mtime and ctime of their dir at the time. If neither
+## has changed, the dir has no new, removed or renamed entries, so it can be skipped without listing it
+
+scan_index_new = [] # Rows of roots found sorted since last saved to the db
+
+def scan_config():
+  # Everything except the dir itself that decides what happens to a media root
+  return hashlib.md5(repr((args.format, sorted(args.exclude), args.keepfiles, args.deletefiles,
+    args.subs))).hexdigest()
+
+def load_scan_index():
+  global scan_index, scan_index_seen
+  scan_index = dict()
+  scan_index_seen = set()
+  for root, components, mtime, ctime in open_state_db().execute(
+      "SELECT root, components, mtime, ctime FROM scan_index WHERE config=?", (scan_config(),)):
+    scan_index[root] = (components, mtime, ctime)
+  return scan_index
+
+def scan_index_unchanged(root):
+  """Returns the ctime of root if it is an indexed media root that has not changed, otherwise None"""
+  import json
+  if args.full_rescan or root not in scan_index:
+    return None
+  components, mtime, ctime = scan_index[root]
+  st = cached_stat(root)
+  if st is None:
+    return None
+  if st.st_mtime!=mtime or st.st_ctime!=ctime or json.loads(components)!=media_components(root):
+    return None
+  scan_index_seen.add(root)
+  return ctime
+
+def index_sorted_root(root, components, files, destinations):
+  import json
+  st = cached_stat(root)
+  scan_index_new.append((root, scan_config(), json.dumps(components), st.st_mtime, st.st_ctime,
+    json.dumps(files), json.dumps(destinations)))
+  scan_index[root] = (json.dumps(components), st.st_mtime, st.st_ctime)
+  scan_index_seen.add(root)
+
+def save_scan_index(top):
+  # Drop roots in top that have gone away or were found needing changes
+  gone = [root for root in scan_index if root not in scan_index_seen and
+    (top==args.media_dir or root==top or root.startswith(top+os.path.sep))]
+  for root in gone:
+    del scan_index[root]
+  db = open_state_db()
+  db.executemany("INSERT OR REPLACE INTO scan_index VALUES (?, ?, ?, ?, ?, ?, ?)", scan_index_new)
+  db.executemany("DELETE FROM scan_index WHERE root=?", [(root,) for root in gone])
+  db.commit()
+  del scan_index_new[:]
+  scan_index_seen.clear()
+#####################################################
+
+###### PARSE CACHE ###############################################
+## A season dir of 24 episodes would otherwise parse the dir names above them 24 times, and every run
+## would parse the same names again. Parsed components and cleaned titles are kept in memory,
+## and parsed components also in the state db, keyed by the parser version so that changing a
+## pattern parses everything again.
+## The memory caches are pairs of dicts, recent and older. When recent is full it becomes older and
+## what was in older is dropped, unless it was used since and so moved to recent. This keeps the
+## recently used like an LRU would, with plain dict operations, which OrderedDict is much slower than
+
+parse_cache = (dict(), dict()) # component -> (found, discarded)
+clean_cache = (dict(), dict()) # title -> cleaned title
+parse_cache_stats = dict(hits=0, db_hits=0, misses=0)
+parse_cache_new = [] # (component, version, marshalled result) parsed since last saved to the db
+parse_cache_pruned = False
+
+def lru_get(cache, key):
+  # Returns the value, or None if not cached
+  recent, older = cache
+  value = recent.get(key)
+  if value is None:
+    value = older.pop(key, None)
+    if value is not None:
+      lru_put(cache, key, value)
+  return value
+
+def lru_put(cache, key, value):
+  recent, older = cache
+  if len(recent)>=args.parse_cache:
+    older.clear()
+    older.update(recent)
+    recent.clear()
+  recent[key] = value
+
+def parse_cached(str):
+  """Returns (found, discarded) for a path component, where found is as from parse_component
+  and discarded are the cleaned parts left after it"""
+  result = None
+  if args.parse_cache>0:
+    result = lru_get(parse_cache, str)
+    if result is not None:
+      parse_cache_stats['hits'] += 1
+      return result
+    if not args.full_rescan:
+      row = open_parse_cache().execute("SELECT result FROM parse_cache WHERE component=? AND version=?",
+        (str, parser_version)).fetchone()
+      if row:
+        result = marshal.loads(row[0])
+        parse_cache_stats['db_hits'] += 1
+  if result is None:
+    parse_cache_stats['misses'] += 1
+    found, rest = parse_component(str)
+    discarded = []
+    for part in match_split.split(rest):
+      if not part:
+        continue
+      part = clean_discarded(part)
+      if len(part)>0 and part not in discarded:
+        discarded.append(part)
+    result = (found, discarded)
+    if args.parse_cache>0:
+      parse_cache_new.append((str, parser_version, marshal.dumps(result)))
+  if args.parse_cache>0:
+    lru_put(parse_cache, str, result)
+  return result
+
+def clean_cached(title):
+  if args.parse_cache<=0:
+    return clean_title(title)
+  cleaned = lru_get(clean_cache, title)
+  if cleaned is None:
+    cleaned = clean_title(title)
+    lru_put(clean_cache, title, cleaned)
+  return cleaned
+
+def open_parse_cache():
+  # Rows of older parser versions will never be read again
+  global parse_cache_pruned
+  db = open_state_db()
+  if not parse_cache_pruned:
+    db.execute("DELETE FROM parse_cache WHERE version!=?", (parser_version,))
+    parse_cache_pruned = True
+  return db
+
+def save_parse_cache():
+  if parse_cache_new:
+    db = open_parse_cache()
+    db.executemany("INSERT OR REPLACE INTO parse_cache VALUES (?, ?, ?)",
+      [(str, version, buffer(result)) for str, version, result in parse_cache_new])
+    db.commit()
+    del parse_cache_new[:]
+  print "Parse cache: %(hits)d hits, %(db_hits)d from db, %(misses)d parsed" % parse_cache_stats
+#####################################################
+
+def media_components(root):
+  # Dir names from root and up, as long as the parent only holds this and maybe one more media dir
+  components = []
+  (path, dir) = os.path.split(root)
+  components.append(dir)
+  while path != args.media_dir and dir_count(path)<3:
+    (path, dir) = os.path.split(path)
+    components.append(dir)
+  return components
+
+def dir_count(path):
+  # Number of subdirs the walk goes into, counted here if the walk started below path
+  if path not in dircount_cache:
+    dircount_cache[path] = len([d for d in scan_dir(path)[0] if d not in excluded and d!="VIDEO_TS"])
+  return dircount_cache[path]
+#####################################################
+
+def import_subdir(import_dir, subdir):
+  for path,subsubdirs,files in scan_walk(os.path.join(import_dir,subdir)):
+    subsubdirs[:] = [ssd for ssd in subsubdirs if os.path.join(path, ssd) not in noimport_paths and
+      not noimport_rules(ssd)]
+    files = [f for f in files if not noimport_rules(f)]
+    if has_media(files, path, os.path.join(import_dir,subdir)):
+      #print "Found video in %s, breaking" % root
+      break # Don't traverse deeper once we know this contained video
+
+def import_media(only=None):
+  """Moves dirs containing media from the import dirs to the media dir. If only is given, it is a
+  set of (import_dir, subdir) and other subdirs are left for later"""
+  started = time.time()
+  reset_stat_cache()
   for import_dir in args.import_dirs:
-    subdirs = [d for d in os.listdir(import_dir) if os.path.isdir(os.path.join(import_dir,d)) and 
-      (d+".torrent" not in files_downloading) and (os.path.join(import_dir,d) not in args.noimport)]
-    for filter in noimport_filters:
-      subdirs = [d for d in subdirs if not fnmatch.fnmatch(d, filter)]
+    subdirs = [d for d in scan_dir(import_dir)[0] if not is_downloading(d) and
+      (os.path.join(import_dir,d) not in noimport_paths) and not noimport_rules(d)]
     
     for subdir in subdirs:
-      for path,subsubdirs,files in os.walk(os.path.join(import_dir,subdir)):
-        subsubdirs[:] = [ssd for ssd in subsubdirs if os.path.join(path, ssd) not in args.noimport]
-        for filter in noimport_filters:
-          subsubdirs[:]= [ssd for ssd in subsubdirs if not fnmatch.fnmatch(ssd, filter)]
-          files = [f for f in files if not fnmatch.fnmatch(f, filter)]
-        if has_media(files, path, os.path.join(import_dir,subdir)):
-          #print "Found video in %s, breaking" % root
-          break # Don't traverse deeper once we know this contained video
+      if only is None or (import_dir, subdir) in only:
+        import_subdir(import_dir, subdir)
+  add_time('import', started)
+  started = time.time()
   flush_cmds()
   init_cmds()
+  add_time('flush', started)
+#####################################################
 
-recent_videos = []
+recent_videos = [] # Recently added media roots that are where they will stay, see update_recent_view()
 no_subs_videos = []
 
 dircount_cache = dict()
 
-recent_limit = timedelta(weeks=4)
-reverse_moves = dict()
+recent_limit = timedelta(weeks=4) # Set by configure() from args.recent_weeks
+scan_index = None
+
+def sort_media(top, flush=True):
+  """Sorts all media roots in top, which is the media dir or a dir in it. Unless flush is False,
+  runs the queued commands"""
+  global recent_videos, no_subs_videos, dircount_cache
+  recent_videos = []
+  no_subs_videos = []
+  dircount_cache = dict()
+  reset_stat_cache()
+  if scan_index is None:
+    load_scan_index()
+  if args.scan_agent:
+    scan_agent_walk(top)
+  try:
+    if args.scan_jobs>1:
+      sort_sharded(top)
+    else:
+      sort_walk(top)
+    started = time.time()
+    finish_background()
+    add_time('background', started)
+  finally:
+    stop_background()
+  save_scan_index(top)
+  save_parse_cache()
+  save_probe_cache()
+  if args.recent_weeks>0:
+    update_recent_view(top)
+  print "No subs: %s" % no_subs_videos
+  if flush:
+    started = time.time()
+    flush_cmds() # run all queued commands
+    init_cmds()
+    add_time('flush', started)
+
+def sort_walk(top):
+  # Sorts the media roots in top as the walk finds them
+  started = time.time()
+  for root, dirs, files in scan_walk(top):
+    add_time('walk', started)
+    started = time.time()
+    sort_dir(root, dirs, files)
+    add_time('plan', started)
+    started = time.time()
+  add_time('walk', started)
+#####################################################
+
+###### RECENT VIEW ###############################################
+## A dir in the media dir with a symlink to each media root added in the last args.recent_weeks
+## weeks, as found by the walk in recent_videos from the ctimes it has already, in the scan index
+## or the stat cache. Roots that are being moved are linked by the run that finds them sorted.
+## The links there are compared with those wanted, and only what differs is made or removed
+
+recent_view_name = "_Recent" # In default_exclude, so it's not sorted itself
+
+def recent_link_names(roots):
+  """Returns link name -> root for the roots, named like the root, with the dirs it is in added if
+  another root has the same name"""
+  by_name = dict()
+  for root in roots:
+    by_name.setdefault(os.path.basename(root), []).append(root)
+  links = dict()
+  for name, same in by_name.iteritems():
+    for root in same:
+      if len(same)>1:
+        parent = os.path.relpath(os.path.dirname(root), args.media_dir)
+        links["%s (%s)" % (name, parent.replace(os.path.sep, ' - '))] = root
+      else:
+        links[name] = root
+  return links
+
+def recent_view_links(view):
+  # Link name -> normalised path it links to, for the symlinks in the view
+  links = dict()
+  for name, kind in list_dir(view).iteritems():
+    path = os.path.join(view, name)
+    if kind=='link' or counted_islink(path): # Listed as a file if it's broken
+      links[name] = os.path.normpath(os.path.join(view, os.readlink(path)))
+  return links
+
+def update_recent_view(top):
+  """Queues the commands linking the recent media roots in top that are not in the view yet, and
+  removing the links to roots in top that are gone or not recent any more"""
+  view = os.path.join(args.media_dir, recent_view_name)
+  in_top = lambda path: top==args.media_dir or path==top or path.startswith(top+os.path.sep)
+  existing = recent_view_links(view) if path_isdir(view) else dict()
+  wanted = recent_link_names(sorted(set(recent_videos)))
+  unlink = [name for name, target in existing.iteritems() if in_top(target) and wanted.get(name)!=target]
+  link = []
+  for name, root in sorted(wanted.iteritems()):
+    if existing.get(name)==root:
+      continue
+    if name in existing and name not in unlink:
+      print "WARNING, %s in %s links to %s already, not linking %s" % (name, view, existing[name], root)
+      continue
+    link.append((name, root))
+  if unlink:
+    queue_cmd(rm_cmd, *[os.path.join(view, name) for name in sorted(unlink)])
+  if link and view not in created_paths and not path_exists(view):
+    queue_cmd(mkdir_rec_cmd, view)
+    created_paths.add(view)
+  for name, root in link:
+    queue_cmd(symlink_cmd, root, os.path.join(view, name))
+#####################################################
 
-for root, dirs, files in os.walk(args.media_dir):
+def sort_dir(root, dirs, files, subs_retcode=None, unrar_retcode=None):
+  # subs_retcode or unrar_retcode is set when called again for a root after searching subtitles for
+  # it or extracting archives in it
   mediafiles = []
   subfiles = dict() # need to associate subs with their media files, so need to hash name before ext
   keepfiles = []
   deletefiles = []
   metafiles = []
   
-  dirs[:] = [d for d in dirs if d not in args.exclude]
+  dirs[:] = [d for d in dirs if d not in excluded]
 
   if "VIDEO_TS" in dirs: #Special treatment of DVD images
     dirs.remove("VIDEO_TS")
     mediafiles.append("VIDEO_TS")
   
   dircount_cache[root]=len(dirs)
+
+  # Skip media roots that were already sorted and have not changed since
+  unchanged = [(d, scan_index_unchanged(os.path.join(root, d))) for d in dirs]
+  dirs[:] = [d for d, ctime in unchanged if ctime is None]
+  for d, ctime in unchanged:
+    if ctime is not None and datetime.fromtimestamp(ctime) > datetime.now()-recent_limit:
+      recent_videos.append(os.path.join(root, d))
+  if os.path.abspath(root)==db_dir:
+    files = [f for f in files if not f.startswith(db_name)] # The db and its journal
   
   need_subs = False
   for file in files:
     fname, ext = os.path.splitext(file)
     ext = ext.strip('.').lower()
-    if fnmatch_multi(file, args.keepfiles):
+    rule = file_rules(file.lower())
+    if rule=='keep':
       keepfiles.append(file)
-    elif fnmatch_multi(file, args.deletefiles):
+    elif rule=='delete':
       deletefiles.append(file)
     elif ext in video_types: #a file in dir has right extension
       if "sample" in fname.lower() or "trailer" in fname.lower():
@@ -749,8 +3570,31 @@ for root, dirs, files in os.walk(args.media_dir):
     else:
       metafiles.append(file)
   
+  ## RAR ARCHIVES ##########
+  # A root with archives of media but no media files yet is sorted when they have been extracted,
+  # the archives then go with the metafiles. Not tried again here if extracting failed
+  if not mediafiles and unrar_retcode is None:
+    archives = media_archives(root, files)
+    if archives and extract_archives(root, archives):
+      del dirs[:]
+      return
+
   if len(mediafiles)>0: #We have found a media file root!
+    ## NEW SUBFILES ############
+    # Only try to download subs if video files found can handle subs and there are no subs already
+    # Do this before anything else because it's probably better to search subtitles before renaming
+    # to get the most original format. The root is sorted when the search is done
+    searched_subs = subs_retcode is not None
+    if args.subs and need_subs and len(subfiles)==0 and not searched_subs:
+      searched_subs = True # Don't index as sorted, so it's searched again when the retry is due
+      if subs_known_missing([os.path.join(root, f) for f in mediafiles]):
+        no_subs_videos.append(root)
+      elif search_subs(root, mediafiles):
+        del dirs[:]
+        return
+
     print "\n%s\n%s" % (root, ''.ljust(len(root),'-')) # Root as title with equal length of dashes under
+    queued_before = len(cmds)
     
     # A note on time: because we may use mounted network volumes, created, modified and accessed
     # time may be incorrect depending on implementation. We want to know if
@@ -758,11 +3602,10 @@ for root, dirs, files in os.walk(args.media_dir):
     # that should reflect the last time we changed it, because the directory will be created
     # or changed when this script first encounters the movie.
     # That should be ok to use if the video was recently added to library or not
-    dt_modified = datetime.fromtimestamp(os.path.getctime(root))
+    dt_modified = datetime.fromtimestamp(path_ctime(root))
     dt_recent = datetime.now()-recent_limit
     #print "%s modified %s and limit is %s. Recent file? %s" % (root, dt_modified, dt_recent, (dt_modified > dt_recent))
-    if dt_modified > dt_recent:
-      recent_videos.append(root)
+    recent = dt_modified > dt_recent
     
     ## DELETE FILES ###########
     # Add all files to delete, make full path of each file
@@ -778,41 +3621,26 @@ for root, dirs, files in os.walk(args.media_dir):
       metafiles.remove(meta_dir_name) # do not traverse into metadata, as we have created them before
     if len(metafiles)>0:
       move(root, metafiles, metapath)
-
-    ## NEW SUBFILES ############
-    # Only try to download subs if video files found can handle subs and there are no subs already
-    # Do this before media files because it's probably better to search subtitles before renaming
-    # to get the most original format
-    if args.subs and need_subs and len(subfiles)==0:
-      queue_cmd(periscope_cmd, *[os.path.join(root, f) for f in mediafiles])
-      pop_cmd()      
-      subfiles = dict() # need to start afresh
-      for s in os.listdir(root):
-        fname, ext = os.path.splitext(s)
-        ext = ext.strip('.').lower()
-        if ext in subfiles_ext:
-          if fname in subfiles:
-            subfiles[fname].append(ext)
-          else:
-            subfiles[fname] = [ext]
       
     ## MEDIA FILES ##########
     ## Finally handle the media files. Do this last because paths will change!
     #print "Mediaroot: %s" % root
-    components = []
-    (path, dir) = os.path.split(root)
-    components.append(dir)
-    while path != args.media_dir and dircount_cache[path]<3:
-      (path, dir) = os.path.split(path)
-      components.append(dir)
+    components = media_components(root)
     moves = dict()
 
     for file in mediafiles:
-      newpath, newfile = analyze_video_file(components, file)
+      started = time.time()
+      newpath, newfile = analyze_video_file(components, file, os.path.join(root, file))
+      add_time('parse', started)
       if newpath in moves:
         moves[newpath].append((file, newfile))
       else:
         moves[newpath] = [(file, newfile)]
+    if subs_retcode==0 and len(subfiles)==0 and need_subs:
+      # Nothing found, remember that under the names the files have now and will get
+      no_subs_videos.append(root)
+      subs_missing([os.path.join(root, f) for f in mediafiles]+
+        [os.path.join(args.media_dir, newpath, nf) for newpath in moves for f, nf in moves[newpath]])
     #print moves
     moved_meta_already = False
     files_left_in_root = False
@@ -861,9 +3689,495 @@ for root, dirs, files in os.walk(args.media_dir):
           # Move the rest individually if there are any
           move(root, conc_moves, newpath)       
 
-    del dirs[:] # Don't continue deeper 
-  
-#print "Recent files: %s" % recent_videos
-print "No subs: %s" % no_subs_videos
-        
-#flush_cmds()# run all queued commands 
+    conflict = claim_paths(root, moved_to(cmds[queued_before:]))
+    if recent and (conflict or all(os.path.join(args.media_dir, newpath)==root for newpath in moves)):
+      recent_videos.append(root) # Not moved anywhere, otherwise it's linked when found sorted
+    if conflict:
+      print conflict
+      unqueue(queued_before)
+    elif len(cmds)==queued_before and not searched_subs and root!=args.media_dir:
+      # Nothing to do here, remember that so we can skip it next time unless it changes
+      index_sorted_root(root, components, sorted(files),
+        sorted(os.path.join(newpath, nf) for newpath in moves for f, nf in moves[newpath]))
+    del dirs[:] # Don't continue deeper
+#####################################################
+
+###### SHARDED SCAN ###############################################
+## With --scan-jobs, the dirs directly in the dir being sorted are walked and planned in a pool of
+## processes, one dir at a time. Nothing is run or written to the state db in the workers, each
+## returns the commands queued for every root, what it printed and what it learned, and the parent
+## merges them in the order a single process would have walked them. A root moving files to where
+## a root of an earlier shard already moves files is left as it is, see claim_paths(). Roots needing subtitle
+## searches or archives extracted are sorted again in the parent, which runs those
+
+scan_worker = False # True in the processes of the pool
+deferred_roots = [] # Roots a worker left for the parent to sort
+
+def init_scan_worker():
+  global scan_worker, parse_cache_pruned
+  scan_worker = True
+  parse_cache_pruned = True # By the parent, the workers only read the state db
+
+def sort_shard(top):
+  """Walks and plans the media roots in top without running anything, returns them as (root, what
+  was printed, commands queued by plan command name, paths moved to) with what else the parent needs"""
+  import StringIO
+  init_cmds()
+  for d in counters, parse_cache_stats:
+    d.update(dict.fromkeys(d, 0))
+  phase_times.clear()
+  for l in recent_videos, no_subs_videos, deferred_roots, scan_index_new, parse_cache_new, probe_cache_new:
+    del l[:]
+  scan_index_seen.clear()
+  roots = []
+  stdout = sys.stdout
+  try:
+    started = time.time()
+    for root, dirs, files in scan_walk(top):
+      add_time('walk', started)
+      started = time.time()
+      sys.stdout = StringIO.StringIO()
+      created_paths.clear() # Each root makes the dirs it moves to, the parent drops those made already
+      queued_before = len(cmds)
+      sort_dir(root, dirs, files)
+      if sys.stdout.getvalue() or len(cmds)>queued_before:
+        queued = cmds[queued_before:]
+        roots.append((root, sys.stdout.getvalue(), [(plan_cmd_name(cmd), paths) for cmd, paths in queued],
+          moved_to(queued)))
+      sys.stdout = stdout
+      add_time('plan', started)
+      started = time.time()
+    add_time('walk', started)
+  finally:
+    sys.stdout = stdout
+  return {'roots': roots, 'recent': recent_videos, 'no_subs': no_subs_videos, 'deferred': deferred_roots,
+    'indexed': scan_index_new, 'seen': scan_index_seen, 'parsed': parse_cache_new, 'probed': probe_cache_new,
+    'counters': counters,
+    'parse_cache': parse_cache_stats, 'phases': phase_times}
+
+def merge_shard(shard):
+  """Queues the commands of what sort_shard returned, except those of roots moving files to where
+  a root of another shard already does. The worker checked what is there already"""
+  for root, output, queued, targets in shard['roots']:
+    queued = [(plan_cmds[name], paths) for name, paths in queued]
+    made = [(cmd, paths) for cmd, paths in queued if cmd is mkdir_rec_cmd and paths[0] in created_paths]
+    for cmd, paths in made: # By an earlier root, not shown as if it was made again
+      output = output.replace(human_friendly_cmd(cmd, *paths)+'\n', '', 1)
+    sys.stdout.write(output)
+    conflict = claim_paths(root, targets, existing=False)
+    if conflict:
+      print conflict
+      continue
+    for cmd, paths in queued:
+      if (cmd, paths) not in made:
+        if cmd is mkdir_rec_cmd:
+          created_paths.add(paths[0])
+        cmds.append(Op(cmd, paths))
+  recent_videos.extend(shard['recent'])
+  no_subs_videos.extend(shard['no_subs'])
+  deferred_roots.extend(shard['deferred'])
+  for row in shard['indexed']:
+    scan_index[row[0]] = row[2:5]
+  scan_index_new.extend(shard['indexed'])
+  scan_index_seen.update(shard['seen'])
+  parse_cache_new.extend(shard['parsed'])
+  probe_cache_new.extend(shard['probed'])
+  for totals, key in (counters, 'counters'), (parse_cache_stats, 'parse_cache'):
+    for name, n in shard[key].iteritems():
+      totals[name] += n
+  for phase, seconds in shard['phases'].iteritems():
+    phase_times[phase] = phase_times.get(phase, 0.0)+seconds
+
+def sort_sharded(top):
+  """Sorts the media roots in top like sort_walk, with the dirs in it walked in a pool of
+  args.scan_jobs processes. The walk and plan times are then summed over the processes"""
+  import multiprocessing
+  started = time.time()
+  try:
+    listing = list_dir(top)
+  except OSError:
+    return
+  dirs, files = scan_dir(top)
+  add_time('walk', started)
+  started = time.time()
+  sort_dir(top, dirs, files)
+  add_time('plan', started)
+  shards = [os.path.join(top, d) for d in dirs if listing.get(d)=='dir']
+  if shards:
+    close_state_db() # The workers open their own
+    pool = multiprocessing.Pool(min(args.scan_jobs, len(shards)), init_scan_worker)
+    try:
+      for shard in pool.imap(sort_shard, shards):
+        merge_shard(shard)
+    finally:
+      pool.terminate()
+      pool.join()
+  while deferred_roots:
+    sort_walk(deferred_roots.pop(0))
+#####################################################
+
+###### BACKGROUND COMMANDS ###############################################
+## Slow commands, such as subtitle searches and extracting archives, run in pools of workers while
+## the walk goes on. The roots they were run for are sorted again when the walk is done and their
+## commands have finished
+
+pools = dict() # Pool name -> (work queue, workers), started by the first command for it
+waiting_roots = [] # (root, queues the results come in, sort_dir() argument for the retcode) in the order started
+
+def background_worker(work):
+  while True:
+    item = work.get()
+    if item is None:
+      return
+    queued, result = item
+    result.put(exec_cmd(queued))
+
+def run_in_background(pool, size, queued):
+  """Runs a queued command in the named pool of size workers, returns a queue its
+  (output, retcode, errors) will come in"""
+  import threading, Queue
+  if pool not in pools:
+    pools[pool] = (Queue.Queue(), [])
+    for i in range(max(1, size)):
+      t = threading.Thread(target=background_worker, args=(pools[pool][0],))
+      t.daemon = True # Don't keep the process alive if the walk fails
+      t.start()
+      pools[pool][1].append(t)
+  result = Queue.Queue(1)
+  pools[pool][0].put((queued, result))
+  return result
+
+def finish_background():
+  # Sorts the roots that were waiting for background commands, in the order they were started
+  while waiting_roots:
+    root, results, retcode_arg = waiting_roots.pop(0)
+    retcodes = []
+    for result in results:
+      output, retcode, errors = result.get()
+      sys.stderr.write(errors)
+      retcodes.append(retcode)
+    invalidate_path(root) # The commands made new files in it
+    dirs, files = scan_dir(root)
+    sort_dir(root, dirs, files, **{retcode_arg: ([r for r in retcodes if r]+[0])[0]})
+  for work, workers in pools.itervalues():
+    for t in workers:
+      work.put(None)
+    for t in workers:
+      t.join()
+  pools.clear()
+
+def stop_background():
+  # Drops the roots still waiting and lets the workers stop after the command they are running,
+  # when the walk fails. Nothing to do after finish_background()
+  del waiting_roots[:]
+  for work, workers in pools.itervalues():
+    for t in workers:
+      work.put(None)
+  pools.clear()
+#####################################################
+
+###### SUBTITLES ###############################################
+## Subtitle searches run in the background. Files nothing was found for are remembered by their
+## path in the state db, and not searched for again until args.subs_retry days have passed
+
+def search_subs(root, mediafiles):
+  """Starts searching subtitles for the media files in root, returns False if it was not started
+  because it is not executing, was declined or has been run before"""
+  if scan_worker and args.execute:
+    deferred_roots.append(root) # The parent process runs it, see sort_shard()
+    return True
+  queued = Op(periscope_cmd, [os.path.join(root, f) for f in mediafiles])
+  if queued in cmds_history:
+    print "Already run before, ignored: %s" % render_cmd(*queued)
+    return False
+  if not args.execute or not (args.batch or confirm_cmd(queued)):
+    return False
+  cmds_history.add(queued)
+  waiting_roots.append((root, [run_in_background('subs', args.subs_jobs, queued)], 'subs_retcode'))
+  return True
+
+def subs_known_missing(paths):
+  # True if nothing was found for any of the files at paths when last searched, recently enough
+  files = sorted(set(paths))
+  known = 0
+  for i in range(0, len(files), 500): # SQLite allows 999 parameters
+    chunk = files[i:i+500]
+    known += open_state_db().execute("SELECT COUNT(*) FROM subs_missing WHERE langs=? AND searched>? AND file IN (%s)" %
+      ', '.join('?'*len(chunk)), [args.subs, time.time()-args.subs_retry*24*3600]+chunk).fetchone()[0]
+  return known==len(files)
+
+def subs_missing(paths):
+  # Paths rather than names, as names like cd1.avi are shared by unrelated titles
+  db = open_state_db()
+  db.executemany("INSERT OR REPLACE INTO subs_missing VALUES (?, ?, ?)",
+    [(f, args.subs, time.time()) for f in set(paths)])
+  db.commit()
+#####################################################
+
+###### EXTRACTION ###############################################
+## Archives with media in them are extracted into their root in the background, and the root is
+## sorted again with what came out. What is in them is found by media_archives()
+
+def extract_archives(root, archives):
+  """Starts extracting the archives in root into it, returns False if that was not started because
+  it is not executing, was declined or has been run before"""
+  if scan_worker and args.execute:
+    deferred_roots.append(root)
+    return True
+  queued = []
+  for archive in archives:
+    q = Op(unrar_cmd, (os.path.join(root, archive), os.path.join(root, '')))
+    if q in cmds_history:
+      print "Already run before, ignored: %s" % render_cmd(*q)
+    elif not args.execute:
+      queue_cmd(unrar_cmd, *q.paths) # Shown with the other commands
+    elif args.batch or confirm_cmd(q):
+      queued.append(q)
+  if not queued:
+    return False
+  results = []
+  for q in queued:
+    cmds_history.add(q)
+    results.append(run_in_background('unrar', args.unrar_jobs, q))
+  waiting_roots.append((root, results, 'unrar_retcode'))
+  return True
+#####################################################
+
+###### WATCH MODE ###############################################
+## Keeps running and handles changes as inotify reports them, through libc as there is no
+## inotify module in the standard library
+
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+watch_mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+watch_max_delay = 60 # Handle changes after this many seconds even if they keep coming
+inotify_fd = None
+watch_paths = dict() # watch descriptor -> watched dir
+
+def inotify_open():
+  import ctypes, ctypes.util
+  global libc, inotify_fd
+  libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+  inotify_fd = libc.inotify_init()
+  if inotify_fd<0:
+    exit("Could not start watching: %s" % os.strerror(ctypes.get_errno()))
+
+def add_watches(top, exclude=()):
+  import ctypes
+  for root, dirs, files in os.walk(top):
+    dirs[:] = [d for d in dirs if d not in exclude]
+    wd = libc.inotify_add_watch(inotify_fd, root, watch_mask)
+    if wd<0: # Most likely out of watches, see /proc/sys/fs/inotify/max_user_watches
+      print "WARNING, can't watch %s: %s" % (root, os.strerror(ctypes.get_errno()))
+    else:
+      watch_paths[wd] = root
+
+def remove_watches(top):
+  for wd, path in watch_paths.items():
+    if path==top or path.startswith(top+os.path.sep):
+      libc.inotify_rm_watch(inotify_fd, wd)
+      del watch_paths[wd]
+
+def read_events():
+  # Returns (path, mask) for each event waiting, path None if events were lost
+  data = os.read(inotify_fd, 65536)
+  events = []
+  i = 0
+  while i<len(data):
+    wd, mask, cookie, length = struct.unpack_from('iIII', data, i)
+    name = data[i+16:i+16+length].rstrip('\0')
+    i += 16+length
+    if mask & IN_Q_OVERFLOW:
+      events.append((None, mask))
+    elif mask & IN_IGNORED:
+      watch_paths.pop(wd, None)
+    elif wd in watch_paths:
+      events.append((os.path.join(watch_paths[wd], name) if name else watch_paths[wd], mask))
+  return events
+
+def read_changes():
+  # Returns the paths of the events waiting, watching the dirs made and no longer the dirs gone
+  changed = []
+  for path, mask in read_events():
+    changed.append(path)
+    if path and mask & IN_ISDIR:
+      if mask & (IN_MOVED_FROM | IN_DELETE):
+        remove_watches(path)
+      if mask & (IN_CREATE | IN_MOVED_TO) and os.path.basename(path) not in excluded:
+        add_watches(path, excluded)
+  return changed
+
+def wait_for_changes():
+  """Blocks until something changes, then collects changes until they have stopped for
+  args.watch_delay seconds. Returns the changed paths, including None if events were lost"""
+  select.select([inotify_fd], [], [])
+  changed = set()
+  started = time.time()
+  while True:
+    changed.update(read_changes())
+    if time.time()-started > watch_max_delay or not select.select([inotify_fd], [], [], args.watch_delay)[0]:
+      return changed
+
+def drain_own_events():
+  """Reads the events waiting after a pass, when those our commands caused have all come. Returns
+  the changed paths other than those, a path our commands changed, something in it or a dir they
+  made above it"""
+  made = set(d for p in own_changes for d in parent_dirs(p))
+  changed = set()
+  while select.select([inotify_fd], [], [], 0)[0]:
+    for path in read_changes():
+      if path is None or not (path in own_changes or path in made or
+          [d for d in parent_dirs(path) if d in own_changes]):
+        changed.add(path)
+  own_changes.clear()
+  return changed
+
+def top_dir(path, parent):
+  # The dir directly in parent that path is in, or None if path is not inside parent
+  if not path.startswith(parent+os.path.sep):
+    return None
+  return path[len(parent)+1:].split(os.path.sep, 1)[0]
+
+def watch():
+  inotify_open()
+  for import_dir in args.import_dirs or []:
+    add_watches(import_dir)
+  add_watches(args.media_dir, excluded)
+  # Torrent lists that are local are watched, the others are read again for every change
+  local_lists = set(os.path.abspath(f) for f in args.unfinished_torrents if os.path.isfile(f))
+  for d in set(os.path.dirname(f) for f in local_lists):
+    add_watches(d, os.listdir(d))
+  db_path = os.path.abspath(args.db)
+  print "Watching for changes in %s" % ', '.join((args.import_dirs or [])+[args.media_dir])
+  own_changes.clear()
+  pending = set() # Changes from elsewhere seen while reading the events of our own commands
+  while True:
+    changed, pending = pending or wait_for_changes(), set()
+    # Our own writes to the db would otherwise wake us up again
+    changed = set(p for p in changed if p is None or not os.path.abspath(p).startswith(db_path))
+    if not changed:
+      continue
+    everything = None in changed
+    changed.discard(None)
+    if len(local_lists)<len(args.unfinished_torrents) or local_lists & set(os.path.abspath(p) for p in changed):
+      if read_downloading():
+        everything = True # Something may have finished
+    if args.import_dirs:
+      only = set()
+      for import_dir in args.import_dirs:
+        only.update((import_dir, d) for d in set(top_dir(p, import_dir) for p in changed) if d)
+      if everything or only:
+        import_media(None if everything else only)
+        changed.update(own_changes) # What was imported is sorted below, its events are ignored
+    tops = set(top_dir(p, args.media_dir) for p in changed)
+    tops.discard(None)
+    if everything or [d for d in tops if not os.path.isdir(os.path.join(args.media_dir, d))]:
+      sort_media(args.media_dir) # Files directly in the media dir, or lost track of changes
+    else:
+      for d in sorted(tops):
+        if d not in excluded:
+          sort_media(os.path.join(args.media_dir, d))
+    pending = drain_own_events() # Our moves and mkdirs would otherwise wake us up again
+#####################################################
+
+###### API ###############################################
+## For using the sorter from other tools. The state is kept in module globals like when run from
+## the command line, so one Sorter works at a time and each call makes its config the one in use
+
+class Config(object):
+  """Settings for sorting media_dir, with the same defaults as the command line. Options are named
+  like the long command line options, e.g. Config('/media', import_dirs=['/downloads'], execute=True)"""
+  def __init__(self, media_dir, **options):
+    make_parser().parse_args([media_dir], namespace=self)
+    for key, value in options.items():
+      if not hasattr(self, key):
+        raise TypeError("Unknown option %s" % key)
+      setattr(self, key, value)
+
+  def __repr__(self):
+    return "Config(%s)" % ', '.join("%s=%r" % item for item in sorted(vars(self).items()))
+
+class Sorter(object):
+  """Sorts the media dir of a Config, or of parsed command line args"""
+  def __init__(self, config):
+    self.config = config
+    self.args = None
+    self.use() # Raises ConfigError right away if invalid
+
+  def use(self):
+    # Make our config the one in use again if another Sorter has been used since
+    if self.args is None or args is not self.args:
+      configure(self.config)
+      self.args = args
+
+  def parse_name(self, path):
+    """Returns the metadata parse_video_file finds in path, a file name that may have dirs before
+    it, with 'destination' added as where it would be sorted to in the media dir"""
+    self.use()
+    components = [c for c in path.split(os.path.sep) if c]
+    file = components.pop()
+    metadata = parse_video_file(components, file)
+    metadata['destination'] = os.path.join(args.media_dir, *analyze_video_file(components, file))
+    return metadata
+
+  def plan(self, media_dir=None):
+    """Returns what sorting media_dir, the configured media dir or a dir in it, would do, as a list
+    of (command name, paths). Nothing is run"""
+    self.use()
+    top = os.path.normpath(media_dir) if media_dir else args.media_dir
+    execute, batch = args.execute, args.batch
+    args.execute, args.batch = False, True # Nor the subtitle search, which runs while sorting
+    try:
+      sort_media(top, flush=False)
+    finally:
+      args.execute, args.batch = execute, batch
+    planned = [(cmd['name'], paths) for cmd, paths in optimize_cmds(cmds)]
+    init_cmds()
+    return planned
+
+  def run(self):
+    """Does what the command line does: imports, sorts and keeps watching if configured to, or
+    undoes a run"""
+    self.use()
+    global planned_steps
+    if args.undo or args.apply:
+      if args.undo:
+        undo_run(args.undo)
+      else:
+        args.execute = True # What was planned was reviewed already
+        apply_plan(args.apply)
+      close_journal()
+      save_timings()
+      return
+    resume_run()
+    planned_steps = [] if args.plan_out else None
+    read_downloading()
+    if args.import_dirs:
+      import_media()
+    sort_media(args.media_dir)
+    if args.plan_out:
+      save_plan()
+    save_timings()
+    if args.watch:
+      watch()
+    close_journal()
+
+def main(argv=None):
+  config = make_parser().parse_args(argv)
+  print config
+  try:
+    sorter = Sorter(config)
+    sorter.run()
+  except ConfigError as e:
+    exit(str(e))
+#####################################################
+
+if __name__=='__main__':
+  main()